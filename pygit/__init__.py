@@ -1,8 +1,29 @@
+import sys
+
 from .__version__ import __version__
 from .pygit import (
     cleanup, check_git_support, is_git_repo, initialize, update,
-    Commands, repos, load, load_multiple, pull, push, all_status
+    Commands, RepoStatus, repos, load, load_multiple, pull, push, fetch, all_status, all_tracking,
+    OperationResult, FanOut, commit, tag, untag, set_group, groups, select_repos,
+    status_delta, compact_history, prune_reports, set_scope, get_scope
 )
 
-__all__ = ['all_status', 'cleanup', 'check_git_support', 'is_git_repo', 'initialize', 'update',
-           'Commands', 'repos', 'load', 'load_multiple', 'pull', 'push']
+# asyncio is slow to import, so the async API is only loaded when it is first used
+_ASYNC_NAMES = ('AsyncCommands', 'async_load', 'async_load_multiple')
+
+
+def __getattr__(name):
+    if name in _ASYNC_NAMES:
+        from . import aio
+        return getattr(aio, name)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+if sys.version_info < (3, 7): # module __getattr__ is not supported
+    from .aio import AsyncCommands, async_load, async_load_multiple
+
+__all__ = ['all_status', 'all_tracking', 'cleanup', 'check_git_support', 'is_git_repo', 'initialize', 'update',
+           'Commands', 'RepoStatus', 'repos', 'load', 'load_multiple', 'pull', 'push', 'fetch',
+           'OperationResult', 'FanOut', 'commit', 'tag', 'untag', 'set_group', 'groups', 'select_repos',
+           'status_delta', 'compact_history', 'prune_reports', 'set_scope', 'get_scope',
+           'AsyncCommands', 'async_load', 'async_load_multiple']
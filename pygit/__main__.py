@@ -1,4 +1,19 @@
-from .pygit import initialize
+import sys
+
+from .pygit import initialize, repos
 
 if __name__ == "__main__":
-    initialize()
+    command = sys.argv[1:2]
+    if command == ["repos"]: # read-only, answered from the index without starting git
+        repos()
+    elif command == ["watch"]:
+        from .watch import main
+        main(sys.argv[2:])
+    elif command == ["maintain"]:
+        from .maintenance import main
+        sys.exit(main(sys.argv[2:]))
+    elif command == ["bench"]:
+        from .bench import main
+        sys.exit(main(sys.argv[2:]))
+    else:
+        initialize()
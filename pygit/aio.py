@@ -0,0 +1,297 @@
+"""asyncio counterparts of the pygit commands
+
+Every git call runs through asyncio.create_subprocess_exec so that many
+repos can be driven from a single event loop without a thread per repo.
+The number of git processes in flight is capped by a global semaphore,
+see set_concurrency().
+"""
+
+import os
+import sys
+import time
+import asyncio
+
+from subprocess import PIPE, STDOUT
+
+from . import pygit
+from .instrument import INSTRUMENTATION
+from .pygit import (
+    Commands, RepoStatus, load, load_multiple, parse_porcelain_status, status_fingerprint,
+    StatusReport, FETCH_SCHEDULER, STATUS_CACHE, open_history, prune_reports, git_environment
+)
+from .ssh import Multiplexer
+
+CONCURRENCY = 32 # maximum number of git processes running at the same time
+
+_semaphores = {} # event loop -> semaphore, asyncio primitives are bound to a loop
+
+
+def set_concurrency(limit):
+    """Set the maximum number of git processes running at the same time"""
+    global CONCURRENCY
+    CONCURRENCY = max(1, int(limit))
+    _semaphores.clear()
+
+
+def _semaphore():
+    """Return the concurrency semaphore of the running event loop"""
+    loop = asyncio.get_event_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(CONCURRENCY)
+    return semaphore
+
+
+def run(coroutine):
+    """Run a coroutine to completion on a new event loop. Convenience for calling the API from synchronous code
+
+    The loop is made the current one while it runs, subprocesses are only reaped for it then
+    """
+    try:
+        previous = asyncio.get_event_loop()
+    except RuntimeError:
+        previous = None
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if os.name != "nt" and sys.version_info < (3, 8): # later versions reap children without a loop
+        asyncio.get_child_watcher().attach_loop(loop)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        _semaphores.pop(loop, None)
+        asyncio.set_event_loop(previous)
+        loop.close()
+
+
+class AsyncCommands(Commands):
+    """Commands class whose git methods are coroutines
+
+    Takes the same parameters as Commands. Cancelling a pending call kills
+    the git process it started.
+    """
+
+    def __str__(self):
+        return "AsyncCommands: {}: {}".format(self.name, self.dir)
+
+    @classmethod
+    def from_commands(cls, commands):
+        """Create an AsyncCommands object for the repo of a Commands object"""
+        return cls(commands.name, commands.dir, commands.git_exec, commands.message)
+
+    async def _run(self, *args, timeout=None, stderr=STDOUT, env=None):
+        """Run a git command inside the repo and return its exit code and output as bytes
+
+        env holds extra environment variables, see pygit.git_environment.
+        Raises asyncio.TimeoutError if git does not finish within timeout seconds
+        """
+        async with _semaphore():
+            command = self._git(*args)
+            started = time.monotonic()
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *command, cwd=self.dir, stdin=PIPE, stdout=PIPE, stderr=stderr, env=git_environment(env, self.dir))
+            except OSError:
+                if os.path.isdir(self.dir):
+                    raise
+                return 128, self._moved_message()
+            try:
+                output, errors = await asyncio.wait_for(process.communicate(), timeout)
+            except (asyncio.CancelledError, asyncio.TimeoutError):
+                if process.returncode is None:
+                    process.kill()
+                await process.wait()
+                INSTRUMENTATION.process_finished(command, self.dir, started, process.returncode, repo=self.name)
+                raise
+            # the event loop reaps the process, so its CPU time is not known
+            INSTRUMENTATION.process_finished(command, self.dir, started, process.returncode, output, errors,
+                                             repo=self.name)
+        if stderr == PIPE and process.returncode != 0:
+            output = errors
+        return process.returncode, output
+
+    async def _execute(self, *args, timeout=None, stderr=STDOUT):
+        """Run a git command inside the repo and return its output"""
+        output = (await self._run(*args, timeout=timeout, stderr=stderr))[1]
+        return str(output.decode("utf-8"))
+
+    async def need_attention(self):
+        """Return True if a repo status is not exactly same as that of remote"""
+        return (await self.status(structured=True)).need_attention()
+
+    async def fetch(self, timeout=None):
+        """git fetch. Returns True if the fetch succeeded"""
+        returncode, _ = await self._run("fetch", timeout=timeout)
+        if returncode == 0:
+            FETCH_SCHEDULER.record(self)
+        return returncode == 0
+
+    async def status(self, timeout=None, fetch=True, force_fetch=False, structured=False, cache=False):
+        """git status
+
+        Fetches first unless FETCH_SCHEDULER considers the last fetch fresh.
+        timeout applies to the fetch and the status together.
+        Returns the text output of git status, or a RepoStatus if structured is True.
+        With cache=True structured statuses come from STATUS_CACHE, see pygit.Commands.status
+        """
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        if fetch and (force_fetch or not FETCH_SCHEDULER.is_fresh(self)):
+            await self.fetch(timeout=timeout)
+        if timeout is not None:
+            timeout = max(timeout - (loop.time() - start), 0)
+        scope = self.scope()
+        if not structured:
+            return await self._execute(*self.status_arguments(scope, porcelain=False), timeout=timeout)
+
+        if cache:
+            status = STATUS_CACHE.get(self, scope=scope)
+            if status is not None:
+                return status
+
+        returncode, output = await self._run(*self.status_arguments(scope), timeout=timeout, stderr=PIPE)
+        if returncode != 0:
+            return RepoStatus(error=output.decode("utf-8", "replace"))
+        status = parse_porcelain_status(output)
+        if cache:
+            STATUS_CACHE.put(self, status, status_fingerprint(self.dir), scope=scope)
+        else:
+            STATUS_CACHE.record(self, status)
+        return status
+
+    async def stage_file(self, file_name):
+        """git add file"""
+        return await self._execute("add", file_name)
+
+    async def stage_all(self, files="."):
+        """git add all"""
+        return await self._execute("add", *files.split())
+
+    async def commit(self, message=None):
+        """git commit. Never prompts, message defaults to self.message"""
+        return await self._execute("commit", "-m", message or self.message, stderr=PIPE)
+
+    async def stage_and_commit(self, message=None):
+        """git add followed by commit"""
+        await self.stage_all()
+        return await self.commit(message)
+
+    async def push(self):
+        """git push"""
+        output = await self._execute("push")
+        return str("Push completed.{}".format(output))
+
+    async def pull(self):
+        """git pull"""
+        output = await self._execute("pull")
+        return str("Pull completed.\n{}".format(output))
+
+    async def reset(self, number='1'):
+        """git reset"""
+        return await self._execute("reset", "HEAD~{}".format(number))
+
+
+def async_load(input_string):
+    """Load a repository with specified id or name as an AsyncCommands object"""
+    return AsyncCommands.from_commands(load(input_string))
+
+
+def async_load_multiple(*args, _all=False, query=None):
+    """Create AsyncCommands objects for a set of repositories. See load_multiple"""
+    for each in load_multiple(*args, _all=_all, query=query):
+        yield AsyncCommands.from_commands(each)
+
+
+class _Multiplexed:
+    """Async context manager around an ssh Multiplexer
+
+    Opening and closing ssh masters blocks for up to the connect timeout, so both
+    run in the default executor instead of on the event loop
+    """
+
+    def __init__(self, repositories):
+        self.multiplexer = Multiplexer(repositories, pygit.SSH_MULTIPLEX)
+
+    async def __aenter__(self):
+        await asyncio.get_event_loop().run_in_executor(None, self.multiplexer.__enter__)
+        return self.multiplexer
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_event_loop().run_in_executor(None, self.multiplexer.close)
+
+
+async def pull(*args, _all=False, query=None):
+    """Pull a set of repos concurrently and return their output in order"""
+    repositories = list(async_load_multiple(*args, _all=_all, query=query))
+    async with _Multiplexed(repositories):
+        outputs = await asyncio.gather(*[each.pull() for each in repositories])
+    for each, output in zip(repositories, outputs):
+        print("*** {} ***\n{}".format(each.name, output))
+    return outputs
+
+
+async def push(*args, _all=False, query=None):
+    """Push a set of repos concurrently and return their output in order"""
+    repositories = list(async_load_multiple(*args, _all=_all, query=query))
+    async with _Multiplexed(repositories):
+        outputs = await asyncio.gather(*[each.push() for each in repositories])
+    for each, output in zip(repositories, outputs):
+        print("*** {} ***\n{}".format(each.name, output))
+    return outputs
+
+
+async def _repo_status(repo, timeout, force_fetch, raw, cache):
+    """Return the RepoStatus of an AsyncCommands object. See pygit.repo_status"""
+    loop = asyncio.get_event_loop()
+    start = loop.time()
+    try:
+        status = await repo.status(timeout=timeout, force_fetch=force_fetch, structured=True, cache=cache)
+        if raw:
+            if timeout is not None:
+                timeout = max(timeout - (loop.time() - start), 0)
+            status.text = await repo.status(timeout=timeout, fetch=False)
+    except asyncio.TimeoutError:
+        return RepoStatus(error="git did not finish within {} seconds".format(timeout))
+    return status
+
+
+async def _named_status(repo, timeout, force_fetch, raw, cache):
+    return repo.name, await _repo_status(repo, timeout, force_fetch, raw, cache)
+
+
+async def all_status(timeout=None, force_fetch=False, raw=False, cache=False, report_format="md", ordered=True,
+                     query=None):
+    """Write status of all repositories to file in markdown format
+
+    The number of repos queried at once is bounded by CONCURRENCY. Each repo is
+    written as soon as it can be, see pygit.all_status for report_format, ordered and query
+    """
+    print("Getting repo status.\n\nYou may be prompted for credentials...")
+
+    repositories = list(async_load_multiple(_all=True, query=query))
+    stale = [each for each in repositories if force_fetch or not FETCH_SCHEDULER.is_fresh(each)]
+    history = open_history() if pygit.KEEP_HISTORY else None
+    async with _Multiplexed(stale):
+        if pygit.FETCH_PLAN and stale and not force_fetch: # ls-remote on a thread pool, off the event loop
+            await asyncio.get_event_loop().run_in_executor(None, lambda: pygit.plan_fetches(stale, timeout=timeout))
+        tasks = [asyncio.ensure_future(_named_status(each, timeout, force_fetch, raw, cache)) for each in repositories]
+        try:
+            with StatusReport(report_format, history) as report:
+                if ordered:
+                    for index, task in enumerate(tasks):
+                        report.add(*await task)
+                        tasks[index] = None # let the status go once it is written
+                else:
+                    for next_done in asyncio.as_completed(tasks):
+                        report.add(*await next_done)
+        finally:
+            for task in tasks:
+                if task is not None:
+                    task.cancel()
+            if history is not None:
+                history.close()
+    if pygit.KEEP_REPORTS is not None:
+        prune_reports(pygit.KEEP_REPORTS)
+    fname = report.path
+
+    print("\n\nDone. Status file saved in ", pygit.STATUS_DIR)
+    return fname
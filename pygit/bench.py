@@ -0,0 +1,259 @@
+"""Benchmarks of pygit operations on synthetic repo fleets
+
+Builds fleets of local repos, each with a bare "remote" next to it, so that every
+operation, fetch included, runs offline. History is written with one
+`git fast-import` per repo, which keeps building large fleets quick.
+
+    python -m pygit bench --sizes 10 100 --repeat 3 --output bench.json
+    python -m pygit bench --sizes 10 100 --compare bench.json
+
+The index and status files of the benchmark live in the fleet folder, the
+user's own index is not touched.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import statistics
+
+from contextlib import contextmanager, redirect_stdout
+from subprocess import run, PIPE
+from pathlib import Path
+
+from . import pygit
+from .__version__ import __version__
+from .catfile import close_catfiles
+
+OPERATIONS = ("initialize", "update", "repos", "load_multiple", "status", "status_cached", "all_status",
+              "all_status_cached", "all_status_processes")
+COMMITTER = "Bench <bench@example.com>"
+NOISE_FLOOR = 0.002 # seconds a median must grow by before it can count as a regression
+
+
+def _git(*args, cwd=None, stdin=None):
+    result = run(["git"] + list(args), cwd=cwd, input=stdin, stdout=PIPE, stderr=PIPE)
+    if result.returncode != 0:
+        raise Exception("git {} failed: {}".format(" ".join(args), result.stderr.decode("utf-8", "replace")))
+    return result.stdout.decode("utf-8").strip()
+
+
+def _history(count, start, parent=None, files=3):
+    """Return a fast-import stream adding count commits to refs/heads/master"""
+    stream = []
+    for i in range(start, start + count):
+        message = "commit {}".format(i).encode("utf-8")
+        stream.append(b"commit refs/heads/master\n")
+        stream.append("committer {} {} +0000\n".format(COMMITTER, 1500000000 + i * 60).encode("utf-8"))
+        stream.append(b"data %d\n%s\n" % (len(message), message))
+        if i == start and parent:
+            stream.append("from {}\n".format(parent).encode("utf-8"))
+        content = "line {}\n".format(i).encode("utf-8") * (i % 20 + 1)
+        stream.append(b"M 644 inline file%d.txt\ndata %d\n%s\n" % (i % files, len(content), content))
+    return b"".join(stream)
+
+
+def make_repo(root, name, history=10, ahead=1, behind=1, dirty=1, untracked=1):
+    """Create root/name with a bare remote in root/remotes/name.git and return its path
+
+    The repo has history commits shared with its remote, then behind commits are
+    dropped locally and ahead new ones added, so it ends up ahead and behind its
+    remote-tracking branch. dirty tracked files are modified and untracked files added
+    """
+    root = Path(root)
+    remote = root / "remotes" / (name + ".git")
+    work = root / name
+    _git("init", "-q", "--bare", str(remote))
+    _git("symbolic-ref", "HEAD", "refs/heads/master", cwd=str(remote))
+    _git("fast-import", "--quiet", cwd=str(remote), stdin=_history(max(history, behind + 1), 0))
+    _git("clone", "-q", str(remote), str(work))
+    _git("config", "user.name", "Bench", cwd=str(work))
+    _git("config", "user.email", "bench@example.com", cwd=str(work))
+
+    if ahead or behind:
+        base = _git("rev-parse", "HEAD~{}".format(behind), cwd=str(work))
+        if ahead:
+            _git("fast-import", "--quiet", "--force", cwd=str(work),
+                 stdin=_history(ahead, max(history, behind + 1), parent=base))
+        else:
+            _git("update-ref", "refs/heads/master", base, cwd=str(work))
+        _git("reset", "-q", "--hard", "master", cwd=str(work))
+
+    for i in range(dirty):
+        with open(str(work / "file{}.txt".format(i % 3)), "a") as f:
+            f.write("local change\n")
+    for i in range(untracked):
+        with open(str(work / "untracked{}.txt".format(i)), "w") as f:
+            f.write("untracked\n")
+    return work
+
+
+def make_fleet(root, count, **options):
+    """Create count repos below root/fleet, see make_repo for options. Returns the fleet folder"""
+    fleet = Path(root) / "fleet"
+    fleet.mkdir(parents=True, exist_ok=True)
+    for i in range(count):
+        make_repo(fleet, "repo{:05d}".format(i), **options)
+    return fleet
+
+
+@contextmanager
+def isolated(root):
+    """Point pygit's index and status folders into root for the duration of the block"""
+    saved = pygit.SHELF_DIR, pygit.STATUS_DIR
+    pygit.close_registry()
+    pygit.SHELF_DIR = Path(root) / "python-git-shelf"
+    pygit.STATUS_DIR = Path(root) / "python-git-status"
+    pygit.FETCH_SCHEDULER.forget()
+    try:
+        yield
+    finally:
+        pygit.close_registry()
+        close_catfiles()
+        pygit.FETCH_SCHEDULER.forget()
+        pygit.SHELF_DIR, pygit.STATUS_DIR = saved
+
+
+def _time(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _each_status(cache):
+    for repo in pygit.load_multiple(_all=True):
+        repo.status(fetch=False, structured=True, cache=cache)
+
+
+def bench_fleet(root, count, repeat=3, workers=pygit.STATUS_WORKERS, **options):
+    """Build a fleet of count repos in root and time every operation in OPERATIONS on it
+
+    Returns a list of result dicts
+    """
+    fleet = make_fleet(root, count, **options)
+    steps = {
+        "initialize": lambda: pygit.initialize(["-m", str(fleet)]),
+        "update": lambda: pygit.update(),
+        "repos": lambda: pygit.repos(),
+        "load_multiple": lambda: list(pygit.load_multiple(_all=True)),
+        "status": lambda: _each_status(cache=False),
+        "status_cached": lambda: _each_status(cache=True),
+        "all_status": lambda: pygit.all_status(workers=workers, force_fetch=True, cache=False),
+        "all_status_cached": lambda: pygit.all_status(workers=workers, cache=True),
+        "all_status_processes": lambda: pygit.all_status(processes=os.cpu_count(), cache=False),
+    }
+    results = []
+    with isolated(root):
+        for operation in OPERATIONS:
+            timings = _time(steps[operation], repeat)
+            results.append({
+                "operation": operation, "fleet_size": count, "runs": timings,
+                "min": min(timings), "median": statistics.median(timings), "mean": statistics.mean(timings),
+            })
+    return results
+
+
+def environment():
+    """Describe the machine and versions a benchmark ran with"""
+    return {
+        "pygit": __version__, "python": platform.python_version(), "platform": platform.platform(),
+        "git": _git("--version"), "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def benchmark(sizes=(10, 50), repeat=3, workers=pygit.STATUS_WORKERS, keep=None, **options):
+    """Time pygit operations on fleets of each size in sizes and return the results as a dict
+
+    keep is a folder in which the fleets are built and left behind. By default they
+    are built in a temporary folder that is removed afterwards
+    """
+    report = {"environment": environment(), "options": dict(options, repeat=repeat, workers=workers),
+              "results": []}
+    for size in sizes:
+        root = tempfile.mkdtemp(prefix="pygit-bench-") if keep is None else os.path.join(keep, str(size))
+        try:
+            report["results"].extend(bench_fleet(root, size, repeat=repeat, workers=workers, **options))
+        finally:
+            if keep is None:
+                shutil.rmtree(root, ignore_errors=True)
+    return report
+
+
+def compare(previous, current, threshold=0.2):
+    """Compare two benchmark reports and return a list of rows, one per operation and fleet size
+
+    Each row is (operation, fleet size, previous median, current median, ratio, regressed).
+    A result regressed if its median grew by more than threshold (0.2 is 20 %) and
+    by more than NOISE_FLOOR seconds
+    """
+    before = {(row["operation"], row["fleet_size"]): row["median"] for row in previous["results"]}
+    rows = []
+    for row in current["results"]:
+        key = (row["operation"], row["fleet_size"])
+        if key not in before:
+            continue
+        ratio = row["median"] / before[key] if before[key] else float("inf")
+        regressed = ratio > 1 + threshold and row["median"] - before[key] > NOISE_FLOOR
+        rows.append(key + (before[key], row["median"], ratio, regressed))
+    return rows
+
+
+def _print_results(report):
+    print("{:<18} {:>6} {:>10} {:>10}".format("operation", "repos", "median s", "min s"))
+    for row in report["results"]:
+        print("{:<18} {:>6} {:>10.4f} {:>10.4f}".format(row["operation"], row["fleet_size"], row["median"], row["min"]))
+
+
+def _print_comparison(rows):
+    print("{:<18} {:>6} {:>10} {:>10} {:>7}".format("operation", "repos", "before s", "after s", "ratio"))
+    for operation, size, before, after, ratio, regressed in rows:
+        print("{:<18} {:>6} {:>10.4f} {:>10.4f} {:>6.2f}x{}".format(
+            operation, size, before, after, ratio, "  REGRESSION" if regressed else ""))
+
+
+def main(argv=None):
+    """Entry point of `python -m pygit bench`. Returns 1 if a regression was found"""
+    parser = argparse.ArgumentParser(prog="python -m pygit bench", description="Benchmark pygit on synthetic repo fleets")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50], help="Fleet sizes to benchmark")
+    parser.add_argument("--history", type=int, default=10, help="Commits shared with the remote in each repo")
+    parser.add_argument("--ahead", type=int, default=1, help="Local commits not on the remote")
+    parser.add_argument("--behind", type=int, default=1, help="Remote commits not in the local branch")
+    parser.add_argument("--dirty", type=int, default=1, help="Modified tracked files in each repo")
+    parser.add_argument("--untracked", type=int, default=1, help="Untracked files in each repo")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each operation")
+    parser.add_argument("--workers", type=int, default=pygit.STATUS_WORKERS, help="Workers used by all_status")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Slowdown reported as a regression, 0.2 is 20%%")
+    parser.add_argument("--keep", help="Build the fleets in this folder and keep them")
+    args = parser.parse_args(argv)
+
+    report = benchmark(args.sizes, repeat=args.repeat, workers=args.workers, keep=args.keep,
+                       history=args.history, ahead=args.ahead, behind=args.behind,
+                       dirty=args.dirty, untracked=args.untracked)
+    _print_results(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print("Results saved in", args.output)
+    if args.compare:
+        with open(args.compare) as f:
+            rows = compare(json.load(f), report, args.threshold)
+        print()
+        _print_comparison(rows)
+        if any(row[-1] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,198 @@
+"""Long-lived `git cat-file` processes for fast object and ref lookups
+
+Starting git for every small query costs far more than the query itself. A CatFile
+keeps one `git cat-file --batch-check` and one `git cat-file --batch` process running
+per repo and sends every lookup through their pipes, so only the first query of a
+repo pays for a process start.
+"""
+
+import os
+import time
+import atexit
+import threading
+
+from subprocess import PIPE, DEVNULL
+
+from .instrument import TimedPopen, INSTRUMENTATION
+
+_catfiles = {} # repo directory -> CatFile
+_catfiles_lock = threading.Lock()
+
+
+def _refs_fingerprint(common_dir):
+    """Return the mtimes of packed-refs and of every folder below refs
+
+    Git updates a loose ref by renaming a lock file over it, which changes the mtime
+    of the folder holding the ref, so this changes whenever a ref is added, updated
+    or deleted
+    """
+    fingerprint = []
+    try:
+        fingerprint.append(os.stat(os.path.join(common_dir, 'packed-refs')).st_mtime_ns)
+    except OSError:
+        fingerprint.append(None)
+    for root, _, __ in os.walk(os.path.join(common_dir, 'refs')):
+        try:
+            fingerprint.append((root, os.stat(root).st_mtime_ns))
+        except OSError:
+            continue
+    return fingerprint
+
+
+def _found(fields):
+    """Return True if a cat-file header, split in fields, describes an object
+
+    Names that do not resolve are echoed back followed by missing or ambiguous, and
+    may themselves contain spaces
+    """
+    return len(fields) == 3 and fields[-1] not in (b"missing", b"ambiguous")
+
+
+class CatFile:
+    """Persistent cat-file processes for one repo
+
+    Parameters
+    -----------
+    directory : str
+        Repo directory
+    git_exec : str
+        The path to the git executable on the system, see Commands
+
+    Lookups are serialized with a lock, so one CatFile can be shared between threads
+    """
+
+    def __init__(self, directory, git_exec=None):
+        self.dir = os.path.abspath(str(directory))
+        self.git_exec = git_exec
+        self._processes = {}
+        self._started = {}
+        self._lock = threading.Lock()
+        self._refs = None
+        self._refs_fingerprint = None
+
+    def _git(self, *args):
+        if self.git_exec:
+            return [self.git_exec, 'git'] + list(args)
+        return ['git'] + list(args)
+
+    def _process(self, mode):
+        """Return the running cat-file process for mode, starting it if needed"""
+        process = self._processes.get(mode)
+        if process is None or process.poll() is not None:
+            process = TimedPopen(self._git("cat-file", mode), cwd=self.dir, stdin=PIPE, stdout=PIPE, stderr=DEVNULL)
+            self._processes[mode] = process
+            self._started[mode] = time.monotonic()
+        return process
+
+    def _request(self, mode, name, read_body):
+        """Send name to the cat-file process for mode and return its header and body
+
+        Restarts the process once if it has died
+        """
+        if "\n" in name:
+            raise ValueError("Object names cannot contain newlines")
+        for attempt in (1, 2):
+            process = self._process(mode)
+            try:
+                process.stdin.write(name.encode("utf-8") + b"\n")
+                process.stdin.flush()
+                header = process.stdout.readline()
+                if not header:
+                    raise BrokenPipeError
+                body = None
+                fields = header.split()
+                if read_body and _found(fields):
+                    body = process.stdout.read(int(fields[2]))
+                    process.stdout.read(1) # newline after the object
+                return fields, body
+            except (BrokenPipeError, ValueError):
+                self._stop(mode)
+                if attempt == 2:
+                    raise
+
+    def info(self, name):
+        """Return (sha, type, size) of the object name resolves to, or None if it does not resolve
+
+        name may be anything `git rev-parse` understands, such as HEAD or @{upstream}
+        """
+        with self._lock:
+            fields, _ = self._request("--batch-check", name, False)
+        if not _found(fields):
+            return None
+        return fields[0].decode(), fields[1].decode(), int(fields[2])
+
+    def read(self, name):
+        """Return (sha, type, content) of the object name resolves to, or None if it does not resolve"""
+        with self._lock:
+            fields, body = self._request("--batch", name, True)
+        if not _found(fields):
+            return None
+        return fields[0].decode(), fields[1].decode(), body
+
+    def refs(self, common_dir, prefix="refs/"):
+        """Return a dict mapping the names of refs starting with prefix to their SHAs
+
+        The full list is read with one `git for-each-ref` and reused until a ref changes
+        """
+        fingerprint = _refs_fingerprint(common_dir)
+        with self._lock:
+            if self._refs is None or fingerprint != self._refs_fingerprint:
+                command = self._git("for-each-ref", "--format=%(objectname) %(refname)")
+                started = time.monotonic()
+                process = TimedPopen(command, cwd=self.dir, stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL)
+                output, _ = process.communicate()
+                INSTRUMENTATION.process_finished(command, self.dir, started, process.returncode, output,
+                                                 cpu=process.cpu_time())
+                refs = {}
+                for line in output.decode("utf-8", "replace").splitlines():
+                    sha, _, refname = line.partition(" ")
+                    refs[refname] = sha
+                self._refs, self._refs_fingerprint = refs, fingerprint
+            refs = self._refs
+        return {name: sha for name, sha in refs.items() if name.startswith(prefix)}
+
+    def _stop(self, mode):
+        process = self._processes.pop(mode, None)
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+        try:
+            process.wait(timeout=1)
+        except Exception:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        # the whole life of the process is reported as one call
+        INSTRUMENTATION.process_finished(process.args, self.dir, self._started.pop(mode), process.returncode,
+                                         cpu=process.cpu_time())
+
+    def close(self):
+        """Stop the cat-file processes"""
+        with self._lock:
+            for mode in list(self._processes):
+                self._stop(mode)
+
+
+def get_catfile(directory, git_exec=None):
+    """Return the shared CatFile of the repo in directory"""
+    directory = os.path.abspath(str(directory))
+    with _catfiles_lock:
+        catfile = _catfiles.get(directory)
+        if catfile is None:
+            catfile = _catfiles[directory] = CatFile(directory, git_exec)
+        return catfile
+
+
+def close_catfiles():
+    """Stop the cat-file processes of every repo"""
+    with _catfiles_lock:
+        catfiles = list(_catfiles.values())
+        _catfiles.clear()
+    for catfile in catfiles:
+        catfile.close()
+
+
+atexit.register(close_catfiles)
@@ -0,0 +1,175 @@
+"""Fetch planning: find the repos whose remote has moved before fetching them
+
+A `git fetch` is costly even when there is nothing to get. The planner first asks
+every remote for its refs with `git ls-remote`, once per remote URL however many
+repos share it, with the remotes queried in parallel. It then compares the answer
+with the remote-tracking refs each repo already has, read from disk without
+running git. Only repos whose remote refs differ need a real fetch:
+
+    plan = plan_fetch(load_multiple(_all=True))
+    FanOut().run(plan.changed, "fetch")
+
+Repos whose remote could not be listed, or whose fetch refspecs the planner does
+not understand, are put in plan.unknown and should be fetched as usual.
+"""
+
+import os
+import threading
+
+from . import graph
+
+
+def _fetch_target(directory):
+    """Return (remote name, URL, refspecs, prune) of the remote `git fetch` uses in directory, None if there is none"""
+    from .pygit import default_remote, common_git_dir
+    config = graph.read_config(str(common_git_dir(directory)))
+    remote = default_remote(directory, config)
+    settings = config.get(("remote", remote), {})
+    url = settings.get("url", [None])[-1]
+    if not url:
+        return None
+    prune = settings.get("prune", config.get(("fetch", None), {}).get("prune", ["false"]))[-1]
+    return remote, url, settings.get("fetch", []), prune.lower() in ("true", "yes", "on", "1")
+
+
+def _check_refspecs(refspecs):
+    """Return refspecs if the planner can predict what they fetch, None if not"""
+    for refspec in refspecs:
+        source, separator, destination = refspec.lstrip("+").partition(":")
+        if refspec.startswith("^") or not separator or not destination or source.count("*") != destination.count("*"):
+            return None
+    return list(refspecs) or None
+
+
+def expected_refs(advertised, refspecs):
+    """Return the remote-tracking refs a fetch with refspecs would leave behind, given the refs the remote advertised"""
+    expected = {}
+    for ref, sha in advertised.items():
+        for refspec in refspecs:
+            local = graph._map_refspec(refspec, ref)
+            if local is not None:
+                expected[local] = sha
+    return expected
+
+
+def local_refs(common_dir, refspecs):
+    """Return the refs on disk that a fetch with refspecs writes to"""
+    refs = {}
+    for refspec in refspecs:
+        destination = refspec.lstrip("+").partition(":")[2]
+        prefix = destination.partition("*")[0]
+        refs.update({ref: sha for ref, sha in graph.list_refs(common_dir, prefix).items()
+                     if graph._map_refspec(destination + ":" + destination, ref) is not None})
+    return refs
+
+
+def parse_ls_remote(output):
+    """Return {ref: SHA} from the output of git ls-remote, peeled tags left out"""
+    refs = {}
+    for line in output.splitlines():
+        sha, _, ref = line.partition("\t")
+        if ref and not ref.endswith("^{}"):
+            refs[ref.strip()] = sha.strip()
+    return refs
+
+
+class FetchPlan:
+    """Outcome of plan_fetch
+
+    Attributes
+    -----------
+    changed : list
+        Repos whose remote refs moved, which need a fetch
+    unchanged : list
+        Repos that are up to date with their remote
+    unknown : list
+        Repos that could not be checked and should be fetched anyway
+    errors : dict
+        Repo name -> why it could not be checked
+    remotes : int
+        Number of distinct remote URLs listed
+    """
+
+    def __init__(self):
+        self.changed = []
+        self.unchanged = []
+        self.unknown = []
+        self.errors = {}
+        self.remotes = 0
+
+    def __repr__(self):
+        return "FetchPlan(changed={}, unchanged={}, unknown={}, remotes={})".format(
+            len(self.changed), len(self.unchanged), len(self.unknown), self.remotes)
+
+    @property
+    def to_fetch(self):
+        """Repos that should be fetched: changed and unknown"""
+        return self.changed + self.unknown
+
+
+def plan_fetch(repositories, workers=None, timeout=None):
+    """Sort Commands objects into a FetchPlan by comparing their remote-tracking refs with their remotes
+
+    Parameters
+    -----------
+    repositories : iterable
+        Repos to check
+    workers : int
+        Number of remotes listed at the same time, STATUS_WORKERS by default
+    timeout : float
+        Seconds each git ls-remote may take
+    """
+    from subprocess import TimeoutExpired
+    from .pygit import common_git_dir, _thread_pool, STATUS_WORKERS
+    repositories = list(repositories)
+    plan = FetchPlan()
+    lock = threading.Lock()
+    by_url = {} # remote URL -> [(repo, mapping, prune)]
+    for repo in repositories:
+        try:
+            target = _fetch_target(repo.dir)
+        except OSError as error:
+            target, plan.errors[repo.name] = None, str(error)
+        if target is None:
+            plan.errors.setdefault(repo.name, "no remote to fetch from")
+            plan.unknown.append(repo)
+            continue
+        _, url, refspecs, prune = target
+        if os.path.isdir(os.path.join(repo.dir, url)): # relative paths mean different remotes in different repos
+            url = os.path.normpath(os.path.join(repo.dir, url))
+        mapping = _check_refspecs(refspecs)
+        if mapping is None:
+            plan.errors[repo.name] = "unsupported fetch refspecs {}".format(", ".join(refspecs) or "(none)")
+            plan.unknown.append(repo)
+            continue
+        by_url.setdefault(url, []).append((repo, mapping, prune))
+    plan.remotes = len(by_url)
+
+    def check(url, members):
+        first = members[0][0]
+        try:
+            returncode, output, errors = first._capture("ls-remote", url, timeout=timeout)
+        except TimeoutExpired:
+            returncode, errors = None, "git ls-remote did not finish within {} seconds".format(timeout).encode("utf-8")
+        if returncode != 0:
+            with lock:
+                for repo, _, _ in members:
+                    plan.unknown.append(repo)
+                    plan.errors[repo.name] = errors.decode("utf-8", "replace").strip()
+            return
+        advertised = parse_ls_remote(output.decode("utf-8", "replace"))
+        for repo, mapping, prune in members:
+            expected = expected_refs(advertised, mapping)
+            local = local_refs(str(common_git_dir(repo.dir)), mapping)
+            if not prune: # refs deleted on the remote stay until a pruning fetch
+                local = {ref: sha for ref, sha in local.items() if ref in expected}
+            with lock:
+                (plan.unchanged if local == expected else plan.changed).append(repo)
+
+    if by_url:
+        with _thread_pool(min(len(by_url), workers or STATUS_WORKERS)) as executor:
+            list(executor.map(lambda item: check(*item), by_url.items()))
+    order = {id(repo): index for index, repo in enumerate(repositories)}
+    for group in (plan.changed, plan.unchanged, plan.unknown):
+        group.sort(key=lambda repo: order[id(repo)])
+    return plan
@@ -0,0 +1,606 @@
+"""Read-only access to git refs and commit history without running git
+
+Reads HEAD, loose refs, packed-refs and the repo config, and walks commit
+history from loose objects, packfiles (through their .idx files, memory mapped)
+and the commit-graph file when there is one. This is enough to tell how far each
+local branch is ahead of or behind its remote-tracking branch with no subprocess.
+
+Only SHA-1 repositories are supported.
+"""
+
+import os
+import mmap
+import zlib
+import heapq
+import struct
+import threading
+
+from collections import OrderedDict
+
+LEFT, RIGHT = 1, 2
+BOTH = LEFT | RIGHT
+
+OBJECT_TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+OFS_DELTA, REF_DELTA = 6, 7
+
+
+class UnsupportedRepository(Exception):
+    """The repository uses a format this module cannot read"""
+
+
+# refs
+
+def read_packed_refs(common_dir):
+    """Return a dict mapping ref names to SHAs from packed-refs"""
+    refs = {}
+    try:
+        with open(os.path.join(common_dir, 'packed-refs'), 'rb') as f:
+            for line in f:
+                if line.startswith((b'#', b'^')):
+                    continue
+                sha, _, name = line.strip().partition(b' ')
+                if name:
+                    refs[name.decode('utf-8', 'replace')] = sha.decode()
+    except OSError:
+        pass
+    return refs
+
+
+def _read_loose_ref(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read().strip().decode('utf-8', 'replace')
+    except OSError:
+        return None
+
+
+def list_refs(common_dir, prefix='refs/'):
+    """Return a dict mapping the names of refs starting with prefix to their SHAs
+
+    Loose refs take precedence over packed ones. Symbolic refs are left out
+    """
+    refs = {name: sha for name, sha in read_packed_refs(common_dir).items() if name.startswith(prefix)}
+    top = os.path.join(common_dir, 'refs')
+    for root, _, files in os.walk(top):
+        for file_name in files:
+            path = os.path.join(root, file_name)
+            name = 'refs/' + os.path.relpath(path, top).replace(os.sep, '/')
+            if not name.startswith(prefix) or name.endswith('.lock'):
+                continue
+            value = _read_loose_ref(path)
+            if value and not value.startswith('ref:'):
+                refs[name] = value
+    return refs
+
+
+def resolve_ref(git_dir, common_dir, name, packed=None, depth=0):
+    """Return the SHA name points to, following symbolic refs, None if it does not exist"""
+    if depth > 5:
+        return None
+    base = git_dir if name == 'HEAD' or '/' not in name else common_dir
+    value = _read_loose_ref(os.path.join(base, *name.split('/')))
+    if value is None:
+        if packed is None:
+            packed = read_packed_refs(common_dir)
+        return packed.get(name)
+    if value.startswith('ref:'):
+        return resolve_ref(git_dir, common_dir, value[4:].strip(), packed, depth + 1)
+    return value
+
+
+def head_branch(git_dir):
+    """Return the ref HEAD points to, None if HEAD is detached"""
+    value = _read_loose_ref(os.path.join(git_dir, 'HEAD')) or ''
+    return value[4:].strip() if value.startswith('ref:') else None
+
+
+# config
+
+def _unquote(value):
+    value = value.strip()
+    if value.startswith('"') and value.endswith('"') and len(value) > 1:
+        value = value[1:-1]
+    return value.replace('\\"', '"').replace('\\\\', '\\')
+
+
+def read_config(common_dir, name='config'):
+    """Return the repo config as a dict mapping (section, subsection) to {key: [values]}
+
+    Section and key names are lower cased. Include directives are ignored. name is the
+    file read in common_dir, config.worktree for the settings of a worktree
+    """
+    config = {}
+    section = None
+    try:
+        with open(os.path.join(common_dir, name), encoding='utf-8', errors='replace') as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return config
+    for line in lines:
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+        if line.startswith('['):
+            header = line[1:line.rindex(']')] if ']' in line else line[1:]
+            name, _, subsection = header.partition(' ')
+            section = (name.lower(), _unquote(subsection) if subsection else None)
+            config.setdefault(section, {})
+            line = line[line.index(']') + 1:].strip() if ']' in line else ''
+            if not line:
+                continue
+        if section is None:
+            continue
+        key, _, value = line.partition('=')
+        config[section].setdefault(key.strip().lower(), []).append(_unquote(value) if _ else 'true')
+    return config
+
+
+def _map_refspec(refspec, ref):
+    """Return the local ref a fetch refspec maps ref to, None if it does not match"""
+    refspec = refspec.lstrip('+')
+    source, _, destination = refspec.partition(':')
+    if '*' in source:
+        head, _, tail = source.partition('*')
+        if ref.startswith(head) and ref.endswith(tail) and len(ref) >= len(head) + len(tail):
+            middle = ref[len(head):len(ref) - len(tail)]
+            return destination.replace('*', middle, 1)
+        return None
+    return destination if source == ref else None
+
+
+def upstream_ref(config, branch):
+    """Return the local ref tracking the upstream of branch (e.g. refs/remotes/origin/master)
+
+    branch is a short branch name. Returns None if the branch has no upstream
+    """
+    settings = config.get(('branch', branch), {})
+    remote, merge = settings.get('remote', [None])[-1], settings.get('merge', [None])[-1]
+    if not remote or not merge:
+        return None
+    if remote == '.':
+        return merge
+    refspecs = config.get(('remote', remote), {}).get('fetch', [])
+    for refspec in refspecs:
+        mapped = _map_refspec(refspec, merge)
+        if mapped:
+            return mapped
+    if merge.startswith('refs/heads/'):
+        return 'refs/remotes/{}/{}'.format(remote, merge[len('refs/heads/'):])
+    return None
+
+
+# objects
+
+def _map_file(path):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _varint_size(data, position):
+    """Read the size varint used in delta headers"""
+    size = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        size |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return size, position
+
+
+def apply_delta(base, delta):
+    """Rebuild an object from its base and a git delta"""
+    _, position = _varint_size(delta, 0)
+    target_size, position = _varint_size(delta, position)
+    result = bytearray()
+    end = len(delta)
+    while position < end:
+        opcode = delta[position]
+        position += 1
+        if opcode & 0x80:
+            offset = size = 0
+            for i in range(4):
+                if opcode & (1 << i):
+                    offset |= delta[position] << (8 * i)
+                    position += 1
+            for i in range(3):
+                if opcode & (0x10 << i):
+                    size |= delta[position] << (8 * i)
+                    position += 1
+            if size == 0:
+                size = 0x10000
+            result += base[offset:offset + size]
+        elif opcode:
+            result += delta[position:position + opcode]
+            position += opcode
+        else:
+            raise UnsupportedRepository("Invalid delta opcode")
+    if len(result) != target_size:
+        raise UnsupportedRepository("Delta produced an object of the wrong size")
+    return bytes(result)
+
+
+class PackIndex:
+    """Version 2 pack index, memory mapped"""
+
+    def __init__(self, path):
+        self.path = path
+        self._map = _map_file(path)
+        if self._map is None or self._map[:4] != b'\xfftOc' or struct.unpack('>I', self._map[4:8])[0] != 2:
+            raise UnsupportedRepository("{} is not a version 2 pack index".format(path))
+        self._fanout = struct.unpack('>256I', self._map[8:8 + 1024])
+        self.count = self._fanout[255]
+        self._names = 8 + 1024
+        self._offsets = self._names + self.count * 24 # after names and crc32s
+        self._large_offsets = self._offsets + self.count * 4
+
+    def offset(self, sha):
+        """Return the pack offset of the 20 byte sha, None if the pack does not hold it"""
+        first = sha[0]
+        low = self._fanout[first - 1] if first else 0
+        high = self._fanout[first]
+        data, names = self._map, self._names
+        while low < high:
+            middle = (low + high) // 2
+            start = names + middle * 20
+            candidate = data[start:start + 20]
+            if candidate < sha:
+                low = middle + 1
+            elif candidate > sha:
+                high = middle
+            else:
+                start = self._offsets + middle * 4
+                offset = struct.unpack('>I', data[start:start + 4])[0]
+                if offset & 0x80000000:
+                    start = self._large_offsets + (offset & 0x7fffffff) * 8
+                    offset = struct.unpack('>Q', data[start:start + 8])[0]
+                return offset
+        return None
+
+    def close(self):
+        self._map.close()
+
+
+class Pack:
+    """A packfile and its index"""
+
+    def __init__(self, index_path):
+        self.index = PackIndex(index_path)
+        self._map = _map_file(index_path[:-len('.idx')] + '.pack')
+        if self._map is None or self._map[:4] != b'PACK':
+            raise UnsupportedRepository("{} has no valid pack".format(index_path))
+
+    def _inflate(self, position, size):
+        decompressor = zlib.decompressobj()
+        chunk = max(size * 2, 512)
+        output = b''
+        while not decompressor.eof:
+            data = self._map[position:position + chunk]
+            if not data:
+                break
+            output += decompressor.decompress(data)
+            position += chunk
+            chunk *= 2
+        return output
+
+    def read_at(self, offset, store):
+        """Return (type, data) of the object at offset. store resolves REF_DELTA bases"""
+        data = self._map
+        byte = data[offset]
+        position = offset + 1
+        kind = (byte >> 4) & 7
+        size = byte & 0x0f
+        shift = 4
+        while byte & 0x80:
+            byte = data[position]
+            position += 1
+            size |= (byte & 0x7f) << shift
+            shift += 7
+
+        if kind == OFS_DELTA:
+            byte = data[position]
+            position += 1
+            distance = byte & 0x7f
+            while byte & 0x80:
+                byte = data[position]
+                position += 1
+                distance = ((distance + 1) << 7) | (byte & 0x7f)
+            base_kind, base = store.read_pack_offset(self, offset - distance)
+            return base_kind, apply_delta(base, self._inflate(position, size))
+        if kind == REF_DELTA:
+            base_sha = bytes(data[position:position + 20])
+            base_kind, base = store.read(base_sha)
+            return base_kind, apply_delta(base, self._inflate(position + 20, size))
+        if kind not in OBJECT_TYPES:
+            raise UnsupportedRepository("Unknown object type {} in pack".format(kind))
+        return OBJECT_TYPES[kind], self._inflate(position, size)
+
+    def close(self):
+        self.index.close()
+        self._map.close()
+
+
+class ObjectStore:
+    """Object database of a repo: loose objects, packs and alternates
+
+    Parameters
+    -----------
+    common_dir : str
+        Git directory holding the objects folder
+    cache_size : int
+        Number of unpacked objects kept to speed up delta chains
+    """
+
+    def __init__(self, common_dir, cache_size=1024):
+        self.objects = os.path.join(common_dir, 'objects')
+        self.packs = []
+        self.directories = [self.objects] + self._alternates(self.objects)
+        for directory in self.directories:
+            pack_dir = os.path.join(directory, 'pack')
+            try:
+                names = sorted(os.listdir(pack_dir))
+            except OSError:
+                continue
+            for name in names:
+                if name.endswith('.idx'):
+                    self.packs.append(Pack(os.path.join(pack_dir, name)))
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _alternates(objects):
+        try:
+            with open(os.path.join(objects, 'info', 'alternates')) as f:
+                return [os.path.join(objects, line.strip()) for line in f
+                        if line.strip() and not line.startswith('#')]
+        except OSError:
+            return []
+
+    def _remember(self, key, value):
+        with self._lock:
+            self._cache[key] = value
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def read_pack_offset(self, pack, offset):
+        """Return (type, data) of the object at offset in pack"""
+        key = (id(pack), offset)
+        cached = self._cache.get(key)
+        if cached is None:
+            cached = pack.read_at(offset, self)
+            self._remember(key, cached)
+        return cached
+
+    def read(self, sha):
+        """Return (type, data) of the object with the 20 byte sha"""
+        for pack in self.packs:
+            offset = pack.index.offset(sha)
+            if offset is not None:
+                return self.read_pack_offset(pack, offset)
+        hex_sha = sha.hex()
+        for directory in self.directories:
+            try:
+                with open(os.path.join(directory, hex_sha[:2], hex_sha[2:]), 'rb') as f:
+                    raw = zlib.decompress(f.read())
+            except OSError:
+                continue
+            header, _, data = raw.partition(b'\0')
+            return header.split(b' ')[0].decode(), data
+        raise KeyError(hex_sha)
+
+    def close(self):
+        for pack in self.packs:
+            pack.close()
+
+
+class CommitGraph:
+    """commit-graph file giving the parents and dates of commits without unpacking them"""
+
+    def __init__(self, path):
+        self._map = _map_file(path)
+        data = self._map
+        if data is None or data[:4] != b'CGPH' or data[4] != 1 or data[5] != 1:
+            raise UnsupportedRepository("Unsupported commit-graph {}".format(path))
+        chunk_count = data[6]
+        chunks = {}
+        for i in range(chunk_count + 1):
+            start = 8 + i * 12
+            chunk_id = bytes(data[start:start + 4])
+            chunks[chunk_id] = struct.unpack('>Q', data[start + 4:start + 12])[0]
+        for required in (b'OIDF', b'OIDL', b'CDAT'):
+            if required not in chunks:
+                raise UnsupportedRepository("commit-graph {} lacks {}".format(path, required))
+        self._fanout = struct.unpack('>256I', data[chunks[b'OIDF']:chunks[b'OIDF'] + 1024])
+        self.count = self._fanout[255]
+        self._oids = chunks[b'OIDL']
+        self._data = chunks[b'CDAT']
+        self._edges = chunks.get(b'EDGE')
+
+    def position(self, sha):
+        """Return the position of the 20 byte sha in the graph, None if it is missing"""
+        first = sha[0]
+        low = self._fanout[first - 1] if first else 0
+        high = self._fanout[first]
+        data = self._map
+        while low < high:
+            middle = (low + high) // 2
+            start = self._oids + middle * 20
+            candidate = data[start:start + 20]
+            if candidate < sha:
+                low = middle + 1
+            elif candidate > sha:
+                high = middle
+            else:
+                return middle
+        return None
+
+    def sha(self, position):
+        start = self._oids + position * 20
+        return bytes(self._map[start:start + 20])
+
+    def commit(self, position):
+        """Return (commit time, parent SHAs) of the commit at position"""
+        start = self._data + position * 36 + 20
+        first, second, high, low = struct.unpack('>IIII', self._map[start:start + 16])
+        when = ((high & 0x3) << 32) | low
+        parents = []
+        if first != 0x70000000:
+            parents.append(self.sha(first))
+        if second != 0x70000000:
+            if second & 0x80000000 and self._edges is not None:
+                index = second & 0x7fffffff
+                while True:
+                    edge = struct.unpack('>I', self._map[self._edges + index * 4:self._edges + index * 4 + 4])[0]
+                    parents.append(self.sha(edge & 0x7fffffff))
+                    if edge & 0x80000000:
+                        break
+                    index += 1
+            else:
+                parents.append(self.sha(second))
+        return when, parents
+
+    def close(self):
+        self._map.close()
+
+
+def parse_commit(data):
+    """Return (commit time, parent SHAs) from the content of a commit object"""
+    parents = []
+    when = 0
+    for line in data.split(b'\n'):
+        if not line:
+            break
+        if line.startswith(b'parent '):
+            parents.append(bytes.fromhex(line[7:47].decode()))
+        elif line.startswith(b'committer '):
+            try:
+                when = int(line.rsplit(b' ', 2)[-2])
+            except (ValueError, IndexError):
+                when = 0
+    return when, parents
+
+
+class Repository:
+    """Read-only view of the refs and commit history of a repo
+
+    Parameters
+    -----------
+    directory : str
+        Repo working directory
+    """
+
+    def __init__(self, directory):
+        from .pygit import git_dir, common_git_dir
+        self.dir = os.path.abspath(str(directory))
+        self.git_dir = str(git_dir(self.dir))
+        self.common_dir = str(common_git_dir(self.dir))
+        self.config = read_config(self.common_dir)
+        object_format = self.config.get(('extensions', None), {}).get('objectformat', ['sha1'])[-1]
+        if object_format.lower() != 'sha1':
+            raise UnsupportedRepository("{} uses {} object names".format(self.dir, object_format))
+        self.store = ObjectStore(self.common_dir)
+        self.graph = None
+        graph_path = os.path.join(self.common_dir, 'objects', 'info', 'commit-graph')
+        if os.path.exists(graph_path):
+            try:
+                self.graph = CommitGraph(graph_path)
+            except UnsupportedRepository:
+                self.graph = None
+        self._commits = {}
+
+    def close(self):
+        self.store.close()
+        if self.graph is not None:
+            self.graph.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def commit(self, sha):
+        """Return (commit time, parent SHAs) of the commit with the 20 byte sha"""
+        info = self._commits.get(sha)
+        if info is None:
+            position = self.graph.position(sha) if self.graph is not None else None
+            if position is not None:
+                info = self.graph.commit(position)
+            else:
+                kind, data = self.store.read(sha)
+                while kind == 'tag': # peel annotated tags
+                    kind, data = self.store.read(bytes.fromhex(data[7:47].decode()))
+                if kind != 'commit':
+                    raise UnsupportedRepository("{} is not a commit".format(sha.hex()))
+                info = parse_commit(data)
+            self._commits[sha] = info
+        return info
+
+    def branches(self):
+        """Return a dict mapping local branch names to their SHAs"""
+        return {name[len('refs/heads/'):]: sha for name, sha in list_refs(self.common_dir, 'refs/heads/').items()}
+
+    def ahead_behind(self, left, right):
+        """Return (commits only reachable from left, commits only reachable from right)
+
+        left and right are hex SHAs. Walks both histories newest first until every commit
+        left to visit is reachable from both sides. One side may have walked past the
+        point where the histories meet by then, when commit times are equal or skewed, so
+        the shared part is walked on until it is older than every commit seen from one side only
+        """
+        if left == right:
+            return 0, 0
+        flags = {}
+        queue = []
+        for sha, flag in ((bytes.fromhex(left), LEFT), (bytes.fromhex(right), RIGHT)):
+            flags[sha] = flags.get(sha, 0) | flag
+            heapq.heappush(queue, (-self.commit(sha)[0], sha))
+
+        oldest = None # time of the oldest commit seen from one side only, once only shared history is left
+        while queue:
+            if oldest is None and all(flags[sha] == BOTH for _, sha in queue):
+                one_sided = [self.commit(sha)[0] for sha, flag in flags.items() if flag != BOTH]
+                if not one_sided:
+                    break
+                oldest = min(one_sided)
+            if oldest is not None and -queue[0][0] < oldest:
+                break
+            _, sha = heapq.heappop(queue)
+            flag = flags[sha]
+            for parent in self.commit(sha)[1]:
+                old = flags.get(parent, 0)
+                if old | flag != old:
+                    flags[parent] = old | flag
+                    heapq.heappush(queue, (-self.commit(parent)[0], parent))
+
+        ahead = sum(1 for flag in flags.values() if flag == LEFT)
+        behind = sum(1 for flag in flags.values() if flag == RIGHT)
+        return ahead, behind
+
+    def tracking(self):
+        """Return {branch: (upstream ref, ahead, behind)} for every local branch with an upstream
+
+        ahead and behind are None when the upstream ref does not exist locally
+        """
+        result = {}
+        packed = read_packed_refs(self.common_dir)
+        for branch, sha in sorted(self.branches().items()):
+            upstream = upstream_ref(self.config, branch)
+            if upstream is None:
+                continue
+            upstream_sha = resolve_ref(self.git_dir, self.common_dir, upstream, packed)
+            if upstream_sha is None:
+                result[branch] = (upstream, None, None)
+            else:
+                result[branch] = (upstream,) + self.ahead_behind(sha, upstream_sha)
+        return result
+
+
+def tracking(directory):
+    """Return {branch: (upstream ref, ahead, behind)} for the repo in directory. See Repository.tracking"""
+    with Repository(directory) as repository:
+        return repository.tracking()
@@ -0,0 +1,252 @@
+"""History of repo statuses across all_status runs, stored as changes only
+
+Every all_status run is recorded in a SQLite database next to the index. A repo's
+status is only written when it differs from the status recorded for that repo
+before, and identical statuses are stored once however many repos or runs share
+them. Storage therefore grows with the number of changes, not with the number of
+repos times the number of runs, and so does the work of finding what changed:
+
+    history = History(SHELF_DIR / "history.db")
+    for change in history.delta(): # between the last two runs
+        print(change.name, change.before, change.after)
+    history.compact(keep_runs=100)
+
+Older runs can be dropped with compact(). The status of every repo at the oldest
+run that is kept stays available.
+"""
+
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    time REAL NOT NULL,
+    repos INTEGER NOT NULL DEFAULT 0,
+    changed INTEGER NOT NULL DEFAULT 0,
+    report TEXT
+);
+CREATE TABLE IF NOT EXISTS states (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    digest TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS changes (
+    run INTEGER NOT NULL,
+    repo TEXT NOT NULL,
+    state INTEGER NOT NULL,
+    PRIMARY KEY (repo, run)
+);
+CREATE INDEX IF NOT EXISTS changes_run ON changes (run);
+CREATE TABLE IF NOT EXISTS latest (
+    repo TEXT PRIMARY KEY,
+    state INTEGER NOT NULL,
+    run INTEGER NOT NULL
+);
+"""
+
+
+def status_digest(data):
+    """Return the digest identifying a status dict. The text of git status is left out"""
+    data = {key: value for key, value in data.items() if key != 'text'}
+    return hashlib.sha1(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest(), data
+
+
+class Change:
+    """A repo whose status differs between two runs
+
+    before and after are status dicts, None where the repo was not seen yet
+    """
+
+    __slots__ = ('name', 'before', 'after')
+
+    def __init__(self, name, before, after):
+        self.name = name
+        self.before = before
+        self.after = after
+
+    def __repr__(self):
+        return "Change({!r})".format(self.name)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class Recorder:
+    """Collects the statuses of one run. Changes are written when it is closed"""
+
+    def __init__(self, history, report=None):
+        self.history = history
+        self.report = None if report is None else str(report)
+        self.time = time.time()
+        self.count = 0
+        self._latest = history._latest_digests()
+        self._changed = {} # repo -> (digest, status dict)
+
+    def add(self, name, data):
+        """Record the status dict of the repo called name"""
+        self.count += 1
+        digest, data = status_digest(data)
+        if self._latest.get(name) != digest:
+            self._changed[name] = (digest, data)
+        else:
+            self._changed.pop(name, None) # reported twice, back to what it was
+
+    def close(self):
+        """Write the run and return its ID"""
+        return self.history._write_run(self)
+
+
+class History:
+    """Status history backed by SQLite
+
+    Parameters
+    -----------
+    path : str
+        Location of the database file. It is created if missing
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.RLock()
+        self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self._connection.close()
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock, self._connection:
+            yield self._connection
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    # recording
+
+    def recorder(self, report=None):
+        """Return a Recorder for a new run. report is the path of the status file it produced"""
+        return Recorder(self, report)
+
+    def _latest_digests(self):
+        return {row['repo']: row['digest'] for row in self._query(
+            "SELECT latest.repo, states.digest FROM latest JOIN states ON states.id = latest.state")}
+
+    def _write_run(self, recorder):
+        with self._transaction() as connection:
+            run = connection.execute(
+                "INSERT INTO runs (time, repos, changed, report) VALUES (?, ?, ?, ?)",
+                (recorder.time, recorder.count, len(recorder._changed), recorder.report)).lastrowid
+            for name, (digest, data) in recorder._changed.items():
+                connection.execute("INSERT OR IGNORE INTO states (digest, status) VALUES (?, ?)",
+                                   (digest, json.dumps(data, sort_keys=True)))
+                state = connection.execute("SELECT id FROM states WHERE digest = ?", (digest,)).fetchone()[0]
+                connection.execute("INSERT INTO changes (run, repo, state) VALUES (?, ?, ?)", (run, name, state))
+                connection.execute("INSERT OR REPLACE INTO latest (repo, state, run) VALUES (?, ?, ?)",
+                                   (name, state, run))
+        return run
+
+    # reading
+
+    def runs(self, limit=None):
+        """Return the most recent runs first as dicts with the keys id, time, repos, changed and report"""
+        sql = "SELECT * FROM runs ORDER BY id DESC"
+        if limit is not None:
+            sql += " LIMIT {:d}".format(limit)
+        return [dict(row) for row in self._query(sql)]
+
+    def run_at(self, when):
+        """Return the ID of the last run at or before the time when, None if there is none"""
+        rows = self._query("SELECT max(id) FROM runs WHERE time <= ?", (when,))
+        return rows[0][0]
+
+    def state_at(self, run=None):
+        """Return {repo: status dict} as of run, by default the last one"""
+        if run is None:
+            rows = self._query("SELECT latest.repo, states.status FROM latest JOIN states ON states.id = latest.state")
+        else:
+            rows = self._query(
+                "SELECT changes.repo, states.status FROM changes JOIN states ON states.id = changes.state "
+                "WHERE changes.run = (SELECT max(run) FROM changes AS c WHERE c.repo = changes.repo AND c.run <= ?)",
+                (run,))
+        return {row[0]: json.loads(row[1]) for row in rows}
+
+    def delta(self, start=None, end=None):
+        """Return a Change for every repo whose status changed after run start, up to run end
+
+        end defaults to the last run and start to the run before end. Only repos that
+        changed are read, so the cost does not depend on the size of the fleet
+        """
+        if end is None:
+            end = self._query("SELECT max(id) FROM runs")[0][0]
+            if end is None:
+                return []
+        if start is None:
+            start = self._query("SELECT max(id) FROM runs WHERE id < ?", (end,))[0][0] or 0
+        names = [row[0] for row in self._query(
+            "SELECT DISTINCT repo FROM changes WHERE run > ? AND run <= ? ORDER BY repo", (start, end))]
+        result = []
+        for name in names:
+            before, after = (self._status_of(name, run) for run in (start, end))
+            if before != after:
+                result.append(Change(name, before, after))
+        return result
+
+    def _status_of(self, name, run):
+        rows = self._query(
+            "SELECT states.status FROM changes JOIN states ON states.id = changes.state "
+            "WHERE changes.repo = ? AND changes.run <= ? ORDER BY changes.run DESC LIMIT 1", (name, run))
+        return json.loads(rows[0][0]) if rows else None
+
+    # retention
+
+    def compact(self, keep_runs=None, max_age=None):
+        """Drop runs beyond the keep_runs most recent ones and runs older than max_age seconds
+
+        The statuses repos had at the oldest run kept are moved onto that run, so
+        state_at() and delta() still work from there. Statuses no change refers to
+        any more are dropped. Returns the number of runs dropped
+        """
+        cutoffs = []
+        if keep_runs is not None:
+            rows = self._query("SELECT id FROM runs ORDER BY id DESC LIMIT 1 OFFSET ?", (max(keep_runs, 1) - 1,))
+            if rows:
+                cutoffs.append(rows[0][0])
+        if max_age is not None:
+            rows = self._query("SELECT min(id) FROM runs WHERE time >= ?", (time.time() - max_age,))
+            cutoffs.append(rows[0][0] if rows[0][0] is not None else
+                           self._query("SELECT max(id) FROM runs")[0][0])
+        cutoffs = [cutoff for cutoff in cutoffs if cutoff is not None]
+        if not cutoffs:
+            return 0
+        oldest = max(cutoffs) # first run kept
+        with self._transaction() as connection:
+            # the status each repo had at the oldest kept run becomes a change of that run
+            connection.execute(
+                "INSERT INTO changes (run, repo, state) "
+                "SELECT ?, repo, state FROM changes WHERE run < ? AND run = "
+                "(SELECT max(run) FROM changes AS c WHERE c.repo = changes.repo AND c.run <= ?) "
+                "AND NOT EXISTS (SELECT 1 FROM changes AS c WHERE c.repo = changes.repo AND c.run = ?)",
+                (oldest, oldest, oldest, oldest))
+            connection.execute("DELETE FROM changes WHERE run < ?", (oldest,))
+            connection.execute("UPDATE latest SET run = ? WHERE run < ?", (oldest, oldest))
+            dropped = connection.execute("DELETE FROM runs WHERE id < ?", (oldest,)).rowcount
+            connection.execute("DELETE FROM states WHERE id NOT IN (SELECT state FROM changes)")
+        return dropped
+
+    def vacuum(self):
+        """Give the space freed by compact() back to the file system"""
+        with self._lock:
+            self._connection.execute("VACUUM")
@@ -0,0 +1,224 @@
+"""Timing and resource accounting for the git processes pygit starts
+
+Every git process started by Commands, the cat-file backend and the async
+commands is reported to INSTRUMENTATION with its repo, wall time, CPU time, exit
+code and output size. It keeps counters and latency histograms per git command
+and per repo, and can write every process to a JSON Lines trace file:
+
+    INSTRUMENTATION.trace("trace.jsonl") # or set PYGIT_TRACE=trace.jsonl
+    print(INSTRUMENTATION.format_summary())
+
+scope() collects the processes started inside a block separately, which is how
+all_status(), pull() and push() print a summary of their own work.
+"""
+
+import os
+import time
+import threading
+
+from subprocess import Popen
+
+HISTOGRAM_BOUNDS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # seconds, upper bounds
+
+
+class TimedPopen(Popen):
+    """Popen that keeps the resource usage of the child once it has been waited for
+
+    rusage is None until then, and on systems without os.wait4
+    """
+
+    rusage = None
+
+    if hasattr(os, "wait4"):
+        def _try_wait(self, wait_flags):
+            try:
+                pid, status, rusage = os.wait4(self.pid, wait_flags)
+            except ChildProcessError:
+                return self.pid, 0
+            if pid == self.pid:
+                self.rusage = rusage
+            return pid, status
+
+    def cpu_time(self):
+        """Return the user plus system CPU seconds used by the child, None if unknown"""
+        if self.rusage is None:
+            return None
+        return self.rusage.ru_utime + self.rusage.ru_stime
+
+
+def git_command(args):
+    """Return the git subcommand in an argument list, e.g. status for git -c x=y status -z"""
+    args = list(args)
+    if args and os.path.basename(str(args[0])).startswith(("git", "bash", "cmd")):
+        args = args[1:]
+    if args and args[0] == "git":
+        args = args[1:]
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in ("-c", "-C", "--git-dir", "--work-tree", "--namespace"):
+            skip = True
+        elif not arg.startswith("-"):
+            return arg
+    return "git"
+
+
+class Stats:
+    """Counters and a latency histogram for one git command or repo"""
+
+    __slots__ = ('count', 'errors', 'wall', 'cpu', 'max', 'output_bytes', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.max = 0.0
+        self.output_bytes = 0
+        self.histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+
+    def add(self, record):
+        self.count += 1
+        self.errors += record["returncode"] != 0
+        self.wall += record["wall"]
+        self.cpu += record["cpu"] or 0.0
+        self.max = max(self.max, record["wall"])
+        self.output_bytes += record["stdout_bytes"] + record["stderr_bytes"]
+        bucket = 0
+        while bucket < len(HISTOGRAM_BOUNDS) and record["wall"] > HISTOGRAM_BOUNDS[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def quantile(self, fraction):
+        """Return the upper bound of the histogram bucket holding the given fraction of calls"""
+        target = fraction * self.count
+        seen = 0
+        for bound, count in zip(HISTOGRAM_BOUNDS + (self.max,), self.histogram):
+            seen += count
+            if seen >= target and count:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class Instrumentation:
+    """Aggregates records of finished git processes
+
+    Records are dicts with the keys command, args, repo, directory, started, wall,
+    cpu, returncode, stdout_bytes and stderr_bytes. cpu is None where it cannot be measured.
+    With keep_records every record is also kept in the records list
+    """
+
+    def __init__(self, keep_records=False):
+        self._lock = threading.Lock()
+        self._trace = None
+        self._scopes = []
+        self.keep_records = keep_records
+        self.reset()
+
+    def reset(self):
+        """Forget every record"""
+        with self._lock:
+            self.by_command = {}
+            self.by_repo = {}
+            self.total = Stats()
+            self.records = []
+
+    def trace(self, path):
+        """Append every record to the JSON Lines file at path. None stops tracing"""
+        with self._lock:
+            if self._trace is not None:
+                self._trace.close()
+            self._trace = open(str(path), "a") if path else None
+
+    def record(self, record):
+        """Add a finished process"""
+        with self._lock:
+            self.total.add(record)
+            self.by_command.setdefault(record["command"], Stats()).add(record)
+            self.by_repo.setdefault(record["repo"], Stats()).add(record)
+            if self.keep_records:
+                self.records.append(record)
+            if self._trace is not None:
+                import json
+                self._trace.write(json.dumps(record) + "\n")
+                self._trace.flush()
+            scopes = list(self._scopes)
+        for scope in scopes:
+            scope.record(record)
+
+    def process_finished(self, args, directory, started, returncode, stdout=b"", stderr=b"", cpu=None, repo=None):
+        """Build a record for a process started at started (time.monotonic()) and add it"""
+        directory = str(directory)
+        self.record({
+            "command": git_command(args),
+            "args": [str(arg) for arg in args],
+            "repo": repo or os.path.basename(directory),
+            "directory": directory,
+            "started": time.time() - (time.monotonic() - started),
+            "wall": time.monotonic() - started,
+            "cpu": cpu,
+            "returncode": returncode,
+            "stdout_bytes": len(stdout or b""),
+            "stderr_bytes": len(stderr or b""),
+        })
+
+    def scope(self, keep_records=False):
+        """Return a context manager collecting the records added during its block in a separate Instrumentation
+
+        With keep_records the records themselves are kept in its records list
+        """
+        return _Scope(self, keep_records)
+
+    def snapshot(self):
+        """Return the counters as plain dicts"""
+        with self._lock:
+            return {
+                "total": self.total.as_dict(),
+                "by_command": {name: stats.as_dict() for name, stats in self.by_command.items()},
+                "by_repo": {name: stats.as_dict() for name, stats in self.by_repo.items()},
+            }
+
+    def format_summary(self, top=5):
+        """Return a table of time spent per git command and the top repos by wall time"""
+        with self._lock:
+            commands = sorted(self.by_command.items(), key=lambda item: -item[1].wall)
+            repos = sorted(self.by_repo.items(), key=lambda item: -item[1].wall)[:top]
+            total = self.total
+        if not total.count:
+            return "No git processes were run"
+        header = "{:<14} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9} {:>6}".format(
+            "command", "calls", "wall s", "cpu s", "p50 s", "p95 s", "max s", "errors")
+        lines = [header, "-" * len(header)]
+        for name, stats in commands + [("total", total)]:
+            lines.append("{:<14} {:>6} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>9.3f} {:>6}".format(
+                name, stats.count, stats.wall, stats.cpu, stats.quantile(0.5), stats.quantile(0.95),
+                stats.max, stats.errors))
+        lines.append("")
+        lines.append("{:<30} {:>6} {:>9} {:>9}".format("slowest repos", "calls", "wall s", "cpu s"))
+        for name, stats in repos:
+            lines.append("{:<30} {:>6} {:>9.3f} {:>9.3f}".format(name[:30], stats.count, stats.wall, stats.cpu))
+        return "\n".join(lines)
+
+
+class _Scope:
+    def __init__(self, parent, keep_records=False):
+        self.parent = parent
+        self.usage = Instrumentation(keep_records)
+
+    def __enter__(self):
+        with self.parent._lock:
+            self.parent._scopes.append(self.usage)
+        return self.usage
+
+    def __exit__(self, *exc_info):
+        with self.parent._lock:
+            self.parent._scopes.remove(self.usage)
+
+
+INSTRUMENTATION = Instrumentation()
+if os.environ.get("PYGIT_TRACE"):
+    INSTRUMENTATION.trace(os.environ["PYGIT_TRACE"])
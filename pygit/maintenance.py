@@ -0,0 +1,242 @@
+"""Fleet maintenance: repack, gc and commit-graphs where repos need them
+
+Repos that never get maintenance pile up loose objects and packs and have no
+commit-graph, which makes every status and fetch slower. measure() inspects the
+object store of a repo from the file system, and tasks() decides what it needs:
+
+    gc              too many loose objects or packs (git's own gc.auto and gc.autoPackLimit defaults)
+    commit-graph    no commit-graph file
+    multi-pack-index several packs but no multi-pack-index
+
+Maintenance runs the tasks of several repos at once, most needy repos first. New
+tasks are held back while the load average per CPU is above max_load, each git
+process gets pack.threads threads at most, and no task starts once the time
+budget is spent:
+
+    python -m pygit maintain --dry-run
+    python -m pygit maintain --workers 2 --max-load 0.7 --budget 600
+"""
+
+import os
+import sys
+import time
+import threading
+
+from .pygit import OperationResult, load_multiple, common_git_dir, _thread_pool
+
+LOOSE_LIMIT = 6700 # estimated loose objects above which a repo is gc'ed, git's gc.auto default
+PACK_LIMIT = 50 # packs above which a repo is gc'ed, git's gc.autoPackLimit default
+MIDX_MIN_PACKS = 5 # packs from which a multi-pack-index is written
+MAX_LOAD = 0.75 # load average per CPU above which no new task is started
+LOAD_WAIT = 1.0 # seconds between load checks while held back
+
+TASKS = {
+    "gc": ("gc", "--quiet"),
+    "commit-graph": ("commit-graph", "write", "--reachable"),
+    "multi-pack-index": ("multi-pack-index", "write"),
+}
+
+
+def _has_loose_objects(objects):
+    """Return True if any loose object folder below objects holds an object"""
+    try:
+        folders = [entry.path for entry in os.scandir(objects)
+                   if len(entry.name) == 2 and entry.is_dir() and entry.name != "17"]
+    except OSError:
+        return False
+    for folder in [os.path.join(objects, "17")] + folders:
+        try:
+            if any(len(name) == 38 for name in os.listdir(folder)):
+                return True
+        except OSError:
+            continue
+    return False
+
+
+def measure(directory):
+    """Return a dict describing the object store of the repo in directory
+
+    loose_objects is estimated from one of the 256 loose object folders, as `git gc --auto`
+    does, so it is 0 for repos with a few loose objects. has_loose_objects tells whether there are any
+    """
+    objects = os.path.join(str(common_git_dir(directory)), "objects")
+    try:
+        sample = len([name for name in os.listdir(os.path.join(objects, "17")) if len(name) == 38])
+    except OSError:
+        sample = 0
+    packs, pack_bytes = 0, 0
+    try:
+        for entry in os.scandir(os.path.join(objects, "pack")):
+            if entry.name.endswith(".pack"):
+                packs += 1
+                pack_bytes += entry.stat().st_size
+    except OSError:
+        pass
+    info = os.path.join(objects, "info")
+    return {
+        "loose_objects": sample * 256,
+        "has_loose_objects": sample > 0 or _has_loose_objects(objects),
+        "packs": packs,
+        "pack_bytes": pack_bytes,
+        "commit_graph": os.path.exists(os.path.join(info, "commit-graph")) or
+                        os.path.exists(os.path.join(info, "commit-graphs", "commit-graph-chain")),
+        "multi_pack_index": os.path.exists(os.path.join(objects, "pack", "multi-pack-index")),
+    }
+
+
+def tasks(measurement):
+    """Return the names of the TASKS a repo with measurement needs, in the order they should run"""
+    if measurement["loose_objects"] > LOOSE_LIMIT or measurement["packs"] > PACK_LIMIT:
+        return ["gc"] # gc also writes the commit-graph and leaves a single pack
+    needed = []
+    if not measurement["commit_graph"] and (measurement["packs"] or measurement["has_loose_objects"]):
+        needed.append("commit-graph")
+    if measurement["packs"] >= MIDX_MIN_PACKS and not measurement["multi_pack_index"]:
+        needed.append("multi-pack-index")
+    return needed
+
+
+def _urgency(measurement):
+    return (measurement["loose_objects"] / LOOSE_LIMIT + measurement["packs"] / PACK_LIMIT,
+            measurement["pack_bytes"])
+
+
+class Maintenance:
+    """Runs maintenance tasks on many repos within a CPU and time budget
+
+    Parameters
+    -----------
+    workers : int
+        Repos maintained at the same time
+    max_load : float
+        Load average per CPU above which new tasks wait, None to ignore the load
+    threads : int
+        pack.threads given to each git process
+    budget : float
+        Seconds after which no new task is started, None for no limit. Running tasks are
+        given the time left as their timeout
+    """
+
+    def __init__(self, workers=None, max_load=MAX_LOAD, threads=None, budget=None):
+        cpus = os.cpu_count() or 1
+        self.workers = workers or max(1, cpus // 4)
+        self.max_load = max_load
+        self.threads = threads or max(1, cpus // self.workers)
+        self.budget = budget
+        self._deadline = None
+        self._gate = threading.Lock()
+
+    def _time_left(self):
+        return None if self._deadline is None else self._deadline - time.monotonic()
+
+    def _wait_for_capacity(self):
+        """Block while the machine is busy. Returns False if the budget ran out meanwhile"""
+        with self._gate: # one task is let through at a time so the load can react
+            while True:
+                left = self._time_left()
+                if left is not None and left <= 0:
+                    return False
+                if self.max_load is None or not hasattr(os, "getloadavg"):
+                    return True
+                if os.getloadavg()[0] / (os.cpu_count() or 1) <= self.max_load:
+                    return True
+                time.sleep(LOAD_WAIT if left is None else min(LOAD_WAIT, left))
+
+    def run_one(self, repo, needed):
+        """Run the tasks named in needed on repo and return an OperationResult"""
+        from subprocess import TimeoutExpired
+        start = time.monotonic()
+        result = OperationResult(repo.name, "+".join(needed) or "maintenance")
+        if not needed:
+            result.returncode, result.skipped, result.stdout = 0, True, "Nothing to do"
+            return result
+        for task in needed:
+            if not self._wait_for_capacity():
+                if result.returncode is None:
+                    result.returncode, result.skipped = 0, True
+                result.stderr += "Time budget spent before {}\n".format(task)
+                break
+            result.attempts += 1
+            try:
+                returncode, output, errors = repo._capture(
+                    "-c", "pack.threads={}".format(self.threads), *TASKS[task], timeout=self._time_left())
+            except TimeoutExpired:
+                result.returncode = None
+                result.stderr += "{} did not finish within the time budget\n".format(task)
+                break
+            result.returncode = returncode
+            result.stdout += output.decode("utf-8", "replace")
+            result.stderr += errors.decode("utf-8", "replace")
+            if returncode != 0:
+                break
+        result.duration = time.monotonic() - start
+        return result
+
+    def run(self, repos):
+        """Measure repos and run the tasks they need. Returns their OperationResults in the order of repos"""
+        repos = list(repos)
+        measurements = [measure(repo.dir) for repo in repos]
+        order = sorted(range(len(repos)), key=lambda index: _urgency(measurements[index]), reverse=True)
+        self._deadline = None if self.budget is None else time.monotonic() + self.budget
+        results = [None] * len(repos)
+        with _thread_pool(self.workers) as executor:
+            futures = {index: executor.submit(self.run_one, repos[index], tasks(measurements[index]))
+                       for index in order}
+            for index, future in futures.items():
+                results[index] = future.result()
+        return results
+
+
+def report(repos):
+    """Return (repo, measurement, tasks) for every repo without changing anything"""
+    result = []
+    for repo in repos:
+        measurement = measure(repo.dir)
+        result.append((repo, measurement, tasks(measurement)))
+    return result
+
+
+def maintain(*args, _all=False, query=None, workers=None, max_load=MAX_LOAD, threads=None, budget=None):
+    """Run the maintenance tasks that a set of repos need and return an OperationResult for each, in order
+
+    Selects repos like load_multiple, every indexed repo if none are given. See Maintenance
+    for workers, max_load, threads and budget
+    """
+    repos = load_multiple(*args, _all=_all or not args, query=query)
+    return Maintenance(workers, max_load, threads, budget).run(repos)
+
+
+def main(argv=None):
+    """Entry point of `python -m pygit maintain`"""
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m pygit maintain", description="Repack and gc the repos that need it")
+    parser.add_argument("repos", nargs="*", help="IDs or names of repos, all indexed repos by default")
+    parser.add_argument("--query", help="Only maintain repos selected by this query, e.g. group:payments")
+    parser.add_argument("--dry-run", action="store_true", help="Show what each repo needs without changing anything")
+    parser.add_argument("--workers", type=int, help="Repos maintained at the same time")
+    parser.add_argument("--max-load", type=float, default=MAX_LOAD, help="Load average per CPU above which tasks wait")
+    parser.add_argument("--threads", type=int, help="pack.threads of each git process")
+    parser.add_argument("--budget", type=float, help="Seconds after which no new task is started")
+    args = parser.parse_args(argv)
+
+    repos = load_multiple(*args.repos, _all=not args.repos, query=args.query)
+    if args.dry_run:
+        print("{:<30} {:>8} {:>6} {:>10} {:>6} {:>5}  {}".format(
+            "repo", "loose", "packs", "pack MB", "graph", "midx", "tasks"))
+        for repo, measurement, needed in report(repos):
+            print("{:<30} {:>8} {:>6} {:>10.1f} {:>6} {:>5}  {}".format(
+                repo.name[:30], measurement["loose_objects"], measurement["packs"], measurement["pack_bytes"] / 1e6,
+                "yes" if measurement["commit_graph"] else "no", "yes" if measurement["multi_pack_index"] else "no",
+                ", ".join(needed) or "-"))
+        return 0
+    results = Maintenance(args.workers, args.max_load, args.threads, args.budget).run(repos)
+    for result in results:
+        if not result.skipped or result.stderr:
+            print("*** {} ***\n{}".format(result.name, result))
+    print("{} repos maintained, {} failed".format(
+        sum(result.ok and not result.skipped for result in results), sum(not result.ok for result in results)))
+    return 1 if any(not result.ok for result in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,29 +1,50 @@
 #! /usr/bin/python3.6
 
+# Heavier modules (argparse, logging, re, sqlite3, send2trash...) are imported where
+# they are used so that importing pygit stays cheap and has no side effects
+
 import os
-import sys
-import shutil
-import shelve
-import argparse
-import logging
+import time
+import threading
+
+from pathlib import Path, PurePath
 
-from datetime import datetime
-from subprocess import Popen, PIPE, STDOUT
-from pathlib import Path, PurePath, PureWindowsPath
 
-from send2trash import send2trash
+# subprocess is only imported once git runs. These are the values of subprocess.PIPE and
+# subprocess.STDOUT, which subprocess documents as special values to pass to Popen
+PIPE = -1
+STDOUT = -2
 
 BASE_DIR = Path.home()
 DESKTOP = BASE_DIR / 'Desktop'
 SHELF_DIR = BASE_DIR / 'python-git-shelf'
 STATUS_DIR = BASE_DIR / 'python-git-status'
 TEST_DIR = BASE_DIR / "TEST_FOLDER"
-
-# NAME_SHELF = shelve.open(str(PurePath(SHELF_DIR / "NAME_SHELF"))) # Use the string representation to open path to avoid errors
-# INDEX_SHELF = shelve.open(str(PurePath(SHELF_DIR / "INDEX_SHELF")))
-# MASTER_SHELF = shelve.open(str(PurePath(SHELF_DIR / "MASTER_SHELF")))
+STATUS_WORKERS = 8 # number of repos whose status is fetched at the same time
+FETCH_TTL = 300 # seconds after a successful fetch during which a repo is not fetched again
+STATUS_CACHE_SIZE = 2000 # maximum number of repos kept in the status cache
+DISCOVERY_DEPTH = 1 # how many levels below the master directory are searched for repos
+REGISTRY_NAME = "pygit.db" # file in SHELF_DIR holding the repo index
+BATCH_BACKEND = True # answer object and ref queries through long-lived git cat-file processes
+PRINT_SUMMARY = True # print the time spent per git command after all_status, pull, push and fetch
+HOST_CONCURRENCY = 4 # maximum number of network operations against the same remote host
+NETWORK_RETRIES = 2 # times a pull, push or fetch is retried after a transient network error
+RETRY_BACKOFF = 1.0 # seconds before the first retry, doubled for every further retry
+LOG_NAME = "pygit_logger.log" # file in SHELF_DIR that verbose output is logged to
+HISTORY_NAME = "history.db" # file in SHELF_DIR holding the changes recorded by all_status
+KEEP_HISTORY = True # record every all_status run in the status history
+KEEP_REPORTS = None # status files all_status leaves in STATUS_DIR, older ones are deleted. None keeps all
+SSH_MULTIPLEX = True # share one ssh connection per host during all_status, pull, push and fetch
+FETCH_PLAN = True # list remote refs first and only fetch repos whose remote moved, see pygit.fetchplan
+GIT_ENVIRONMENT = {} # variables added to the environment of every git process pygit starts
+REPO_ENVIRONMENT = {} # repo directory -> variables added to the environment of git processes in that repo
+
+_registry = None
+_registry_lock = threading.Lock()
+_logger = None
 
 def logging_def(log_file_name):
+    import logging
     FORMATTER = logging.Formatter("%(asctime)s:%(funcName)s:%(levelname)s\n%(message)s")
     # console_logger = logging.StreamHandler(sys.stdout)
     file_logger = logging.FileHandler(log_file_name)
@@ -36,22 +57,78 @@ def logging_def(log_file_name):
     return logger
 
 
-pygit_logger = logging_def('pygit_logger.log')
-# logging.disable(logging.CRITICAL)
+def get_logger():
+    """Return the pygit logger, creating its log file in SHELF_DIR on first use"""
+    global _logger
+    if _logger is None:
+        Path.mkdir(SHELF_DIR, parents=True, exist_ok=True)
+        _logger = logging_def(str(SHELF_DIR / LOG_NAME))
+    return _logger
 
 
 def show_verbose_output(verbosity, *args):
     """Logs output"""
     if verbosity:
+        logger = get_logger()
         for arg in args:
-            pygit_logger.debug(arg)
+            logger.debug(arg)
+
+
+def get_registry():
+    """Return the repo registry, opening it on first use
+
+    The registry is shared by the whole session. Indexes kept in the shelves of
+    earlier versions are imported the first time it is opened
+    """
+    global _registry
+    path = str(SHELF_DIR / REGISTRY_NAME)
+    with _registry_lock:
+        if _registry is None or _registry.path != path:
+            Path.mkdir(SHELF_DIR, parents=True, exist_ok=True)
+            from .registry import Registry
+            _registry = Registry(path)
+            _registry.migrate_shelves(SHELF_DIR)
+        return _registry
+
+
+def close_registry():
+    """Close the repo registry. The next get_registry() call opens it again"""
+    global _registry
+    with _registry_lock:
+        if _registry is not None:
+            _registry.close()
+            _registry = None
 
 
 def cleanup():
     """Cleanup files"""
-    send2trash(SHELF_DIR)
+    close_registry()
+    from send2trash import send2trash
+    send2trash(str(SHELF_DIR))
     return
 
+def git_environment(env=None, directory=None):
+    """Return the environment to run git with, None to inherit the environment of pygit
+
+    env holds variables set for one process, on top of GIT_ENVIRONMENT and the
+    REPO_ENVIRONMENT of directory, the repo git runs in
+    """
+    repo_env = REPO_ENVIRONMENT.get(directory) if directory is not None else None
+    if not GIT_ENVIRONMENT and not repo_env and not env:
+        return None
+    environment = dict(os.environ)
+    environment.update(GIT_ENVIRONMENT)
+    environment.update(repo_env or {})
+    environment.update(env or {})
+    return environment
+
+
+def _thread_pool(workers):
+    """Return a thread pool with workers threads"""
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=max(1, workers))
+
+
 # keep for later
 def kill_process(process):
     if process.poll() is None: # don't send the signal unless it seems it is necessary
@@ -63,23 +140,162 @@ def kill_process(process):
     return
 
 
+class RepoStatus:
+    """Structured status of a repo
+
+    Attributes
+    -----------
+    branch : str
+        Checked out branch, None when HEAD is detached
+    commit : str
+        SHA of HEAD, None before the first commit
+    upstream : str
+        Remote-tracking branch of branch, None if it has none
+    ahead, behind : int
+        Commits on branch missing from upstream and the other way round
+    staged, unstaged, untracked : int
+        Number of changed paths in the index, in the working tree and not known to git
+    conflicted : list
+        Paths with unresolved merge conflicts
+    error : str
+        Why the status could not be read, None if it was read fine
+    text : str
+        Human readable `git status` output, only set when asked for
+    """
+
+    FIELDS = ('branch', 'commit', 'upstream', 'ahead', 'behind',
+              'staged', 'unstaged', 'untracked', 'conflicted', 'error', 'text')
+    __slots__ = FIELDS
+
+    def __init__(self, branch=None, commit=None, upstream=None, ahead=0, behind=0,
+                 staged=0, unstaged=0, untracked=0, conflicted=None, error=None, text=None):
+        self.branch = branch
+        self.commit = commit
+        self.upstream = upstream
+        self.ahead = ahead
+        self.behind = behind
+        self.staged = staged
+        self.unstaged = unstaged
+        self.untracked = untracked
+        self.conflicted = conflicted or []
+        self.error = error
+        self.text = text
+
+    def __repr__(self):
+        return "RepoStatus({})".format(", ".join(
+            "{}={!r}".format(field, getattr(self, field)) for field in self.FIELDS if field != 'text'))
+
+    def __str__(self):
+        lines = []
+        if self.error:
+            lines.append("error: {}".format(self.error.strip()))
+        else:
+            branch = self.branch or "detached HEAD at {}".format((self.commit or "")[:7])
+            if self.upstream:
+                lines.append("On branch {}, tracking {}".format(branch, self.upstream))
+                lines.append("ahead {}, behind {}".format(self.ahead, self.behind))
+            else:
+                lines.append("On branch {}, no upstream".format(branch))
+            lines.append("{} staged, {} not staged, {} untracked".format(
+                self.staged, self.unstaged, self.untracked))
+            if self.conflicted:
+                lines.append("conflicts: {}".format(", ".join(self.conflicted)))
+        return "\n".join(lines) + "\n"
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self.as_dict() == other.as_dict()
+        return False
+
+    def as_dict(self):
+        """Return the status as a dictionary"""
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a RepoStatus from the output of as_dict()"""
+        return cls(**{field: data[field] for field in cls.FIELDS if field in data})
+
+    def need_attention(self):
+        """Return True if a repo status is not exactly same as that of remote"""
+        return bool(self.error or self.unstaged or self.untracked or self.ahead
+                    or self.behind or self.conflicted)
+
+
+def parse_porcelain_status(output):
+    """Parse the bytes output of `git status --porcelain=v2 --branch -z` into a RepoStatus"""
+    status = RepoStatus()
+    entries = iter(output.split(b'\0'))
+    for entry in entries:
+        kind = entry[:1]
+        if kind == b'#':
+            key, _, value = entry[2:].partition(b' ')
+            if key == b'branch.oid':
+                status.commit = None if value == b'(initial)' else value.decode()
+            elif key == b'branch.head':
+                status.branch = None if value == b'(detached)' else value.decode('utf-8', 'replace')
+            elif key == b'branch.upstream':
+                status.upstream = value.decode('utf-8', 'replace')
+            elif key == b'branch.ab':
+                ahead, behind = value.split()
+                status.ahead, status.behind = int(ahead[1:]), int(behind[1:])
+        elif kind == b'1' or kind == b'2':
+            if entry[2:3] != b'.':
+                status.staged += 1
+            if entry[3:4] != b'.':
+                status.unstaged += 1
+            if kind == b'2':
+                next(entries, None) # renames and copies are followed by the original path
+        elif kind == b'u':
+            status.conflicted.append(entry.split(b' ', 10)[10].decode('utf-8', 'replace'))
+        elif kind == b'?':
+            status.untracked += 1
+    return status
+
+
 def need_attention(status_msg):
-    """Return True if a repo status is not exactly same as that of remote"""
+    """Return True if a repo status is not exactly same as that of remote
+
+    status_msg is either a RepoStatus or the text output of `git status`
+    """
+    if isinstance(status_msg, RepoStatus):
+        return status_msg.need_attention()
     msg = ["not staged", "behind", "ahead", "Untracked"]
     if any([each in status_msg for each in msg]):
         return True
     return False
 
 
+def git_dir(directory):
+    """Return the git directory of a repo
+
+    Follows the `gitdir:` pointer that worktrees and submodules keep in a .git file
+    """
+    dot_git = Path(directory) / '.git'
+    if dot_git.is_file():
+        with open(str(dot_git)) as f:
+            content = f.read().strip()
+        if content.startswith('gitdir:'):
+            return (Path(directory) / content[len('gitdir:'):].strip()).resolve()
+    return dot_git
+
+
+def common_git_dir(directory):
+    """Return the git directory holding the refs and objects shared by all worktrees of a repo"""
+    gdir = git_dir(directory)
+    try:
+        with open(str(gdir / 'commondir')) as f:
+            return (gdir / f.read().strip()).resolve()
+    except OSError:
+        return gdir
+
+
 def is_git_repo(directory):
     """
     Determine if a folder is a git repo
-    Checks the 'git status' message for error
+    Checks for a .git directory, or the .git file of worktrees and submodules
     """
-    files = os.listdir(directory)
-    if '.git' in files:
-        return True
-    return False
+    return os.path.exists(os.path.join(str(directory), '.git'))
 
 
 def check_git_support():
@@ -87,7 +303,11 @@ def check_git_support():
     Return True if git is available via command line.
     If not, check if its available as an executable in installation folder.
     """
-    proc = Popen(['git', '--version'], shell=True, stdout=PIPE,)
+    from subprocess import Popen
+    try:
+        proc = Popen(['git', '--version'], stdout=PIPE,)
+    except OSError:
+        return False
     msg, _ = proc.communicate()
     msg = msg.decode('utf-8')
     if "git version" in msg:
@@ -95,16 +315,18 @@ def check_git_support():
     return False
 
 
-def get_command_line_arguments():
-    """Get arguments from command line"""
+def get_command_line_arguments(argv=None):
+    """Get arguments from command line, or from argv if given"""
 
+    import argparse
     parser = argparse.ArgumentParser(prog="Pygit. Initialize working directories for python-git")
     parser.add_argument("-v", "--verbosity", type=int, help="turn verbosity ON/OFF", choices=[0,1])
     parser.add_argument("-r", "--rules", help="Set a list of string patterns for folders to skip during setup", nargs='+')
     parser.add_argument('-g', '--gitPath', help="Full pathname to git executable. cmd or bash.")
     parser.add_argument('-m', '--masterDirectory', help="Full pathname to directory holding any number of git repos.")
     parser.add_argument('-s', '--simpleDirectory', help="A list of full pathnames to any number of individual git repos.", nargs='+')
-    return parser.parse_args()
+    parser.add_argument('-d', '--depth', type=int, default=DISCOVERY_DEPTH, help="How many levels below the master directory to search for git repos.")
+    return parser.parse_args(argv)
 
 
 def shelve_git_path(git_path, verbosity):
@@ -116,10 +338,10 @@ def shelve_git_path(git_path, verbosity):
         user_paths = os.environ['PATH'].split(os.pathsep)
         for path in user_paths:
             if "git-cmd.exe" in path:
-                NAME_SHELF['GIT_WINDOWS'] = path
+                get_registry().set_setting('GIT_WINDOWS', path)
                 return
             if "git-bash.exe" in path:
-                NAME_SHELF['GIT_BASH'] = path
+                get_registry().set_setting('GIT_BASH', path)
                 return
     else:
         print("Git was not found in your system path.\nYou may need to set the location manually using the -g flag.\n")
@@ -127,9 +349,9 @@ def shelve_git_path(git_path, verbosity):
     if git_path:
         for _, __, files in os.walk(git_path):
             if "git-cmd.exe" in files:
-                NAME_SHELF['GIT_WINDOWS'] = git_path
+                get_registry().set_setting('GIT_WINDOWS', git_path)
             elif "git-bash.exe" in files:
-                NAME_SHELF['GIT_BASH'] = git_path
+                get_registry().set_setting('GIT_BASH', git_path)
             else:
                 print("A valid git executable was not found in the directory.\n")
                 return
@@ -154,143 +376,264 @@ def match_rule(rules, path, verbosity):
     return False
 
 
-def save_master(master_directory):
-    """Saves the location of the master directory"""
-    global MASTER_SHELF
-    MASTER_SHELF = shelve.open(str(PurePath(SHELF_DIR / "MASTER_SHELF")))
-    MASTER_SHELF["master"] = master_directory
-    MASTER_SHELF.close()
+def save_master(master_directory, max_depth=DISCOVERY_DEPTH, rules=None):
+    """Saves the location of the master directory and the settings used to search it"""
+    registry = get_registry()
+    registry.set_setting("master", os.path.abspath(str(master_directory)))
+    registry.set_setting("depth", max_depth)
+    registry.set_setting("rules", rules)
 
 
-def shelve_master_directory(master_directory, verbosity, rules):
-    """Find and store the locations of git repos"""
+def _should_descend(entry, rules, verbosity):
+    """Return True if the os.DirEntry is a folder that may hold repos"""
+    try:
+        if not entry.is_dir():
+            return False
+    except OSError:
+        return False
+    if enforce_exclusion(entry.name, verbosity):
+        return False
+    if match_rule(rules, entry.path, verbosity):
+        return False
+    return True
 
-    if master_directory:
-        save_master(master_directory)
-        show_verbose_output(verbosity, "Master directory set to ", master_directory, "Now Shelving")
 
-        i = len(list(INDEX_SHELF.keys())) + 1
-        folder_paths = [x for x in Path(master_directory).iterdir() if x.is_dir()]
+def _repo_identity(directory):
+    """Return what tells the repo in directory apart from a repo re-created in its place, None if unknown
+
+    This is the inode and change time of .git/description, which git writes once when it
+    creates the repo, or of the .git file of worktrees and submodules. Moving the repo
+    leaves both alone, while a new file gets a new change time even if its inode is reused
+    """
+    git = os.path.join(directory, '.git')
+    for path in (os.path.join(git, 'description'), git):
+        try:
+            info = os.lstat(path)
+        except OSError:
+            continue
+        if path == git and not os.path.isfile(path):
+            return None
+        return [info.st_ino, info.st_ctime_ns]
+    return None
+
+
+def _read_directory(directory, rules, verbosity, known=None, seen=None):
+    """Return a record describing directory, or None if it cannot be read
+
+    The record is a dict holding the folder's mtime and inode, whether it is a git repo,
+    the identity of the repo (see _repo_identity) and the subfolders worth searching.
+    known maps folders to the records of an earlier scan, which are reused while the
+    folder has not been modified. Every record read is added to seen
+    """
+    try:
+        info = os.stat(directory)
+    except OSError:
+        return None
+    record = known.get(directory) if known else None
+    if record is None or record['mtime'] != info.st_mtime_ns:
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return None
+        record = {
+            'mtime': info.st_mtime_ns,
+            'inode': (info.st_dev, info.st_ino),
+            'repo': any(entry.name == '.git' for entry in entries),
+            'identity': None,
+            'subfolders': [entry.path for entry in entries if _should_descend(entry, rules, verbosity)],
+        }
+    if record['repo'] and record.get('identity') is None: # also fills in records of earlier versions
+        record = dict(record, identity=_repo_identity(directory))
+    if seen is not None:
+        seen[directory] = record
+    return record
+
+
+def _scan_for_repos(directory, depth, max_depth, rules, verbosity, known=None, seen=None):
+    """Return the git repos in directory and below it, down to max_depth
+
+    A directory holding .git is a repo and is not descended into
+    """
+    record = _read_directory(directory, rules, verbosity, known, seen)
+    if record is None:
+        return []
+    if record['repo']:
+        show_verbose_output(verbosity, directory, " is a git repository *** shelving\n")
+        return [directory]
+    if depth >= max_depth:
+        return []
+
+    found = []
+    for subfolder in record['subfolders']:
+        found.extend(_scan_for_repos(subfolder, depth + 1, max_depth, rules, verbosity, known, seen))
+    return found
 
-        for f in folder_paths: # log folders
-            show_verbose_output(verbosity, f)
 
-        for folder_name in folder_paths:
-            path = Path(master_directory) / folder_name
-            if enforce_exclusion(folder_name, verbosity):
-                continue
-            if match_rule(rules, path, verbosity):
-                continue
+def discover_repos(master_directory, max_depth=DISCOVERY_DEPTH, rules=None, verbosity=0,
+                   workers=STATUS_WORKERS, known=None, seen=None):
+    """Return the sorted absolute paths of the git repos below master_directory
+
+    Parameters
+    ------------
+    master_directory : str
+        Directory to search
+    max_depth : int
+        How many levels below master_directory to search. 1 only looks at its direct children
+    rules : list
+        Folders whose path contains any of these strings are skipped, see match_rule
+    workers : int
+        Number of subtrees of master_directory searched at the same time
+    known, seen : dict
+        Folder records of an earlier search to reuse, and a dict that receives the
+        records of this one. See _read_directory
+    """
+    master_directory = os.path.abspath(str(master_directory))
+    record = _read_directory(master_directory, rules, verbosity, known, seen)
+    if record is None or max_depth < 1 or not record['subfolders']:
+        return []
+
+    with _thread_pool(workers) as executor:
+        results = executor.map(
+            lambda path: _scan_for_repos(path, 1, max_depth, rules, verbosity, known, seen),
+            record['subfolders'])
+        return sorted(repo for found in results for repo in found)
+
+
+def _reindex(master_directory, max_depth, rules, verbosity, registry):
+    """Bring the index in line with the repos below master_directory
+
+    Only folders modified since the last scan are listed again. Repos that disappeared
+    are removed, new ones are added with fresh IDs and repos whose folder was renamed
+    or moved keep their ID. A repo that cannot be told apart from a new one in its
+    place is removed and added again. Returns (added, removed, renamed) lists of paths
+    """
+    master_directory = os.path.abspath(str(master_directory))
+    settings = {'master': master_directory, 'depth': max_depth, 'rules': sorted(rules or [])}
+
+    if registry.get_setting('scan_settings') != settings: # folder records depend on the search settings
+        registry.clear_folders()
+        registry.set_setting('scan_settings', settings)
+    known = registry.folders()
+    seen = {}
+    found = discover_repos(master_directory, max_depth, rules, verbosity, known=known, seen=seen)
+    registry.save_folders(
+        {path: record for path, record in seen.items() if known.get(path) is not record},
+        known.keys() - seen.keys())
+
+    indexed = {row['path']: row for row in registry.repos()}
+    found_set = set(found)
+    removed = [path for path, row in indexed.items()
+               if row['master'] == master_directory and path not in found_set]
+    added = [path for path in found if path not in indexed]
+
+    # inodes are reused as soon as they are freed, so a moved repo must also keep its identity
+    by_inode = {(known[path]['inode'], tuple(known[path]['identity'])): path for path in removed
+                if path in known and known[path].get('identity')}
+    renamed = []
+    with registry.transaction():
+        for path in added:
+            identity = seen[path].get('identity')
+            old_path = by_inode.pop((seen[path]['inode'], tuple(identity)), None) if identity else None
+            if old_path is None:
+                repo_id = registry.add(registry.unique_name(path, master_directory), path, master_directory)
+                show_verbose_output(verbosity, path, " added to the index as ", repo_id)
+            else:
+                removed.remove(old_path)
+                renamed.append(path)
+                old = indexed[old_path]
+                name = old['name'] if old['name'] == os.path.basename(path) else \
+                    registry.unique_name(path, master_directory)
+                registry.move(old['id'], name, path)
+                show_verbose_output(verbosity, old_path, " moved to ", path)
+
+        for path in removed:
+            show_verbose_output(verbosity, path, " no longer exists. Removed from the index")
+            registry.remove(indexed[path]['id'])
 
-            directory_absolute_path = Path(path).resolve()
-            if is_git_repo(directory_absolute_path):
-                if sys.platform == 'win32':
-                    name = PureWindowsPath(directory_absolute_path).parts[-1]
-                if sys.platform == 'linux':
-                    name = PurePath(directory_absolute_path).parts[-1]
+    return [path for path in added if path not in renamed], removed, renamed
 
-                show_verbose_output(verbosity, directory_absolute_path, " is a git repository *** shelving\n")
 
-                NAME_SHELF[name] = directory_absolute_path
-                INDEX_SHELF[str(i)] = name
-                i += 1
-        # NAME_SHELF.close()
-        # INDEX_SHELF.close()
+def shelve_master_directory(master_directory, verbosity, rules, max_depth=DISCOVERY_DEPTH):
+    """Find and store the locations of git repos"""
+
+    if master_directory:
+        save_master(master_directory, max_depth, rules)
+        show_verbose_output(verbosity, "Master directory set to ", master_directory, "Now Shelving")
+        _reindex(master_directory, max_depth, rules, verbosity, get_registry())
 
 
 def shelve_simple_directory(simple_directory, verbosity):
     if simple_directory:
 
-        i = len(list(INDEX_SHELF.keys())) + 1
+        registry = get_registry()
         for directory in simple_directory:
 
+            if registry.get_by_path(directory) is not None:
+                continue
             if is_git_repo(directory):
                 show_verbose_output(verbosity, " is a git repository *** shelving\n")
-                if sys.platform == 'win32':
-                    name = directory.split("\\")[-1]
-                if sys.platform == 'linux':
-                    name = directory.split("/")[-1]
-                NAME_SHELF[name] = directory
-                INDEX_SHELF[str(i)] = name
+                directory = os.path.abspath(directory)
+                registry.add(registry.unique_name(directory, os.path.dirname(directory)), directory)
             else:
                 show_verbose_output(verbosity, " is not a valid git repo.\nContinuing...\n")
                 continue
-            i += 1
 
 
-def initialize():
-    """Initialize the data necessary for pygit to operate"""
-    print("Initializing ...")
+def _print_index(registry):
+    print("{:<4} {:<20} {:<}".format("Key", "| Name", "| Path"))
+    print("******************************************")
+    for row in registry.repos():
+        print("{:<4} {:<20} {:<}".format(row['id'], row['name'], row['path']))
 
-    global NAME_SHELF, INDEX_SHELF
-    try:
-        Path.mkdir(SHELF_DIR)
-    except FileExistsError:
-        shutil.rmtree(SHELF_DIR)
-        Path.mkdir(SHELF_DIR)
 
-    try:
-        Path.mkdir(STATUS_DIR)
-    except FileExistsError:
-        pass
+def initialize(argv=None):
+    """Initialize the data necessary for pygit to operate
 
-    NAME_SHELF = shelve.open(str(PurePath(SHELF_DIR / "NAME_SHELF"))) # Use the string representation to open path to avoid errors
-    INDEX_SHELF = shelve.open(str(PurePath(SHELF_DIR / "INDEX_SHELF")))
+    Options are read from the command line, or from the argv list if given, e.g.
+    initialize(["-m", "/path/to/repos"]). Running it again refreshes the index.
+    Repos that are still present keep their IDs
+    """
+    print("Initializing ...")
+
+    Path.mkdir(SHELF_DIR, exist_ok=True)
+    Path.mkdir(STATUS_DIR, exist_ok=True)
 
-    args = get_command_line_arguments()
+    args = get_command_line_arguments(argv)
     verbosity = args.verbosity
     rules = args.rules
     shelve_git_path(args.gitPath, verbosity)
-    shelve_master_directory(args.masterDirectory, verbosity, rules)
+    shelve_master_directory(args.masterDirectory, verbosity, rules, args.depth)
     shelve_simple_directory(args.simpleDirectory, verbosity)
 
-    INDEX_SHELF.close()
-    NAME_SHELF.close()
-
     if verbosity:
         print("\nIndexed git repos.\n")
-        NAME_SHELF = shelve.open(str(PurePath(SHELF_DIR / "NAME_SHELF")))
-        INDEX_SHELF = shelve.open(str(PurePath(SHELF_DIR / "INDEX_SHELF")))
-
         print("Status saved in {}".format(STATUS_DIR))
-        print("{:<4} {:<20} {:<}".format("Key", "| Name", "| Path"))
-        print("*********************************")
-        for key in INDEX_SHELF.keys():
-            name = INDEX_SHELF[key]
-            print("{:<4} {:<20} {:<}".format(key, name, str(NAME_SHELF[name])))
+        _print_index(get_registry())
     else:
         print("Indexing done")
     return
 
 
-def update():
-    """Update INDEX_SHELF"""
-    MASTER_SHELF = shelve.open(str(PurePath(SHELF_DIR / "MASTER_SHELF")))
-    INDEX_SHELF = shelve.open(str(PurePath(SHELF_DIR / "INDEX_SHELF")))
-    NAME_SHELF = shelve.open(str(PurePath(SHELF_DIR / "NAME_SHELF")))
+def update(max_depth=None, rules=None, verbosity=0):
+    """Update the repo index
 
-    master = MASTER_SHELF["master"]
+    Only folders modified since the last update are searched again. max_depth and
+    rules default to the values used when the master directory was set
+    """
+    registry = get_registry()
+    master = registry.get_setting("master")
+    if master is None:
+        raise Exception("No master directory has been set. Run initialize() first")
+    if max_depth is None:
+        max_depth = registry.get_setting("depth", DISCOVERY_DEPTH)
+    if rules is None:
+        rules = registry.get_setting("rules")
     print("Master ", master)
-    # shelve_master_directory(master, 0, "")
-    save_master(master)
-
-    i = len(list(INDEX_SHELF.keys())) + 1
-    folder_paths = [x for x in Path(master).iterdir() if x.is_dir()]
-
-    for folder_name in folder_paths:
-        path = Path(master) / folder_name
-
-        directory_absolute_path = Path(path).resolve()
-        if is_git_repo(directory_absolute_path):
-            if sys.platform == 'win32':
-                name = PureWindowsPath(directory_absolute_path).parts[-1]
-            if sys.platform == 'linux':
-                name = PurePath(directory_absolute_path).parts[-1]
+    save_master(master, max_depth, rules)
 
-            NAME_SHELF[name] = directory_absolute_path
-            INDEX_SHELF[str(i)] = name
-            i += 1
+    added, removed, renamed = _reindex(master, max_depth, rules, verbosity, registry)
 
+    print("{} added, {} removed, {} moved".format(len(added), len(removed), len(renamed)))
     print("Update completed successfully")
     return
 
@@ -325,111 +668,215 @@ class Commands:
 
     def __init__(self, repo_name, master_directory, git_exec=None, message="minor changes"):
         self.name = repo_name
-        self.dir = master_directory
+        self.dir = os.path.abspath(str(master_directory))
         self.git_exec = git_exec
         self.message = message
 
-        try:
-            os.chdir(self.dir)
-        except (FileNotFoundError, TypeError):
-            print("{} may have been moved.\n Run initialize() to update paths".format(self.name))
-        self.dir = os.getcwd()
-
-
     def need_attention(self):
         """Return True if a repo status is not exactly same as that of remote"""
-        msg = ["not staged", "behind", "ahead", "Untracked"]
-        status_msg = self.status()
-        if any([each in status_msg for each in msg]):
-            return True
-        return False
+        return self.status(structured=True).need_attention()
 
-    def fetch(self):
-        """git fetch"""
+    def _git(self, *args):
+        """Return the argument list for running git with args"""
         if self.git_exec:
-            process = Popen([self.git_exec, "git fetch"], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-        else:
-            process = Popen("git fetch", shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-        # output, error = process.communicate()
-        process.communicate()
-
-    def status(self):
-        """git status"""
-        self.fetch() # always do a fetch before reporting status
-        if self.git_exec:
-            process = Popen([self.git_exec, " git status"], stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+            return [self.git_exec, 'git'] + list(args)
+        return ['git'] + list(args)
+
+    def _moved_message(self):
+        return "{} may have been moved.\n Run initialize() to update paths".format(self.name).encode("utf-8")
+
+    def _capture(self, *args, timeout=None, env=None):
+        """Run a git command inside the repo and return its exit code, stdout and stderr as bytes
+
+        Git runs with the repo as its working directory, the working directory of the
+        process is never changed. env holds extra environment variables, see
+        git_environment. Raises TimeoutExpired if git does not finish within timeout seconds
+        """
+        return self._spawn(args, PIPE, timeout, env)
+
+    def _run(self, *args, timeout=None, stderr=STDOUT, env=None):
+        """Run a git command inside the repo and return its exit code and output as bytes
+
+        With stderr=PIPE the output is stdout, or stderr if git fails. See _capture
+        """
+        returncode, output, errors = self._spawn(args, stderr, timeout, env)
+        if stderr == PIPE and returncode != 0:
+            output = errors
+        return returncode, output
+
+    def _spawn(self, args, stderr, timeout, env=None):
+        """Run git with args and report the process to INSTRUMENTATION"""
+        from subprocess import TimeoutExpired
+        from .instrument import TimedPopen, INSTRUMENTATION
+        command = self._git(*args)
+        started = time.monotonic()
+        try:
+            process = TimedPopen(command, cwd=self.dir, stdin=PIPE, stdout=PIPE, stderr=stderr,
+                                 env=git_environment(env, self.dir))
+        except OSError:
+            if os.path.isdir(self.dir):
+                raise
+            return 128, b"" if stderr == PIPE else self._moved_message(), self._moved_message()
+        try:
+            output, errors = process.communicate(timeout=timeout)
+        except TimeoutExpired:
+            kill_process(process)
+            process.communicate()
+            INSTRUMENTATION.process_finished(command, self.dir, started, process.returncode,
+                                             cpu=process.cpu_time(), repo=self.name)
+            raise
+        INSTRUMENTATION.process_finished(command, self.dir, started, process.returncode, output, errors,
+                                         cpu=process.cpu_time(), repo=self.name)
+        return process.returncode, output, errors or b""
+
+    def _execute(self, *args, timeout=None):
+        """Run a git command inside the repo and return its output"""
+        return str(self._run(*args, timeout=timeout)[1].decode("utf-8"))
+
+    def fetch(self, timeout=None):
+        """git fetch
+
+        Returns True if the fetch succeeded. Successful fetches are recorded by FETCH_SCHEDULER
+        """
+        returncode, _ = self._run("fetch", timeout=timeout)
+        if returncode == 0:
+            FETCH_SCHEDULER.record(self)
+        return returncode == 0
+
+    def status(self, timeout=None, fetch=True, force_fetch=False, structured=False, cache=False):
+        """git status
+
+        Fetches first unless the last successful fetch is younger than FETCH_SCHEDULER.ttl.
+        Pass force_fetch to fetch regardless, or fetch=False to only read local state.
+        timeout applies to the fetch and the status together.
+
+        Returns the text output of git status, or a RepoStatus if structured is True.
+        With cache=True structured statuses come from STATUS_CACHE while the index, HEAD
+        and refs are unchanged. Edits to the working tree do not show until they are staged
+        """
+        start = time.monotonic()
+        if fetch:
+            FETCH_SCHEDULER.fetch(self, force=force_fetch, timeout=timeout)
+        if timeout is not None:
+            timeout = max(timeout - (time.monotonic() - start), 0)
+        scope = self.scope()
+        if not structured:
+            return self._execute(*self.status_arguments(scope, porcelain=False), timeout=timeout)
+
+        if cache:
+            status = STATUS_CACHE.get(self, scope=scope)
+            if status is not None:
+                return status
+
+        started = time.monotonic()
+        returncode, output = self._run(*self.status_arguments(scope), timeout=timeout, stderr=PIPE)
+        if returncode != 0:
+            return RepoStatus(error=output.decode("utf-8", "replace"))
+        status = parse_porcelain_status(output)
+        if cache:
+            # git status may refresh the index, so fingerprint the state it left behind
+            STATUS_CACHE.put(self, status, status_fingerprint(self.dir), cost=time.monotonic() - started, scope=scope)
         else:
-            process = Popen("git status", shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
-        output, _ = process.communicate()
-        return str(output.decode("utf-8"))
+            STATUS_CACHE.record(self, status, cost=time.monotonic() - started)
+        return status
+
+    def scope(self):
+        """Return the status scope stored for the repo in the index, see set_scope"""
+        return get_registry().get_scope(self.dir)
+
+    def status_arguments(self, scope=None, porcelain=True):
+        """Return the git arguments reading the status of the repo within scope, by default its stored scope"""
+        if scope is None:
+            scope = self.scope()
+        arguments = ["status"]
+        if porcelain:
+            arguments += ["--porcelain=v2", "--branch", "-z"]
+        if scope.get("untracked"):
+            arguments.append("--untracked-files={}".format(scope["untracked"]))
+        paths = scope.get("paths") or (sparse_pathspecs(self.dir) if scope.get("sparse") else None)
+        if paths:
+            arguments += ["--"] + list(paths)
+        return arguments
 
     def stage_file(self, file_name):
         """git add file"""
-        stage_file = 'git add {}'.format(file_name)
-        if self.git_exec:
-            process = Popen([self.git_exec, stage_file], stdin=PIPE, stdout=PIPE, stderr=STDOUT,)
-        else:
-            process = Popen(stage_file, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT,)
-        output, _ = process.communicate()
-        return str(output.decode("utf-8"))
+        return self._execute("add", file_name)
 
     def stage_all(self, files="."):
         """git add all"""
-        files = "` ".join(files.split())
-        stage_file = 'git add {}'.format(files)
-        if self.git_exec:
-            process = Popen([self.git_exec, stage_file], stdin=PIPE, stdout=PIPE, stderr=STDOUT,)
-        else:
-            process = Popen(stage_file, shell=True, stdin=PIPE, stdout=PIPE, stderr=STDOUT,)
-        output, _ = process.communicate()
-        return str(output.decode("utf-8"))
-
-    def commit(self):
-        """git commit"""
-        enter = input("Commit message.\nPress enter to use 'minor changes'")
-        if enter == "":
-            message = self.message
-        else:
-            message = enter
-        # message = "` ".join(message.split())
-        if self.git_exec:
-            process = Popen([self.git_exec, 'git', ' commit ', '-m ', message], stdin=PIPE, stdout=PIPE, stderr=PIPE,)
-        else:
-            process = Popen(['git', ' commit', ' -m ', message], shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE,)
-        output, _ = process.communicate()
-        return str(output.decode("utf-8"))
+        return self._execute("add", *files.split())
+
+    def commit(self, message=None):
+        """git commit
 
-    def stage_and_commit(self):
+        Asks for a message unless one is given. Pressing enter uses self.message
+        """
+        if message is None:
+            message = input("Commit message.\nPress enter to use 'minor changes'") or self.message
+        return str(self._run("commit", "-m", message, stderr=PIPE)[1].decode("utf-8"))
+
+    def stage_and_commit(self, message=None):
         """git add followed by commit"""
         self.stage_all()
-        self.commit()
+        return self.commit(message)
+
+    def has_staged_changes(self):
+        """Return True if the index differs from HEAD, i.e. a commit would not be empty"""
+        returncode, _, errors = self._capture("diff", "--cached", "--quiet")
+        if returncode > 1:
+            raise Exception("Could not read the index of {}: {}".format(self.name, errors.decode("utf-8", "replace")))
+        return returncode == 1
 
     def push(self):
         """git push"""
-        if self.git_exec:
-            process = Popen([self.git_exec, ' git push'], stdin=PIPE, stdout=PIPE, stderr=STDOUT,)
-        else:
-            process = Popen(['git push'], shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE,)
-        output, _ = process.communicate()
-        return str("Push completed.{}".format(str(output.decode("utf-8"))))
+        return str("Push completed.{}".format(self._execute("push")))
 
     def pull(self):
         """git pull"""
-        if self.git_exec:
-            process = Popen([self.git_exec, ' git pull'], stdin=PIPE, stdout=PIPE, stderr=STDOUT,)
-        else:
-            process = Popen(['git pull'], shell=True, stdin=PIPE, stdout=PIPE, stderr=PIPE,)
-        output, _ = process.communicate()
-        return str("Pull completed.\n{}".format(str(output.decode("utf-8"))))
+        return str("Pull completed.\n{}".format(self._execute("pull")))
 
     def reset(self, number='1'):
         """git reset"""
-        if self.git_exec:
-            process = Popen([self.git_exec, ' git reset HEAD~', number], stdin=PIPE, stdout=PIPE, stderr=STDOUT,)
-        else:
-            process = Popen(['git reset HEAD~', number], stdin=PIPE, stdout=PIPE, stderr=STDOUT,)
-        output, _ = process.communicate()
-        return str(output.decode("utf-8"))
+        return self._execute("reset", "HEAD~{}".format(number))
+
+    def rev_parse(self, name):
+        """Return the SHA that name resolves to, None if it does not resolve
+
+        Uses the repo's persistent cat-file process when BATCH_BACKEND is on
+        """
+        if BATCH_BACKEND:
+            from .catfile import get_catfile
+            info = get_catfile(self.dir, self.git_exec).info(name)
+            return info[0] if info else None
+        # _capture rather than _run, which AsyncCommands turns into a coroutine
+        returncode, output, _ = self._capture("rev-parse", "--verify", "--quiet", name)
+        return output.decode("utf-8").strip() if returncode == 0 else None
+
+    def head_commit(self):
+        """Return the SHA of HEAD, None before the first commit"""
+        return self.rev_parse("HEAD")
+
+    def upstream_commit(self):
+        """Return the SHA of the remote-tracking branch of HEAD, None if there is none"""
+        return self.rev_parse("HEAD@{upstream}")
+
+    def refs(self, prefix="refs/"):
+        """Return a dict mapping ref names starting with prefix to their SHAs"""
+        if BATCH_BACKEND:
+            from .catfile import get_catfile
+            return get_catfile(self.dir, self.git_exec).refs(str(common_git_dir(self.dir)), prefix)
+        _, output, _ = self._capture("for-each-ref", "--format=%(objectname) %(refname)", prefix)
+        return {refname: sha for sha, _, refname in
+                (line.partition(" ") for line in output.decode("utf-8", "replace").splitlines())}
+
+    def tracking(self):
+        """Return {branch: (upstream ref, ahead, behind)} for every local branch with an upstream
+
+        Read straight from the refs, packs and commit-graph of the repo without running git.
+        Nothing is fetched, so the counts are against the last fetched state of the remote
+        """
+        from .graph import tracking
+        return tracking(self.dir)
 
     # def branch(self):
     #     """Return the branch being tracked by local"""
@@ -444,108 +891,1182 @@ class Commands:
     #     branch_name = re.search(r"\[origin\/(.*)\]", line)
     #     return branch_name.group(1)
 
+class FetchScheduler:
+    """Decides when repos need to be fetched
+
+    Remembers the time of the last successful fetch of each repo and only fetches again
+    once ttl seconds have passed. Fetches made in earlier sessions are taken from the
+    modification time of FETCH_HEAD.
+
+    Parameters
+    -----------
+    ttl : float
+        Seconds during which a successful fetch is considered fresh
+    workers : int
+        Number of repos fetched at the same time by fetch_many() and prefetch()
+    """
+
+    def __init__(self, ttl=FETCH_TTL, workers=STATUS_WORKERS):
+        self.ttl = ttl
+        self.workers = workers
+        self._last_fetch = {} # repo directory -> time of last successful fetch
+        self._pending = {} # repo directory -> future of a fetch in progress
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def record(self, repo, when=None):
+        """Record a successful fetch of repo"""
+        with self._lock:
+            self._last_fetch[repo.dir] = time.time() if when is None else when
+
+    def forget(self, repo=None):
+        """Forget the fetch time of repo, or of every repo, so the next request fetches"""
+        with self._lock:
+            if repo is None:
+                self._last_fetch.clear()
+            else:
+                self._last_fetch.pop(repo.dir, None)
+
+    def last_fetch(self, repo):
+        """Return the time of the last successful fetch of repo or None if unknown"""
+        with self._lock:
+            if repo.dir in self._last_fetch:
+                return self._last_fetch[repo.dir]
+        try:
+            when = (common_git_dir(repo.dir) / "FETCH_HEAD").stat().st_mtime
+        except OSError:
+            return None
+        self.record(repo, when)
+        return when
+
+    def is_fresh(self, repo):
+        """Return True if repo was fetched successfully less than ttl seconds ago"""
+        when = self.last_fetch(repo)
+        return when is not None and time.time() - when < self.ttl
+
+    def fetch(self, repo, force=False, timeout=None):
+        """Fetch repo if its last fetch is stale or force is True
+
+        Waits for a background fetch of the same repo instead of starting another one.
+        Returns True if a fetch was made and succeeded
+        """
+        with self._lock:
+            pending = self._pending.get(repo.dir)
+        if pending is not None:
+            pending.result()
+        return self._fetch_if_stale(repo, force, timeout)
+
+    def _fetch_if_stale(self, repo, force, timeout):
+        if not force and self.is_fresh(repo):
+            return False
+        return repo.fetch(timeout=timeout)
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = _thread_pool(self.workers)
+            return self._executor
+
+    def _background_fetch(self, repo, force, timeout):
+        from subprocess import TimeoutExpired
+        try:
+            return self._fetch_if_stale(repo, force, timeout)
+        except TimeoutExpired:
+            return False
+        finally:
+            with self._lock:
+                self._pending.pop(repo.dir, None)
+
+    def prefetch(self, repos, force=False, timeout=None):
+        """Start fetching repos in the background and return a list of futures
+
+        status() calls on a repo being prefetched wait for that fetch to finish
+        """
+        executor = self._get_executor()
+        futures = []
+        for repo in repos:
+            with self._lock:
+                future = self._pending.get(repo.dir)
+                if future is None:
+                    future = executor.submit(self._background_fetch, repo, force, timeout)
+                    self._pending[repo.dir] = future
+            futures.append(future)
+        return futures
+
+    def fetch_many(self, repos, force=False, timeout=None):
+        """Fetch repos that need it in parallel and wait for them to finish"""
+        return [future.result() for future in self.prefetch(repos, force=force, timeout=timeout)]
+
+
+FETCH_SCHEDULER = FetchScheduler()
+
+
+TRANSIENT_ERRORS = (
+    "could not resolve host", "temporary failure in name resolution", "connection timed out",
+    "connection reset", "connection refused", "operation timed out", "network is unreachable",
+    "the remote end hung up unexpectedly", "early eof", "rpc failed", "unexpected disconnect",
+    "ssh: connect to host", "http 5", "returned error: 5", "remote: internal server error",
+)
+
+_UPDATED_REF = r"^ ([ +*!t-]) +(?:\S+\.\.\.?\S+|\[[^\]]+\]) +\S+ +-> +(\S+)"
+
+
+def updated_refs(output):
+    """Return the refs that git fetch, pull or push reports as changed, rejected ones excluded"""
+    import re
+    return [ref for flag, ref in re.findall(_UPDATED_REF, output, re.MULTILINE) if flag != "!"]
+
+
+def is_transient_error(output):
+    """Return True if git output looks like a network failure worth retrying"""
+    output = output.lower()
+    return any(error in output for error in TRANSIENT_ERRORS)
+
+
+def default_remote(directory, config=None):
+    """Return the name of the remote git fetch uses in directory: that of the checked out branch, then origin"""
+    from . import graph
+    if config is None:
+        config = graph.read_config(str(common_git_dir(directory)))
+    branch = graph.head_branch(str(git_dir(directory))) or ""
+    settings = config.get(("branch", branch[len("refs/heads/"):]), {})
+    return settings.get("remote", ["origin"])[-1]
+
+
+def remote_url(directory, remote=None):
+    """Return the URL of the remote of the repo in directory, None if there is no remote
+
+    remote defaults to default_remote()
+    """
+    from . import graph
+    config = graph.read_config(str(common_git_dir(directory)))
+    if remote is None:
+        remote = default_remote(directory, config)
+    return config.get(("remote", remote), {}).get("url", [None])[-1]
+
+
+def remote_host(directory, remote=None):
+    """Return the host name of the remote of the repo in directory
+
+    remote defaults to the remote of the checked out branch, then origin.
+    Remotes on the local file system are reported as "local", None if there is no remote
+    """
+    import re
+    url = remote_url(directory, remote)
+    if not url:
+        return None
+    match = re.match(r"^[a-z][a-z0-9+.-]*://(?:[^@/]*@)?(\[[^\]]+\]|[^:/]+)", url, re.IGNORECASE)
+    if match:
+        return "local" if url.lower().startswith("file:") else match.group(1).lower()
+    match = re.match(r"^(?:[^@/]+@)?([^:/]+):", url) # scp-like user@host:path
+    if match and not os.path.exists(url):
+        return match.group(1).lower()
+    return "local"
+
+
+class OperationResult:
+    """Outcome of a pull, push or fetch run by FanOut, or of a commit
+
+    Attributes
+    -----------
+    name : str
+        Repo name
+    operation : str
+        pull, push, fetch or commit
+    returncode : int
+        Exit code of the last attempt, None if it timed out
+    duration : float
+        Seconds spent on the operation, retries and waits included
+    stdout, stderr : str
+        Output of the last attempt
+    refs_updated : list
+        Refs reported as changed, e.g. origin/master
+    attempts : int
+        Number of times git was run
+    host : str
+        Remote host the operation was counted against
+    skipped : bool
+        True if there was nothing to do and git was not run, e.g. a commit with nothing staged
+    """
+
+    __slots__ = ('name', 'operation', 'returncode', 'duration', 'stdout', 'stderr',
+                 'refs_updated', 'attempts', 'host', 'skipped')
+
+    def __init__(self, name, operation, returncode=None, duration=0.0, stdout="", stderr="",
+                 refs_updated=None, attempts=0, host=None, skipped=False):
+        self.name = name
+        self.operation = operation
+        self.returncode = returncode
+        self.duration = duration
+        self.stdout = stdout
+        self.stderr = stderr
+        self.refs_updated = refs_updated or []
+        self.attempts = attempts
+        self.host = host
+        self.skipped = skipped
+
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    def __repr__(self):
+        return "OperationResult({!r}, {!r}, returncode={!r}, attempts={}, duration={:.2f})".format(
+            self.name, self.operation, self.returncode, self.attempts, self.duration)
+
+    def __str__(self):
+        output = self.stdout + self.stderr
+        if self.skipped:
+            return "{} skipped.\n{}".format(self.operation.capitalize(), output)
+        if self.ok:
+            return "{} completed.\n{}".format(self.operation.capitalize(), output)
+        if self.returncode is None:
+            return "{} timed out after {} attempt(s).\n{}".format(self.operation.capitalize(), self.attempts, output)
+        return "{} failed with exit code {} after {} attempt(s).\n{}".format(
+            self.operation.capitalize(), self.returncode, self.attempts, output)
+
+    def as_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class FanOut:
+    """Runs pull, push or fetch on many repos in parallel
+
+    Parameters
+    -----------
+    workers : int
+        Number of repos handled at the same time
+    per_host : int
+        Maximum number of operations running against the same remote host
+    retries : int
+        Times an operation is retried after a transient network error or a timeout
+    backoff : float
+        Seconds before the first retry, doubled for every further retry
+    timeout : float
+        Seconds each attempt may take before git is killed, None to wait forever
+    """
+
+    OPERATIONS = ('pull', 'push', 'fetch')
+
+    def __init__(self, workers=STATUS_WORKERS, per_host=HOST_CONCURRENCY, retries=NETWORK_RETRIES,
+                 backoff=RETRY_BACKOFF, timeout=None):
+        self.workers = workers
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host_semaphore(self, host):
+        with self._lock:
+            semaphore = self._hosts.get(host)
+            if semaphore is None:
+                semaphore = self._hosts[host] = threading.BoundedSemaphore(max(1, self.per_host))
+            return semaphore
+
+    def run_one(self, repo, operation, *args):
+        """Run git operation with args on repo, retrying transient failures, and return an OperationResult"""
+        from subprocess import TimeoutExpired
+        if operation not in self.OPERATIONS:
+            raise Exception("Unsupported operation {}".format(operation))
+        start = time.monotonic()
+        try:
+            host = remote_host(repo.dir)
+        except OSError:
+            host = None
+        result = OperationResult(repo.name, operation, host=host)
+        semaphore = self._host_semaphore(host)
+
+        while True:
+            result.attempts += 1
+            with semaphore:
+                try:
+                    returncode, output, errors = repo._capture(operation, *args, timeout=self.timeout)
+                    result.returncode = returncode
+                    result.stdout = output.decode("utf-8", "replace")
+                    result.stderr = errors.decode("utf-8", "replace")
+                except TimeoutExpired:
+                    result.returncode = None
+                    result.stdout = ""
+                    result.stderr = "git did not finish within {} seconds".format(self.timeout)
+            transient = result.returncode is None or (
+                result.returncode != 0 and is_transient_error(result.stderr))
+            if not transient or result.attempts > self.retries:
+                break
+            time.sleep(self.backoff * 2 ** (result.attempts - 1)) # the host slot is free while waiting
+
+        if result.ok:
+            result.refs_updated = updated_refs(result.stderr + result.stdout)
+            if operation in ('fetch', 'pull'):
+                FETCH_SCHEDULER.record(repo)
+        result.duration = time.monotonic() - start
+        return result
+
+    def run(self, repos, operation, *args):
+        """Run operation on every repo in parallel and return their OperationResults in order"""
+        repos = list(repos)
+        with _thread_pool(self.workers) as executor:
+            return list(executor.map(lambda repo: self.run_one(repo, operation, *args), repos))
+
+
+def _stat_tree(directory, fingerprint):
+    """Add (path, mtime, size) of every file below directory to fingerprint"""
+    try:
+        entries = list(os.scandir(str(directory)))
+    except OSError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            _stat_tree(entry.path, fingerprint)
+        else:
+            try:
+                info = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            fingerprint.append((entry.path, info.st_mtime_ns, info.st_size))
+
+
+def status_fingerprint(directory):
+    """Return a cheap fingerprint of the state git status reports on
+
+    Built from the modification times and sizes of the index, HEAD, packed-refs and
+    the branch and remote-tracking refs. Edits to tracked files that have not been
+    staged do not change it.
+    """
+    gdir, common = git_dir(directory), common_git_dir(directory)
+    fingerprint = []
+    for path in (gdir / 'index', gdir / 'HEAD', common / 'packed-refs'):
+        try:
+            info = path.stat()
+        except OSError:
+            fingerprint.append((str(path), None, None))
+            continue
+        fingerprint.append((str(path), info.st_mtime_ns, info.st_size))
+    _stat_tree(common / 'refs' / 'heads', fingerprint)
+    _stat_tree(common / 'refs' / 'remotes', fingerprint)
+    return tuple(fingerprint)
+
+
+UNTRACKED_MODES = ("all", "normal", "no")
+
+
+def sparse_pathspecs(directory):
+    """Return pathspecs covering the cone of a cone mode sparse checkout, None if the repo is not one"""
+    from . import graph
+    core = dict(graph.read_config(str(common_git_dir(directory))).get(("core", None), {}))
+    # git sparse-checkout writes its settings to the worktree's own config
+    core.update(graph.read_config(str(git_dir(directory)), "config.worktree").get(("core", None), {}))
+    if core.get("sparsecheckout", ["false"])[-1].lower() != "true" or \
+            core.get("sparsecheckoutcone", ["true"])[-1].lower() != "true":
+        return None
+    try:
+        with open(str(git_dir(directory) / "info" / "sparse-checkout")) as f:
+            lines = [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    except OSError:
+        return None
+    excluded = {line[2:-3] for line in lines if line.startswith("!/") and line.endswith("/*/")}
+    pathspecs = [":(glob)*"] # files at the top are always checked out
+    for line in lines:
+        if line.startswith("/") and line.endswith("/") and line != "/":
+            folder = line.strip("/")
+            # parents of the cone only have their own files checked out
+            pathspecs.append(":(glob){}/*".format(folder) if folder in excluded else folder)
+    return pathspecs
+
+
+class StatusCache:
+    """Persistent store of the last structured status of each indexed repo
+
+    Entries are kept in the registry together with the status_fingerprint() of the repo
+    they were read from, and are only returned while the fingerprint matches. When
+    more than max_entries repos have a cached status the least recently used are evicted.
+
+    Parameters
+    -----------
+    max_entries : int
+        Maximum number of repos kept
+    max_age : float
+        Seconds after which an entry is ignored even if the fingerprint matches, None to keep it
+    """
+
+    def __init__(self, max_entries=STATUS_CACHE_SIZE, max_age=None):
+        self.max_entries = max_entries
+        self.max_age = max_age
+
+    @staticmethod
+    def _key(repo, fingerprint, scope):
+        """Return the stored form of a fingerprint. Statuses read within a scope only match that scope"""
+        import json
+        if fingerprint is None:
+            fingerprint = status_fingerprint(repo.dir)
+        if scope is None:
+            scope = repo.scope()
+        if scope:
+            fingerprint = tuple(fingerprint) + (("scope", scope),)
+        return json.dumps(fingerprint, sort_keys=True)
+
+    def get(self, repo, fingerprint=None, scope=None):
+        """Return the cached RepoStatus of repo, or None if it is missing or out of date
+
+        scope is the status scope of repo, read from the index if not given
+        """
+        registry = get_registry()
+        entry = registry.get_status(repo.dir)
+        if entry is None:
+            return None
+        stored_fingerprint, data, created = entry
+        if stored_fingerprint != self._key(repo, fingerprint, scope):
+            return None
+        now = time.time()
+        if self.max_age is not None and now - created > self.max_age:
+            return None
+        registry.touch_status(repo.dir, now)
+        return RepoStatus.from_dict(data)
+
+    def put(self, repo, status, fingerprint=None, cost=None, scope=None):
+        """Store the RepoStatus of repo. Statuses carrying an error are not stored
+
+        cost is the number of seconds reading the status took, all_status schedules costly repos first.
+        scope is the status scope the status was read within, read from the index if not given
+        """
+        if status.error:
+            return
+        data = status.as_dict()
+        data['text'] = None
+        registry = get_registry()
+        registry.put_status(repo.dir, self._key(repo, fingerprint, scope), data, time.time(), cost)
+        registry.evict_statuses(self.max_entries)
+
+    def record(self, repo, status, cost=None):
+        """Store the RepoStatus of repo without a fingerprint, so it is never returned by get()
+
+        Used when the cache is off: the status: terms of queries and the cost schedule of
+        all_status still need the last status and its cost, but the repo's refs are not walked
+        """
+        if status.error:
+            return
+        data = status.as_dict()
+        data['text'] = None
+        get_registry().put_status(repo.dir, None, data, time.time(), cost)
+
+    def invalidate(self, repo=None):
+        """Drop the cached status of repo, or of every repo"""
+        get_registry().clear_status(None if repo is None else repo.dir)
+
+
+STATUS_CACHE = StatusCache()
+
+
 def repos():
     """Show all available repositories, path, and unique ID"""
     print("\nThe following repos are available.\n")
-    NAME_SHELF = shelve.open(str(PurePath(SHELF_DIR / "NAME_SHELF")))
-    INDEX_SHELF = shelve.open(str(PurePath(SHELF_DIR / "INDEX_SHELF")))
+    _print_index(get_registry())
 
-    print("{:<4} {:<20} {:<}".format("Key", "| Name", "| Path"))
-    print("******************************************")
-    for key in INDEX_SHELF.keys():
-        name = INDEX_SHELF[key]
-        print("{:<4} {:<20} {:<}".format(key, name, str(NAME_SHELF[name])))
-    INDEX_SHELF.close()
-    NAME_SHELF.close()
 
-
-def load(input_string): # id is string
-    """Load a repository with specified id"""
-    NAME_SHELF = shelve.open(str(PurePath(SHELF_DIR / "NAME_SHELF")))
-    INDEX_SHELF = shelve.open(str(PurePath(SHELF_DIR / "INDEX_SHELF")))
+def _load_row(input_string):
+    """Return the index row of the repo with the given id or name"""
+    registry = get_registry()
     input_string = str(input_string)
 
     try:
         int(input_string) # if not coercible into an integer, then its probably a repo name rather than ID
-        try:
-            name = INDEX_SHELF[input_string]
-            return Commands(name, str(NAME_SHELF[name]))
-        except KeyError:
+        row = registry.get(input_string)
+        if row is None:
             raise Exception("That index does not exist.")
     except ValueError:
-        try:
-            return Commands(input_string, NAME_SHELF[input_string])
-        except KeyError:
+        row = registry.get_by_name(input_string)
+        if row is None:
             raise Exception("That repository name does not exist or is not indexed")
-    INDEX_SHELF.close()
-    NAME_SHELF.close()
+    return row
+
+
+def load(input_string): # id is string
+    """Load a repository with specified id"""
+    row = _load_row(input_string)
+    return Commands(row['name'], row['path'])
 
 
-def load_multiple(*args, _all=False):
+def last_change(directory):
+    """Return the time HEAD, the index or a branch or remote-tracking ref of a repo last changed
+
+    None if the repo cannot be read
+    """
+    try:
+        times = [mtime for _, mtime, _ in status_fingerprint(directory) if mtime is not None]
+    except OSError:
+        return None
+    return max(times) / 1e9 if times else None
+
+
+def load_multiple(*args, _all=False, query=None):
     """Create `commands` object for a set of repositories
 
     Parameters
     ------------
     args : int
         comma-separated string values
+    query : str
+        Only yield the repos selected by this query, e.g. "group:payments status:dirty".
+        Without args it selects from every indexed repo. See pygit.query for the syntax
 
     Yields
     ---------
     A list of commands objects. One for each of the entered string
     """
 
-    if _all:
-        NAME_SHELF = shelve.open(str(PurePath(SHELF_DIR / "NAME_SHELF")))
-        for key in NAME_SHELF.keys():
-            yield load(key)
+    if query is not None:
+        from .query import Query
+        if not isinstance(query, Query):
+            query = Query(query)
+        rows = get_registry().repos() if _all or not args else [_load_row(arg) for arg in args]
+        for row in rows:
+            if query.matches(row, last_change):
+                yield Commands(row['name'], row['path'])
+    elif _all:
+        for row in get_registry().repos(): # always yield repos in index order
+            yield Commands(row['name'], row['path'])
     else:
         for arg in args:
             yield load(arg)
 
 
-def pull(*args, _all=False):
-    for each in load_multiple(*args, _all=_all):
-        s = "*** {} ***\n{}".format(each.name, each.pull())
-        print(s)
+def _check_tag(tag):
+    tag = str(tag).strip()
+    if not tag or "," in tag or any(character.isspace() for character in tag):
+        raise Exception("Invalid name {!r}. Tags and groups cannot be empty or contain commas or spaces".format(tag))
+    return tag
 
 
-def push(*args, _all=False):
-    for each in load_multiple(*args, _all=_all):
-        s = "*** {} ***\n{}".format(each.name, each.push())
-        print(s)
+def tag(input_string, *tags):
+    """Add tags to the repo with the given id or name and return all of its tags"""
+    registry = get_registry()
+    repo_id = _load_row(input_string)['id']
+    tags = set(registry.get_tags(repo_id)) | {_check_tag(each) for each in tags}
+    registry.set_tags(repo_id, tags)
+    return sorted(tags)
 
 
-def all_status():
-    """Write status of all repositories to file in markdown format"""
-    print("Getting repo status.\n\nYou may be prompted for credentials...")
+def untag(input_string, *tags):
+    """Remove tags from the repo with the given id or name and return the tags left"""
+    registry = get_registry()
+    repo_id = _load_row(input_string)['id']
+    tags = set(registry.get_tags(repo_id)) - {str(each).strip() for each in tags}
+    registry.set_tags(repo_id, tags)
+    return sorted(tags)
+
+
+def set_group(input_string, group):
+    """Put the repo with the given id or name in group. None takes it out of its group"""
+    if group is not None:
+        group = _check_tag(group)
+    registry = get_registry()
+    registry.set_group(_load_row(input_string)['id'], group)
+
+
+def groups():
+    """Return {group: number of repos in it}"""
+    return get_registry().groups()
+
+
+def _set_config(repo, key, value):
+    if value is None:
+        returncode, _, errors = repo._capture("config", "--unset", key)
+        returncode = 0 if returncode == 5 else returncode # 5: it was not set
+    else:
+        returncode, _, errors = repo._capture("config", key, value)
+    if returncode != 0:
+        raise Exception("Could not set {} in {}: {}".format(key, repo.name, errors.decode("utf-8", "replace")))
+
 
-    os.chdir(STATUS_DIR)
-    attention = ""
-    messages = []
-    TIME_STAMP = datetime.now().strftime("%a_%d_%b_%Y_%H_%M_%S_%p")
+def set_scope(input_string, paths=None, untracked=None, sparse=False, fsmonitor=None, untracked_cache=None):
+    """Limit the status of the repo with the given id or name and return its new scope
 
-    fname = "REPO_STATUS_@_{}.md".format(TIME_STAMP)
-    with open(fname, 'w+') as f:
-        f.write("# Repository status as at {}\n\n".format(TIME_STAMP))
-        
-        for each in load_multiple(_all=True):
-            name = each.name
-            status = each.status()
+    Parameters
+    -----------
+    paths : list
+        Pathspecs status is limited to. None for the whole working tree
+    untracked : str
+        "no" to skip looking for untracked files, "normal" or "all" as in git status --untracked-files
+    sparse : bool
+        Limit status to the cone of a cone mode sparse checkout when no paths are given
+    fsmonitor : bool
+        Turn git's built-in file system monitor on or off for the repo, None leaves it as it is
+    untracked_cache : bool
+        Turn the untracked cache on or off for the repo, None leaves it as it is
+
+    The scope is stored in the index, fsmonitor and untracked_cache are written to the repo's config.
+    Cached statuses only match the scope they were read within
+    """
+    if untracked is not None and untracked not in UNTRACKED_MODES:
+        raise Exception("Unknown untracked mode {}. Use one of {}".format(untracked, ", ".join(UNTRACKED_MODES)))
+    row = _load_row(input_string)
+    repo = Commands(row['name'], row['path'])
+    if fsmonitor:
+        returncode, _, errors = repo._capture("fsmonitor--daemon", "status")
+        if b"not supported" in errors or b"is not a git command" in errors:
+            raise Exception("git's built-in fsmonitor is not available on this system")
+    if fsmonitor is not None:
+        _set_config(repo, "core.fsmonitor", "true" if fsmonitor else None)
+    if untracked_cache is not None:
+        _set_config(repo, "core.untrackedCache", "true" if untracked_cache else "false")
+        repo._capture("update-index", "--untracked-cache" if untracked_cache else "--no-untracked-cache")
+
+    scope = repo.scope()
+    for key in ("paths", "untracked", "sparse"):
+        scope.pop(key, None)
+    if paths:
+        scope["paths"] = [paths] if isinstance(paths, str) else list(paths)
+    if untracked is not None:
+        scope["untracked"] = untracked
+    if sparse:
+        scope["sparse"] = True
+    for key, value in (("fsmonitor", fsmonitor), ("untracked_cache", untracked_cache)):
+        if value is not None:
+            scope[key] = bool(value)
+    get_registry().set_scope(row['id'], scope)
+    return scope
+
+
+def get_scope(input_string):
+    """Return the status scope of the repo with the given id or name"""
+    return get_registry().get_scope(_load_row(input_string)['path'])
+
+
+def select_repos(*args, tags=None, _all=False):
+    """Yield a Commands object for each repo given by id or name and each repo with one of tags
+
+    Repos are yielded once, those given by id or name first
+    """
+    if _all:
+        yield from load_multiple(_all=True)
+        return
+    seen = set()
+    for each in load_multiple(*args):
+        if each.dir not in seen:
+            seen.add(each.dir)
+            yield each
+    if isinstance(tags, str):
+        tags = [tags]
+    registry = get_registry()
+    for each in tags or ():
+        for row in registry.tagged(each):
+            if row['path'] not in seen:
+                seen.add(row['path'])
+                yield Commands(row['name'], row['path'])
+
+
+def plan_fetches(repositories, workers=STATUS_WORKERS, timeout=None):
+    """Return the repos among repositories that need a fetch, see pygit.fetchplan
+
+    Repos whose remote has not moved are recorded as fetched by FETCH_SCHEDULER
+    """
+    from .fetchplan import plan_fetch
+    plan = plan_fetch(repositories, workers=workers, timeout=timeout)
+    for repo in plan.unchanged:
+        FETCH_SCHEDULER.record(repo)
+    return plan
+
+
+def _fan_out(operation, args, _all, query, workers, timeout, retries, plan=False):
+    from .ssh import Multiplexer
+    from .instrument import INSTRUMENTATION
+    repositories = list(load_multiple(*args, _all=_all, query=query))
+    with INSTRUMENTATION.scope() as usage, Multiplexer(repositories, SSH_MULTIPLEX):
+        unchanged = set()
+        if plan:
+            unchanged = {repo.dir for repo in plan_fetches(repositories, workers, timeout).unchanged}
+        done = iter(FanOut(workers=workers, retries=retries, timeout=timeout).run(
+            [repo for repo in repositories if repo.dir not in unchanged], operation))
+        results = [OperationResult(repo.name, operation, 0, stdout="Remote refs unchanged", skipped=True)
+                   if repo.dir in unchanged else next(done) for repo in repositories]
+    for result in results:
+        print("*** {} ***\n{}".format(result.name, result))
+    if PRINT_SUMMARY:
+        print(usage.format_summary())
+    return results
+
+
+def pull(*args, _all=False, query=None, workers=STATUS_WORKERS, timeout=None, retries=NETWORK_RETRIES):
+    """Pull a set of repos in parallel and return an OperationResult for each, in order
+
+    query selects repos as in load_multiple. See FanOut for the meaning of workers, timeout and retries
+    """
+    return _fan_out("pull", args, _all, query, workers, timeout, retries)
 
-            messages.append("## {}\n\n```cmd\n{}```\n".format(name, status))
 
-            if need_attention(status):
-                attention += "1. {}\n".format(name)
+def push(*args, _all=False, query=None, workers=STATUS_WORKERS, timeout=None, retries=NETWORK_RETRIES):
+    """Push a set of repos in parallel and return an OperationResult for each, in order"""
+    return _fan_out("push", args, _all, query, workers, timeout, retries)
 
-        f.write("## REPOS NEEDING ATTENTION\n\n")
-        f.write(attention)
-        f.write("\n-------\n\n")
-        f.write("## STATUS MESSAGES\n\n")
-        f.write("\n".join(messages))
+
+def fetch(*args, _all=False, query=None, workers=STATUS_WORKERS, timeout=None, retries=NETWORK_RETRIES,
+          plan=FETCH_PLAN):
+    """Fetch a set of repos in parallel and return an OperationResult for each, in order
+
+    With plan, the remotes are listed first and repos whose remote refs did not move are
+    not fetched. Their results have skipped set
+    """
+    return _fan_out("fetch", args, _all, query, workers, timeout, retries, plan)
+
+
+def _commit_one(repo, message, stage, skip_empty):
+    start = time.monotonic()
+    result = OperationResult(repo.name, "commit")
+    if callable(message):
+        message = message(repo)
+    if stage:
+        returncode, _, errors = repo._capture("add", "--all")
+        if returncode != 0:
+            result.returncode, result.stderr = returncode, errors.decode("utf-8", "replace")
+            result.attempts, result.duration = 1, time.monotonic() - start
+            return result
+    try:
+        empty = skip_empty and not repo.has_staged_changes()
+    except Exception as error:
+        result.returncode, result.stderr = 128, str(error)
+        empty = False
+    if empty:
+        result.returncode, result.skipped, result.stdout = 0, True, "Nothing to commit"
+    elif result.returncode is None:
+        returncode, output, errors = repo._capture("commit", "-m", message or repo.message)
+        result.returncode = returncode
+        result.stdout = output.decode("utf-8", "replace")
+        result.stderr = errors.decode("utf-8", "replace")
+        result.attempts = 1
+    result.duration = time.monotonic() - start
+    return result
+
+
+def commit(*args, message=None, tags=None, _all=False, stage=True, skip_empty=True, workers=STATUS_WORKERS):
+    """Stage and commit a set of repos in parallel without asking for messages
+
+    Parameters
+    -----------
+    args : str
+        IDs or names of the repos to commit
+    message : str or callable
+        Commit message, or a function called with the Commands object of each repo that
+        returns its message. Defaults to the message of each Commands object
+    tags : list
+        Also commit every repo carrying one of these tags
+    stage : bool
+        Run `git add --all` first. With False only what is already staged is committed
+    skip_empty : bool
+        Skip repos whose index matches HEAD instead of running a commit that would fail
+
+    Returns
+    --------
+    A list of OperationResult objects, one per repo, in order. Skipped repos have skipped set
+    """
+    from .instrument import INSTRUMENTATION
+    repositories = list(select_repos(*args, tags=tags, _all=_all))
+    with INSTRUMENTATION.scope() as usage, _thread_pool(workers) as executor:
+        results = list(executor.map(lambda repo: _commit_one(repo, message, stage, skip_empty), repositories))
+    for result in results:
+        print("*** {} ***\n{}".format(result.name, result))
+    if PRINT_SUMMARY:
+        print(usage.format_summary())
+    return results
+
+
+def all_tracking(*args, _all=True):
+    """Return {repo name: tracking} for the given repos, every indexed repo by default
+
+    tracking is the result of Commands.tracking(), or the error message if the repo
+    could not be read. No git processes are started
+    """
+    from .graph import UnsupportedRepository
+    result = {}
+    for each in load_multiple(*args, _all=_all and not args):
+        try:
+            result[each.name] = each.tracking()
+        except (OSError, KeyError, UnsupportedRepository) as error:
+            result[each.name] = "{} could not be read: {}".format(each.name, error)
+    return result
+
+
+def repo_status(repo, timeout=None, force_fetch=False, raw=False, cache=False):
+    """Return the RepoStatus of a Commands object
+
+    Problems reading the status, including timeouts, are reported in RepoStatus.error.
+    If raw is True the text output of git status is kept in RepoStatus.text
+    """
+    from subprocess import TimeoutExpired
+    start = time.monotonic()
+    try:
+        status = repo.status(timeout=timeout, force_fetch=force_fetch, structured=True, cache=cache)
+        if raw:
+            if timeout is not None:
+                timeout = max(timeout - (time.monotonic() - start), 0)
+            status.text = repo.status(timeout=timeout, fetch=False)
+    except TimeoutExpired:
+        return RepoStatus(error="git did not finish within {} seconds".format(timeout))
+    return status
+
+
+class StatusReport:
+    """Status file in STATUS_DIR written one repo at a time
+
+    Each repo is written as soon as it is added, so the report can be followed while
+    it grows and only the names of repos needing attention are kept in memory.
+    Markdown reports start with a placeholder where the attention list goes, which
+    is filled in by close(). JSON Lines reports hold one object per repo followed by
+    a summary object.
+
+    Parameters
+    ------------
+    report_format : str
+        "md" for markdown or "jsonl" for JSON Lines
+    history : History
+        Also record the statuses as a run of this status history. The ID of the run is
+        in run once the report is closed
+    """
+
+    FORMATS = ("md", "jsonl")
+    PLACEHOLDER = "_Report in progress..._\n"
+
+    def __init__(self, report_format="md", history=None):
+        if report_format not in self.FORMATS:
+            raise Exception("Unknown report format {}. Use one of {}".format(report_format, ", ".join(self.FORMATS)))
+        self.format = report_format
+        from datetime import datetime
+        self.time_stamp = datetime.now().strftime("%a_%d_%b_%Y_%H_%M_%S_%p")
+        self.path = STATUS_DIR / "REPO_STATUS_@_{}.{}".format(self.time_stamp, report_format)
+        self.attention = []
+        self.count = 0
+        self.run = None
+        self._recorder = None if history is None else history.recorder(self.path)
+        self._file = open(str(self.path), 'wb')
+        if self.format == "md":
+            self._file.write(self._header(self.PLACEHOLDER).encode("utf-8"))
+            self._body_start = self._file.tell()
+            self._file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _header(self, attention):
+        return "# Repository status as at {}\n\n## REPOS NEEDING ATTENTION\n\n{}\n-------\n\n## STATUS MESSAGES\n\n".format(
+            self.time_stamp, attention)
+
+    def add(self, name, status):
+        """Write the RepoStatus of the repo called name"""
+        import json
+        if need_attention(status):
+            self.attention.append(name)
+        if self.format == "md":
+            if self.count:
+                self._file.write(b"\n")
+            entry = "## {}\n\n```cmd\n{}```\n".format(name, status.text or status)
+        else:
+            entry = json.dumps({"name": name, "status": status.as_dict(),
+                                "need_attention": bool(need_attention(status))}) + "\n"
+        self._file.write(entry.encode("utf-8"))
+        self._file.flush()
+        self.count += 1
+        if self._recorder is not None:
+            self._recorder.add(name, status.as_dict())
+
+    def close(self):
+        """Finish the report. Markdown reports get their attention list written in"""
+        if self._file.closed:
+            return
+        if self._recorder is not None:
+            self.run = self._recorder.close()
+        if self.format == "jsonl":
+            import json
+            summary = {"summary": {"time": self.time_stamp, "repos": self.count, "attention": self.attention}}
+            self._file.write((json.dumps(summary) + "\n").encode("utf-8"))
+            self._file.close()
+            return
+        self._file.close()
+        from shutil import copyfileobj
+        attention = "".join("1. {}\n".format(name) for name in self.attention)
+        temporary = str(self.path) + ".tmp"
+        with open(temporary, 'wb') as output, open(str(self.path), 'rb') as body:
+            output.write(self._header(attention).encode("utf-8"))
+            body.seek(self._body_start)
+            copyfileobj(body, output)
+        os.replace(temporary, str(self.path))
+
+
+def write_status_report(results, report_format="md", history=None):
+    """Write a status file to STATUS_DIR and return its path
+
+    Parameters
+    ------------
+    results : iterable
+        (repo name, RepoStatus) pairs in the order they should be reported. Each
+        pair is written as soon as the iterable produces it
+    report_format : str
+        "md" for markdown or "jsonl" for JSON Lines
+    history : History
+        Also record the statuses in this status history
+    """
+    with StatusReport(report_format, history) as report:
+        for name, status in results:
+            report.add(name, status)
+    return report.path
+
+
+def open_history():
+    """Return the status history kept in SHELF_DIR. Close it when done"""
+    from .history import History
+    Path.mkdir(SHELF_DIR, parents=True, exist_ok=True)
+    return History(SHELF_DIR / HISTORY_NAME)
+
+
+def _describe_change(before, after):
+    """Return the fields of a status that changed as a list of lines"""
+    if before is None:
+        return ["first seen"] + str(RepoStatus.from_dict(after)).splitlines()
+    lines = []
+    for field in RepoStatus.FIELDS:
+        if field != 'text' and before.get(field) != after.get(field):
+            lines.append("{}: {} -> {}".format(field, before.get(field), after.get(field)))
+    return lines
+
+
+def status_delta(since=None, until=None, report_format="md"):
+    """Write a report of the repos whose status changed between two all_status runs and return its path
+
+    Parameters
+    ------------
+    since : int or str
+        Run ID, or a duration such as "1d" for the last run at least that long ago.
+        Defaults to the run before until
+    until : int
+        Run ID, defaults to the last run
+    report_format : str
+        "md" for markdown or "jsonl" for JSON Lines
+    """
+    import json
+    from datetime import datetime
+    from .query import parse_duration
+    if report_format not in StatusReport.FORMATS:
+        raise Exception("Unknown report format {}. Use one of {}".format(report_format, ", ".join(StatusReport.FORMATS)))
+    history = open_history()
+    try:
+        if isinstance(since, str):
+            since = history.run_at(time.time() - parse_duration(since)) or 0
+        changes = history.delta(since, until)
+    finally:
+        history.close()
+
+    Path.mkdir(STATUS_DIR, parents=True, exist_ok=True)
+    time_stamp = datetime.now().strftime("%a_%d_%b_%Y_%H_%M_%S_%p")
+    path = STATUS_DIR / "REPO_DELTA_@_{}.{}".format(time_stamp, report_format)
+    with open(str(path), 'w') as f:
+        if report_format == "jsonl":
+            for change in changes:
+                f.write(json.dumps(change.as_dict()) + "\n")
+        else:
+            f.write("# Repository status changes as at {}\n\n{} repos changed\n".format(time_stamp, len(changes)))
+            for change in changes:
+                f.write("\n## {}\n\n```cmd\n{}\n```\n".format(
+                    change.name, "\n".join(_describe_change(change.before, change.after))))
+    print("{} repos changed. Report saved in {}".format(len(changes), path))
+    return path
+
+
+def compact_history(keep_runs=None, max_age=None):
+    """Drop old runs from the status history and return how many were dropped, see History.compact"""
+    history = open_history()
+    try:
+        dropped = history.compact(keep_runs, max_age)
+        if dropped:
+            history.vacuum()
+        return dropped
+    finally:
+        history.close()
+
+
+def prune_reports(keep=None, max_age=None):
+    """Delete all but the keep newest status files in STATUS_DIR and those older than max_age seconds
+
+    Returns the number of files deleted
+    """
+    try:
+        entries = [entry for entry in os.scandir(str(STATUS_DIR))
+                   if entry.name.startswith(("REPO_STATUS_@_", "REPO_DELTA_@_")) and entry.is_file()]
+    except FileNotFoundError:
+        return 0
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    doomed = entries[keep:] if keep is not None else []
+    if max_age is not None:
+        cutoff = time.time() - max_age
+        doomed += [entry for entry in entries[:len(entries) - len(doomed)] if entry.stat().st_mtime < cutoff]
+    for entry in doomed:
+        os.remove(entry.path)
+    return len(doomed)
+
+
+def stream_results(executor, function, repositories, ordered=True, schedule=None):
+    """Run function on every repo with executor and yield (repo name, result) as results come in
+
+    If ordered is True results are yielded in the order of repositories. Results that
+    finish early are parked in a reorder buffer until every repo before them is out, so
+    only those are held in memory. schedule lists the indexes of repositories in the
+    order they are handed to executor, by default their own order. function is
+    submitted as it is, so it has to be picklable for process pools. Exceptions raised
+    by function are raised again here
+    """
+    from queue import Queue
+    from functools import partial
+    finished = Queue()
+    repositories = list(repositories)
+
+    def done(index, name, future):
+        error = future.exception()
+        finished.put((index, name, None if error is not None else future.result(), error))
+
+    for index in range(len(repositories)) if schedule is None else schedule:
+        future = executor.submit(function, repositories[index])
+        future.add_done_callback(partial(done, index, repositories[index].name))
+
+    waiting = {} # reorder buffer, index -> (name, result)
+    next_index = 0
+    for _ in range(len(repositories)):
+        index, name, result, error = finished.get()
+        if error is not None:
+            raise error
+        if not ordered:
+            yield name, result
+            continue
+        waiting[index] = (name, result)
+        while next_index in waiting:
+            yield waiting.pop(next_index)
+            next_index += 1
+
+
+def cost_schedule(repositories):
+    """Return the indexes of repositories ordered by the time their last git status took, largest first
+
+    Repos that have not been measured yet come first, in their own order
+    """
+    costs = get_registry().status_costs()
+    return sorted(range(len(repositories)), key=lambda index: -costs.get(repositories[index].dir, float("inf")))
+
+
+def _start_status_process(shelf_dir, status_dir, batch_backend, environment, repo_environment, fetch_ttl, fetched):
+    """Give a status worker process the settings and known fetch times of the process that started it"""
+    global SHELF_DIR, STATUS_DIR, BATCH_BACKEND
+    SHELF_DIR, STATUS_DIR, BATCH_BACKEND = Path(shelf_dir), Path(status_dir), batch_backend
+    GIT_ENVIRONMENT.update(environment)
+    REPO_ENVIRONMENT.update(repo_environment)
+    FETCH_SCHEDULER.ttl = fetch_ttl
+    FETCH_SCHEDULER._last_fetch.update(fetched)
+
+
+def _process_status(repo, timeout, force_fetch, raw, cache):
+    """Read the status of repo in a worker process
+
+    Returns the status as a dict and the git processes it ran as instrumentation
+    records, which is all that is sent back to the parent
+    """
+    from .instrument import INSTRUMENTATION
+    with INSTRUMENTATION.scope(keep_records=True) as usage:
+        status = repo_status(repo, timeout, force_fetch=force_fetch, raw=raw, cache=cache)
+    return status.as_dict(), usage.records
+
+
+def _process_pool(processes):
+    """Return a pool of processes for _process_status. Needs Python 3.7 or later"""
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    # spawned workers start clean instead of inheriting the registry connection and threads of this process
+    return ProcessPoolExecutor(max_workers=max(1, processes), mp_context=get_context("spawn"),
+                               initializer=_start_status_process,
+                               initargs=(str(SHELF_DIR), str(STATUS_DIR), BATCH_BACKEND, dict(GIT_ENVIRONMENT),
+                                         dict(REPO_ENVIRONMENT), FETCH_SCHEDULER.ttl,
+                                         dict(FETCH_SCHEDULER._last_fetch)))
+
+
+def _process_results(results):
+    from .instrument import INSTRUMENTATION
+    for name, (data, records) in results:
+        for record in records:
+            INSTRUMENTATION.record(record)
+        yield name, RepoStatus.from_dict(data)
+
+
+def all_status(workers=STATUS_WORKERS, timeout=None, force_fetch=False, raw=False, cache=False,
+               report_format="md", ordered=True, query=None, processes=None):
+    """Write status of all repositories to file in markdown format
+
+    Parameters
+    ------------
+    workers : int
+        Number of repos whose status is fetched at the same time
+    timeout : float
+        Seconds to wait for each repo before giving up on it
+    force_fetch : bool
+        Fetch every repo, even those fetched less than FETCH_SCHEDULER.ttl seconds ago
+    raw : bool
+        Write the full text of git status for each repo instead of a summary
+    cache : bool
+        Reuse statuses from STATUS_CACHE for repos whose index, HEAD and refs have not changed.
+        Unstaged edits and new untracked files are missed while it is on
+    report_format : str
+        "md" for markdown or "jsonl" for JSON Lines
+    ordered : bool
+        Report repos in index order. If False each repo is written as soon as it finishes
+    query : str
+        Only report on the repos selected by this query, see load_multiple
+    processes : int
+        Read statuses in this many worker processes instead of workers threads. Each
+        worker runs and parses git status itself and only sends the structured status
+        back, which keeps huge repos from holding up the rest of the fleet. Needs
+        Python 3.7 or later, earlier versions use workers threads
+
+    Repos are started in order of the time their last git status took, largest first.
+    Unless force_fetch is set, repos due for a fetch are only fetched if their remote
+    refs moved, see FETCH_PLAN
+    """
+    print("Getting repo status.\n\nYou may be prompted for credentials...")
+
+    import sys
+    from functools import partial
+    from .ssh import Multiplexer
+    from .instrument import INSTRUMENTATION
+    repositories = list(load_multiple(_all=True, query=query))
+    schedule = cost_schedule(repositories)
+    stale = [repo for repo in repositories if force_fetch or not FETCH_SCHEDULER.is_fresh(repo)]
+    history = open_history() if KEEP_HISTORY else None
+    if processes and sys.version_info < (3, 7):
+        # worker processes are set up with ProcessPoolExecutor's initializer, added in Python 3.7
+        print("Worker processes need Python 3.7 or later, reading statuses with {} threads".format(workers))
+        processes = None
+    try:
+        with INSTRUMENTATION.scope() as usage, Multiplexer(stale, SSH_MULTIPLEX):
+            if FETCH_PLAN and stale and not force_fetch:
+                plan_fetches(stale, workers, timeout)
+            if processes:
+                with _process_pool(processes) as executor:
+                    results = stream_results(
+                        executor, partial(_process_status, timeout=timeout, force_fetch=force_fetch, raw=raw,
+                                          cache=cache),
+                        repositories, ordered, schedule)
+                    fname = write_status_report(_process_results(results), report_format, history)
+            else:
+                with _thread_pool(workers) as executor:
+                    results = stream_results(
+                        executor, lambda repo: repo_status(repo, timeout, force_fetch=force_fetch, raw=raw, cache=cache),
+                        repositories, ordered, schedule)
+                    fname = write_status_report(results, report_format, history)
+    finally:
+        if history is not None:
+            history.close()
+    if KEEP_REPORTS is not None:
+        prune_reports(KEEP_REPORTS)
 
     print("\n\nDone. Status file saved in ", STATUS_DIR)
-    os.chdir(BASE_DIR)
-    return
+    if PRINT_SUMMARY:
+        print(usage.format_summary())
+    return fname
 
 if __name__ == "__main__":
     initialize()
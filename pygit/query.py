@@ -0,0 +1,119 @@
+"""Selection of indexed repos by tag, group, name, last known status and recent changes
+
+A query is a space separated list of kind:value terms. Terms of the same kind
+match if any of them does, terms of different kinds must all match, and terms
+starting with - exclude the repos they match:
+
+    group:payments                  repos in the payments group
+    tag:web tag:api                 repos tagged web or api
+    group:payments status:dirty     repos in payments that were dirty when last seen
+    changed:1h -tag:archived        repos whose HEAD, index or refs changed in the last hour, except archived ones
+    name:service-*                  repos whose name matches a shell pattern
+
+status: uses the status stored in the index by the last structured status read, so it
+runs no git. Repos that have never been read, or whose status could not be read, are
+status:unknown. changed: only looks at modification times.
+"""
+
+import json
+import time
+
+from fnmatch import fnmatchcase
+
+KINDS = ('tag', 'group', 'name', 'status', 'changed')
+STATUSES = ('attention', 'clean', 'dirty', 'ahead', 'behind', 'conflicted', 'untracked', 'unknown')
+UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+def parse_duration(text):
+    """Return the seconds in a duration such as 90, 90s, 15m, 1h, 2d or 1w"""
+    text = text.strip().lower()
+    try:
+        if text and text[-1] in UNITS:
+            return float(text[:-1]) * UNITS[text[-1]]
+        return float(text)
+    except ValueError:
+        raise Exception("Invalid duration {!r}. Use a number followed by s, m, h, d or w".format(text))
+
+
+def status_matches(data, wanted):
+    """Return True if a status dict stored in the index, or None, is in the wanted state
+
+    attention and clean follow RepoStatus.need_attention, as the status report does
+    """
+    from .pygit import RepoStatus
+    if data is None:
+        return wanted == 'unknown'
+    changed = data['staged'] or data['unstaged'] or data['untracked'] or data['conflicted']
+    attention = RepoStatus.from_dict(data).need_attention()
+    return {
+        'attention': attention,
+        'clean': not attention,
+        'dirty': changed,
+        'ahead': data['ahead'],
+        'behind': data['behind'],
+        'conflicted': data['conflicted'],
+        'untracked': data['untracked'],
+        'unknown': False,
+    }[wanted]
+
+
+class Query:
+    """A parsed repo query
+
+    Parameters
+    -----------
+    text : str
+        The query, see the module documentation
+
+    Call matches() with rows of the index to filter them
+    """
+
+    def __init__(self, text=""):
+        self.text = text
+        self.include = {}
+        self.exclude = {}
+        for term in text.split():
+            terms = self.include
+            if term.startswith("-"):
+                terms, term = self.exclude, term[1:]
+            kind, separator, value = term.partition(":")
+            if not separator or kind not in KINDS or not value:
+                raise Exception("Invalid query term {!r}. Use one of {}".format(
+                    term, ", ".join(kind + ":" for kind in KINDS)))
+            if kind == 'status' and value not in STATUSES:
+                raise Exception("Unknown status {!r}. Use one of {}".format(value, ", ".join(STATUSES)))
+            if kind == 'changed':
+                value = parse_duration(value)
+            terms.setdefault(kind, []).append(value)
+
+    def __repr__(self):
+        return "Query({!r})".format(self.text)
+
+    def _term(self, kind, value, row, changed):
+        if kind == 'tag':
+            return value in row['tags'].split(",")
+        if kind == 'group':
+            return value == row['repo_group']
+        if kind == 'name':
+            return fnmatchcase(row['name'], value)
+        if kind == 'status':
+            return bool(status_matches(json.loads(row['last_status']) if row['last_status'] else None, value))
+        return changed is not None and changed >= time.time() - value
+
+    def matches(self, row, last_change=None):
+        """Return True if an index row is selected by the query
+
+        last_change is a function returning the time the repo in a path last changed,
+        only called for queries with changed: terms
+        """
+        changed = None
+        if 'changed' in self.include or 'changed' in self.exclude:
+            changed = last_change(row['path'])
+        for kind, values in self.include.items():
+            if not any(self._term(kind, value, row, changed) for value in values):
+                return False
+        for kind, values in self.exclude.items():
+            if any(self._term(kind, value, row, changed) for value in values):
+                return False
+        return True
@@ -0,0 +1,339 @@
+"""SQLite store for the repo index, settings, folder scan records and cached statuses
+
+A single database file replaces the NAME_SHELF, INDEX_SHELF and MASTER_SHELF shelves of
+earlier versions. It runs in WAL mode so that several processes, such as parallel
+workers and the watch daemon, can read it while another writes.
+"""
+
+import os
+import json
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS repos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    path TEXT NOT NULL UNIQUE,
+    master TEXT,
+    tags TEXT NOT NULL DEFAULT '',
+    repo_group TEXT,
+    status_cost REAL,
+    status_scope TEXT,
+    last_status TEXT,
+    status_fingerprint TEXT,
+    status_time REAL,
+    status_used REAL
+);
+CREATE INDEX IF NOT EXISTS repos_master ON repos (master);
+CREATE INDEX IF NOT EXISTS repos_status_used ON repos (status_used);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    mtime INTEGER,
+    device INTEGER,
+    inode INTEGER,
+    repo INTEGER,
+    identity TEXT,
+    subfolders TEXT
+);
+"""
+
+
+def split_tags(tags):
+    """Return the tags stored in a tags column as a sorted list"""
+    return sorted(tag for tag in tags.split(",") if tag)
+
+
+class Registry:
+    """Index of git repos backed by SQLite
+
+    Parameters
+    -----------
+    path : str
+        Location of the database file. It is created if missing
+
+    One connection is shared by every thread of the process, calls are serialized with a lock
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._lock = threading.RLock()
+        self._depth = 0 # transaction() blocks open in the thread holding the lock
+        self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        self._add_columns()
+
+    def _add_columns(self):
+        """Add the columns of later versions to a database created by an earlier one"""
+        columns = {row['name'] for row in self._connection.execute("PRAGMA table_info(repos)")}
+        with self._connection:
+            if 'repo_group' not in columns:
+                self._connection.execute("ALTER TABLE repos ADD COLUMN repo_group TEXT")
+            if 'status_cost' not in columns:
+                self._connection.execute("ALTER TABLE repos ADD COLUMN status_cost REAL")
+            if 'status_scope' not in columns:
+                self._connection.execute("ALTER TABLE repos ADD COLUMN status_scope TEXT")
+            if 'identity' not in {row['name'] for row in self._connection.execute("PRAGMA table_info(folders)")}:
+                self._connection.execute("ALTER TABLE folders ADD COLUMN identity TEXT")
+
+    def close(self):
+        """Close the database connection"""
+        with self._lock:
+            self._connection.close()
+
+    @contextmanager
+    def transaction(self):
+        """Run a block of writes atomically. Nested blocks are part of the outermost one"""
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield self
+                finally:
+                    self._depth -= 1
+                return
+            self._depth = 1
+            try:
+                with self._connection: # commits on success, rolls back on an exception
+                    yield self
+            finally:
+                self._depth = 0
+
+    def _query(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def _write(self, sql, parameters=()):
+        with self.transaction():
+            return self._connection.execute(sql, parameters)
+
+    # settings
+
+    def get_setting(self, key, default=None):
+        """Return a stored setting"""
+        rows = self._query("SELECT value FROM settings WHERE key = ?", (key,))
+        return json.loads(rows[0]['value']) if rows else default
+
+    def set_setting(self, key, value):
+        """Store a JSON serializable setting"""
+        self._write("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    # repos
+
+    def repos(self):
+        """Return every repo row ordered by ID"""
+        return self._query("SELECT * FROM repos ORDER BY id")
+
+    def get(self, repo_id):
+        """Return the repo row with repo_id, None if there is none"""
+        rows = self._query("SELECT * FROM repos WHERE id = ?", (int(repo_id),))
+        return rows[0] if rows else None
+
+    def get_by_name(self, name):
+        """Return the repo row called name, None if there is none"""
+        rows = self._query("SELECT * FROM repos WHERE name = ?", (name,))
+        return rows[0] if rows else None
+
+    def get_by_path(self, path):
+        """Return the repo row for the repo in path, None if there is none"""
+        rows = self._query("SELECT * FROM repos WHERE path = ?", (os.path.abspath(str(path)),))
+        return rows[0] if rows else None
+
+    def unique_name(self, path, base_directory):
+        """Return a name for the repo in path that no other repo uses
+
+        Falls back to the path relative to base_directory and then to numbered names
+        """
+        name = os.path.basename(path)
+        if self.get_by_name(name) is None:
+            return name
+        name = os.path.relpath(path, base_directory).replace(os.sep, "/")
+        candidate, i = name, 2
+        while self.get_by_name(candidate) is not None:
+            candidate = "{}-{}".format(name, i)
+            i += 1
+        return candidate
+
+    def add(self, name, path, master=None, repo_id=None):
+        """Add a repo and return its ID. IDs of removed repos are never reused"""
+        cursor = self._write(
+            "INSERT INTO repos (id, name, path, master) VALUES (?, ?, ?, ?)",
+            (repo_id, name, os.path.abspath(str(path)), master))
+        return cursor.lastrowid
+
+    def move(self, repo_id, name, path):
+        """Give a repo a new name and location, keeping its ID"""
+        self._write(
+            "UPDATE repos SET name = ?, path = ?, last_status = NULL, status_fingerprint = NULL "
+            "WHERE id = ?", (name, os.path.abspath(str(path)), int(repo_id)))
+
+    def remove(self, repo_id):
+        """Remove a repo from the index"""
+        self._write("DELETE FROM repos WHERE id = ?", (int(repo_id),))
+
+    # tags
+
+    def get_tags(self, repo_id):
+        """Return the tags of a repo as a sorted list"""
+        rows = self._query("SELECT tags FROM repos WHERE id = ?", (int(repo_id),))
+        return split_tags(rows[0]['tags']) if rows else []
+
+    def set_tags(self, repo_id, tags):
+        """Replace the tags of a repo"""
+        self._write("UPDATE repos SET tags = ? WHERE id = ?", (",".join(sorted(set(tags))), int(repo_id)))
+
+    def tagged(self, tag):
+        """Return the rows of the repos tagged tag, ordered by ID"""
+        return self._query(
+            "SELECT * FROM repos WHERE instr(',' || tags || ',', ',' || ? || ',') > 0 ORDER BY id", (tag,))
+
+    def set_group(self, repo_id, group):
+        """Put a repo in group, None takes it out of its group"""
+        self._write("UPDATE repos SET repo_group = ? WHERE id = ?", (group, int(repo_id)))
+
+    def groups(self):
+        """Return {group: number of repos in it}"""
+        return {row['repo_group']: row['count'] for row in self._query(
+            "SELECT repo_group, count(*) AS count FROM repos WHERE repo_group IS NOT NULL "
+            "GROUP BY repo_group ORDER BY repo_group")}
+
+    # folder scan records
+
+    def folders(self):
+        """Return the folder records of the last scan as a dict keyed on path"""
+        return {
+            row['path']: {
+                'mtime': row['mtime'],
+                'inode': (row['device'], row['inode']),
+                'repo': bool(row['repo']),
+                'identity': json.loads(row['identity']) if row['identity'] else None,
+                'subfolders': json.loads(row['subfolders']),
+            }
+            for row in self._query("SELECT * FROM folders")
+        }
+
+    def save_folders(self, changed, removed):
+        """Store changed folder records and drop the removed paths"""
+        with self.transaction():
+            self._connection.executemany("DELETE FROM folders WHERE path = ?", [(path,) for path in removed])
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO folders (path, mtime, device, inode, repo, identity, subfolders) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(path, record['mtime'], record['inode'][0], record['inode'][1], int(record['repo']),
+                  json.dumps(record['identity']) if record.get('identity') else None,
+                  json.dumps(record['subfolders'])) for path, record in changed.items()])
+
+    def clear_folders(self):
+        """Drop every folder record"""
+        self._write("DELETE FROM folders")
+
+    # cached statuses
+
+    def get_status(self, path):
+        """Return (fingerprint, status dict, time stored) for the repo in path, None if missing"""
+        rows = self._query(
+            "SELECT last_status, status_fingerprint, status_time FROM repos WHERE path = ?",
+            (os.path.abspath(str(path)),))
+        if not rows or rows[0]['last_status'] is None:
+            return None
+        row = rows[0]
+        return row['status_fingerprint'], json.loads(row['last_status']), row['status_time']
+
+    def put_status(self, path, fingerprint, status, when, cost=None):
+        """Store the status dict of the repo in path. Repos that are not indexed are ignored
+
+        cost is the number of seconds git took to produce the status, kept until a new one is given
+        """
+        self._write(
+            "UPDATE repos SET last_status = ?, status_fingerprint = ?, status_time = ?, status_used = ?, "
+            "status_cost = coalesce(?, status_cost) WHERE path = ?",
+            (json.dumps(status), fingerprint, when, when, cost, os.path.abspath(str(path))))
+
+    def get_scope(self, path):
+        """Return the status scope dict of the repo in path, empty if it has none"""
+        rows = self._query("SELECT status_scope FROM repos WHERE path = ?", (os.path.abspath(str(path)),))
+        return json.loads(rows[0]['status_scope']) if rows and rows[0]['status_scope'] else {}
+
+    def set_scope(self, repo_id, scope):
+        """Store the status scope dict of a repo. An empty scope removes it"""
+        self._write("UPDATE repos SET status_scope = ? WHERE id = ?",
+                    (json.dumps(scope, sort_keys=True) if scope else None, int(repo_id)))
+
+    def status_costs(self):
+        """Return {path: seconds the last git status took} for the repos where it is known"""
+        return {row['path']: row['status_cost']
+                for row in self._query("SELECT path, status_cost FROM repos WHERE status_cost IS NOT NULL")}
+
+    def touch_status(self, path, when):
+        """Record that the cached status of the repo in path was used"""
+        self._write("UPDATE repos SET status_used = ? WHERE path = ?", (when, os.path.abspath(str(path))))
+
+    def clear_status(self, path=None):
+        """Drop the cached status of the repo in path, or of every repo"""
+        sql = "UPDATE repos SET last_status = NULL, status_fingerprint = NULL, status_used = NULL"
+        if path is None:
+            self._write(sql)
+        else:
+            self._write(sql + " WHERE path = ?", (os.path.abspath(str(path)),))
+
+    def evict_statuses(self, max_entries):
+        """Drop the least recently used cached statuses until at most max_entries remain"""
+        self._write(
+            "UPDATE repos SET last_status = NULL, status_fingerprint = NULL, status_used = NULL "
+            "WHERE id IN (SELECT id FROM repos WHERE last_status IS NOT NULL "
+            "ORDER BY status_used DESC LIMIT -1 OFFSET ?)", (max_entries,))
+
+    # migration
+
+    def migrate_shelves(self, shelf_dir):
+        """Import the index from the shelves of earlier versions, once
+
+        Returns True if anything was imported
+        """
+        if self.get_setting('shelves_migrated'):
+            return False
+        shelf_dir = str(shelf_dir)
+        paths = {name: os.path.join(shelf_dir, name) for name in ("NAME_SHELF", "INDEX_SHELF", "MASTER_SHELF")}
+
+        def exists(name):
+            return any(os.path.exists(paths[name] + suffix) for suffix in ("", ".db", ".dat", ".dir"))
+
+        imported = False
+        if exists("NAME_SHELF") and exists("INDEX_SHELF"):
+            import shelve
+            with shelve.open(paths["NAME_SHELF"], 'r') as names, \
+                    shelve.open(paths["INDEX_SHELF"], 'r') as index:
+                for key in sorted(index.keys(), key=int):
+                    name = index[key]
+                    if name in names and self.get_by_name(name) is None:
+                        self.add(name, str(names[name]), repo_id=int(key))
+                for git_key in ('GIT_WINDOWS', 'GIT_BASH'):
+                    if git_key in names:
+                        self.set_setting(git_key, str(names[git_key]))
+            imported = True
+
+        if exists("MASTER_SHELF"):
+            import shelve
+            with shelve.open(paths["MASTER_SHELF"], 'r') as master_shelf:
+                master = master_shelf.get("master")
+                if master:
+                    master = os.path.abspath(str(master))
+                    self.set_setting('master', master)
+                    self.set_setting('depth', master_shelf.get("depth", 1))
+                    self.set_setting('rules', master_shelf.get("rules"))
+                    inside = master.rstrip(os.sep) + os.sep
+                    self._write("UPDATE repos SET master = ? WHERE substr(path, 1, ?) = ?",
+                                (master, len(inside), inside))
+            imported = True
+
+        self.set_setting('shelves_migrated', True)
+        return imported
@@ -0,0 +1,203 @@
+"""Shared ssh connections for fleet operations
+
+Git starts a new ssh process, and so goes through a new ssh handshake, for every
+fetch, pull and push. While a Multiplexer is active, one master connection is
+opened up front for each ssh host the repos use, and every git process pygit
+starts is told through GIT_SSH_COMMAND to run its session over it:
+
+    with Multiplexer(load_multiple(_all=True)):
+        ... # fetches, pulls and pushes started here reuse the connections
+
+The connections are closed when the block ends. Masters log in non-interactively,
+hosts that need a password or have an unknown host key get none and git connects
+to them as usual. Repos that set core.sshCommand, for instance to use a deploy key,
+keep their own command and get no master. Nothing changes when GIT_SSH or
+GIT_SSH_COMMAND is already set, when the global or system git config sets
+core.sshCommand, or on Windows, whose ssh cannot share connections.
+"""
+
+import os
+import re
+import shlex
+import shutil
+import tempfile
+import threading
+
+from subprocess import run, PIPE, DEVNULL, TimeoutExpired
+
+CONNECT_TIMEOUT = 10 # seconds a master may take to log in
+PERSIST = 300 # seconds an idle master stays up if it is never closed, e.g. when pygit is killed
+
+
+def ssh_destination(url):
+    """Return (user, host, port) of an ssh remote URL, None if git does not reach it over ssh
+
+    user and port are None where the URL leaves them to the ssh configuration
+    """
+    if not url:
+        return None
+    match = re.match(r"^(?:ssh|git\+ssh|ssh\+git)://(?:([^@/]*)@)?(\[[^\]]+\]|[^:/]+)(?::(\d+))?/", url, re.IGNORECASE)
+    if match:
+        user, host, port = match.groups()
+        return user or None, host.strip("[]"), int(port) if port else None
+    if re.match(r"^[a-z][a-z0-9+.-]*://", url, re.IGNORECASE) or os.path.exists(url):
+        return None
+    match = re.match(r"^(?:([^@/]+)@)?(\[[^\]]+\]|[^:/]+):", url) # scp-like user@host:path
+    if match:
+        return match.group(1), match.group(2).strip("[]"), None
+    return None
+
+
+def _global_ssh_command():
+    """Return the core.sshCommand of the system and global git config, None if neither sets one"""
+    try:
+        result = run(["git", "config", "--get", "core.sshCommand"], cwd=os.path.expanduser("~"),
+                     stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL, timeout=CONNECT_TIMEOUT,
+                     env=dict(os.environ, GIT_DIR=os.devnull))
+    except (OSError, TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.decode("utf-8", "replace").strip() or None
+
+
+def own_ssh_command(directory):
+    """Return the core.sshCommand set in the config of the repo in directory, None if it sets none
+
+    Include directives are not followed
+    """
+    from . import graph
+    from .pygit import git_dir, common_git_dir
+    for config in (graph.read_config(str(git_dir(directory)), "config.worktree"),
+                   graph.read_config(str(common_git_dir(directory)))):
+        command = config.get(("core", None), {}).get("sshcommand")
+        if command:
+            return command[-1]
+    return None
+
+
+def _destination_arguments(destination):
+    user, host, port = destination
+    arguments = []
+    if port is not None:
+        arguments += ["-p", str(port)]
+    if user is not None:
+        arguments += ["-l", user]
+    return arguments + [host]
+
+
+class Multiplexer:
+    """Keeps one ssh master connection per host open for the git processes pygit starts
+
+    Parameters
+    -----------
+    repositories : iterable
+        Commands objects whose ssh remotes get a master connection
+    enabled : bool
+        If False the multiplexer does nothing
+    connect_timeout : float
+        Seconds a master may take to log in before the host is left without one
+
+    masters holds the destinations, (user, host, port), that have a master, and
+    directories the repos whose git processes are pointed at them
+    """
+
+    def __init__(self, repositories=(), enabled=True, connect_timeout=CONNECT_TIMEOUT):
+        self.repositories = list(repositories)
+        self.enabled = enabled
+        self.connect_timeout = connect_timeout
+        self.directory = None
+        self.masters = []
+        self.directories = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def available():
+        """Return True if ssh connections can be shared on this system"""
+        from . import pygit
+        if os.name == "nt" or shutil.which("ssh") is None:
+            return False
+        if any(name in os.environ or name in pygit.GIT_ENVIRONMENT for name in ("GIT_SSH", "GIT_SSH_COMMAND")):
+            return False
+        return _global_ssh_command() is None
+
+    def _control_options(self):
+        return ["-o", "ControlPath=" + os.path.join(self.directory, "%C")]
+
+    def ssh_command(self):
+        """Return the GIT_SSH_COMMAND that runs ssh over the masters"""
+        return " ".join(shlex.quote(argument) for argument in
+                        ["ssh", "-o", "ControlMaster=no"] + self._control_options())
+
+    def __enter__(self):
+        if not self.enabled or not self.available():
+            return self
+        # unix socket paths are short, keep them out of long per-user temporary folders
+        self.directory = tempfile.mkdtemp(prefix="pygit-ssh-", dir="/tmp" if os.path.isdir("/tmp") else None)
+        self.connect(self.repositories)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self, repositories):
+        """Open a master for every ssh host of repositories that does not have one yet
+
+        Git processes in those repos run ssh over the masters, except in repos that set
+        their own core.sshCommand
+        """
+        from . import pygit
+        if self.directory is None:
+            return
+        destinations = []
+        for repo in repositories:
+            try:
+                destination = ssh_destination(pygit.remote_url(repo.dir))
+                if destination is None or own_ssh_command(repo.dir) is not None:
+                    continue
+            except OSError:
+                continue
+            # set per repo, GIT_SSH_COMMAND would override the core.sshCommand of other repos
+            pygit.REPO_ENVIRONMENT.setdefault(repo.dir, {})["GIT_SSH_COMMAND"] = self.ssh_command()
+            self.directories.append(repo.dir)
+            if destination not in destinations and destination not in self.masters:
+                destinations.append(destination)
+        if destinations:
+            with pygit._thread_pool(min(len(destinations), pygit.STATUS_WORKERS)) as executor:
+                list(executor.map(self._start_master, destinations))
+
+    def _start_master(self, destination):
+        # -f returns once the master has logged in and is running in the background
+        command = ["ssh", "-f", "-N", "-M", "-o", "BatchMode=yes", "-o", "ControlPersist={}".format(PERSIST),
+                   "-o", "ConnectTimeout={}".format(int(self.connect_timeout))]
+        command += self._control_options() + _destination_arguments(destination)
+        try:
+            result = run(command, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, timeout=self.connect_timeout + 5)
+        except (OSError, TimeoutExpired):
+            return False
+        if result.returncode == 0:
+            with self._lock:
+                self.masters.append(destination)
+        return result.returncode == 0
+
+    def close(self):
+        """Close every master and stop pointing git at them"""
+        from . import pygit
+        if self.directory is None:
+            return
+        for directory in self.directories:
+            environment = pygit.REPO_ENVIRONMENT.get(directory, {})
+            if environment.get("GIT_SSH_COMMAND") == self.ssh_command():
+                del environment["GIT_SSH_COMMAND"]
+                if not environment:
+                    del pygit.REPO_ENVIRONMENT[directory]
+        self.directories = []
+        for destination in self.masters:
+            try:
+                run(["ssh", "-O", "exit"] + self._control_options() + _destination_arguments(destination),
+                    stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, timeout=self.connect_timeout)
+            except (OSError, TimeoutExpired):
+                pass
+        self.masters = []
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
@@ -19,3 +19,251 @@ from send2trash import send2trash
 #     cleanup, check_git_support, is_git_repo, need_attention, initialize,
 #     Commands, repos, load, load_multiple, pull, push, all_status
 # )
+
+
+def _git(cwd, *args):
+    """Run git in cwd with a fixed identity and return its stripped output"""
+    from subprocess import run, PIPE
+    env = dict(os.environ, GIT_AUTHOR_NAME="pygit", GIT_AUTHOR_EMAIL="pygit@example.com",
+               GIT_COMMITTER_NAME="pygit", GIT_COMMITTER_EMAIL="pygit@example.com")
+    result = run(["git"] + list(args), cwd=str(cwd), stdout=PIPE, stderr=PIPE, env=env, check=True)
+    return result.stdout.decode("utf-8").strip()
+
+
+class TrackingTest(unittest.TestCase):
+    """graph.tracking() agrees with git rev-list --left-right --count"""
+
+    def setUp(self):
+        import tempfile
+        self.root = Path(tempfile.mkdtemp(prefix="pygit-test-"))
+        self.remote = self.root / "remote.git"
+        self.work = self.root / "work"
+        self.other = self.root / "other"
+        _git(self.root, "init", "--quiet", "--bare", str(self.remote))
+        _git(self.remote, "symbolic-ref", "HEAD", "refs/heads/master")
+        for clone in (self.work, self.other):
+            _git(self.root, "clone", "--quiet", str(self.remote), str(clone))
+            _git(clone, "symbolic-ref", "HEAD", "refs/heads/master")
+        self.commit(self.work, "base", 3)
+        _git(self.work, "push", "--quiet", "-u", "origin", "master")
+        _git(self.other, "pull", "--quiet", "origin", "master")
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(str(self.root), ignore_errors=True)
+
+    def commit(self, repo, prefix, count):
+        for number in range(count):
+            path = repo / "{}-{}.txt".format(prefix, number)
+            path.write_text("{}\n".format(random.random()) * 50)
+            _git(repo, "add", path.name)
+            _git(repo, "commit", "--quiet", "-m", "{} {}".format(prefix, number))
+
+    def diverge(self, ahead=4, behind=5):
+        """Give work local commits and the remote commits work has fetched but not merged"""
+        self.commit(self.work, "local", ahead)
+        self.commit(self.other, "remote", behind)
+        _git(self.other, "push", "--quiet", "origin", "master")
+        _git(self.work, "fetch", "--quiet")
+
+    def assertMatchesGit(self):
+        from .graph import tracking
+        behind, ahead = (int(count) for count in
+                         _git(self.work, "rev-list", "--left-right", "--count", "@{u}...HEAD").split())
+        upstream, found_ahead, found_behind = tracking(str(self.work))["master"]
+        self.assertEqual(upstream, "refs/remotes/origin/master")
+        self.assertEqual((found_ahead, found_behind), (ahead, behind))
+
+    def test_loose_objects(self):
+        self.diverge()
+        self.assertFalse(list((self.work / ".git" / "objects" / "pack").glob("*.pack")))
+        self.assertMatchesGit()
+
+    def test_deltified_pack(self):
+        self.diverge()
+        _git(self.work, "repack", "-adf", "--quiet")
+        self.assertTrue(list((self.work / ".git" / "objects" / "pack").glob("*.pack")))
+        self.assertMatchesGit()
+
+    def test_commit_graph(self):
+        self.diverge()
+        _git(self.work, "commit-graph", "write", "--reachable")
+        self.assertTrue((self.work / ".git" / "objects" / "info" / "commit-graph").exists())
+        self.assertMatchesGit()
+
+    def test_merge_commits(self):
+        _git(self.work, "checkout", "--quiet", "-b", "feature")
+        self.commit(self.work, "feature", 3)
+        _git(self.work, "checkout", "--quiet", "master")
+        self.commit(self.work, "local", 2)
+        _git(self.work, "merge", "--quiet", "--no-ff", "-m", "merge feature", "feature")
+        _git(self.other, "checkout", "--quiet", "-b", "topic")
+        self.commit(self.other, "topic", 2)
+        _git(self.other, "checkout", "--quiet", "master")
+        self.commit(self.other, "remote", 1)
+        _git(self.other, "merge", "--quiet", "--no-ff", "-m", "merge topic", "topic")
+        _git(self.other, "push", "--quiet", "origin", "master")
+        _git(self.work, "fetch", "--quiet")
+        self.assertMatchesGit()
+        _git(self.work, "repack", "-adf", "--quiet")
+        _git(self.work, "commit-graph", "write", "--reachable")
+        self.assertMatchesGit()
+
+    def test_merged_upstream(self):
+        self.diverge()
+        _git(self.work, "merge", "--quiet", "-m", "merge upstream", "@{u}")
+        self.assertMatchesGit()
+
+
+SHA = "1" * 40
+HEADER = "# branch.oid {}\0# branch.head main\0".format(SHA)
+ENTRY = "N... 100644 100644 100644 {0} {0}".format(SHA)
+
+PORCELAIN_CASES = [
+    # name, output of git status --porcelain=v2 --branch -z, expected fields
+    ("clean with upstream", HEADER + "# branch.upstream origin/main\0# branch.ab +2 -3\0",
+     dict(branch="main", commit=SHA, upstream="origin/main", ahead=2, behind=3)),
+    ("no upstream", HEADER, dict(branch="main", upstream=None, ahead=0, behind=0)),
+    ("gone upstream", HEADER + "# branch.upstream origin/gone\0",
+     dict(upstream="origin/gone", ahead=0, behind=0)),
+    ("initial commit", "# branch.oid (initial)\0# branch.head main\0", dict(commit=None, branch="main")),
+    ("detached", "# branch.oid {}\0# branch.head (detached)\0".format(SHA), dict(branch=None, commit=SHA)),
+    ("staged and unstaged", HEADER + "1 M. {0} a.txt\0" "1 .M {0} b.txt\0" "1 MM {0} c.txt\0".format(ENTRY),
+     dict(staged=2, unstaged=2)),
+    ("rename", HEADER + "2 R. {0} R100 new name.txt\0old name.txt\0".format(ENTRY),
+     dict(staged=1, unstaged=0, untracked=0)),
+    ("rename then untracked", HEADER + "2 R. {0} R100 b\0a\0? c\0".format(ENTRY), dict(staged=1, untracked=1)),
+    ("copy with edits", HEADER + "2 CM {0} C75 copy.txt\0? looks like an entry.txt\0".format(ENTRY),
+     dict(staged=1, unstaged=1, untracked=0)),
+    ("unmerged", HEADER + "u UU N... 100644 100644 100644 100644 {0} {0} {0} both changed.txt\0"
+                          "u AA N... 000000 100644 100644 100644 {1} {0} {0} added.txt\0".format(SHA, "0" * 40),
+     dict(conflicted=["both changed.txt", "added.txt"], staged=0, unstaged=0)),
+    ("untracked with spaces", HEADER + "? a file.txt\0? dir with spaces/\0", dict(untracked=2)),
+    ("ignored", HEADER + "! build/\0", dict(untracked=0)),
+]
+
+
+class PorcelainStatusTest(unittest.TestCase):
+    """parse_porcelain_status() reads git status --porcelain=v2 --branch -z"""
+
+    def test_cases(self):
+        for name, output, expected in PORCELAIN_CASES:
+            with self.subTest(name):
+                status = pygit.parse_porcelain_status(output.encode("utf-8"))
+                self.assertEqual({field: getattr(status, field) for field in expected}, expected)
+
+    def test_real_output(self):
+        import shutil
+        import tempfile
+        from subprocess import CalledProcessError
+        repo = Path(tempfile.mkdtemp(prefix="pygit-test-"))
+        try:
+            _git(repo, "init", "--quiet")
+            _git(repo, "symbolic-ref", "HEAD", "refs/heads/master")
+            (repo / "old name.txt").write_text("content\n" * 20)
+            (repo / "conflict.txt").write_text("base\n")
+            _git(repo, "add", ".")
+            _git(repo, "commit", "--quiet", "-m", "base")
+            _git(repo, "checkout", "--quiet", "-b", "other")
+            (repo / "conflict.txt").write_text("other\n")
+            _git(repo, "commit", "--quiet", "-am", "other")
+            _git(repo, "checkout", "--quiet", "master")
+            (repo / "conflict.txt").write_text("master\n")
+            _git(repo, "commit", "--quiet", "-am", "master")
+            try:
+                _git(repo, "merge", "--quiet", "other")
+            except CalledProcessError:
+                pass # the merge stops on the conflict
+            _git(repo, "mv", "old name.txt", "new name.txt")
+            (repo / "untracked file.txt").write_text("new\n")
+            output = _git(repo, "status", "--porcelain=v2", "--branch", "-z")
+            status = pygit.parse_porcelain_status(output.encode("utf-8"))
+            self.assertEqual((status.branch, status.upstream, status.staged, status.untracked, status.conflicted),
+                             ("master", None, 1, 1, ["conflict.txt"]))
+        finally:
+            shutil.rmtree(str(repo), ignore_errors=True)
+
+
+def _status(**fields):
+    return pygit.RepoStatus(branch="main", commit=SHA, **fields).as_dict()
+
+
+class HistoryTest(unittest.TestCase):
+    """History stores changes only and answers deltas across runs and compaction"""
+
+    def setUp(self):
+        import tempfile
+        from .history import History
+        self.directory = tempfile.mkdtemp(prefix="pygit-test-")
+        self.history = History(os.path.join(self.directory, "history.db"))
+
+    def tearDown(self):
+        import shutil
+        self.history.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def record(self, statuses):
+        recorder = self.history.recorder()
+        for name, data in statuses.items():
+            recorder.add(name, data)
+        return recorder.close()
+
+    def test_only_changes_are_stored(self):
+        clean, dirty = _status(), _status(unstaged=1)
+        first = self.record({"a": clean, "b": clean})
+        second = self.record({"a": clean, "b": clean})
+        third = self.record({"a": dirty, "b": clean})
+        runs = {run["id"]: run for run in self.history.runs()}
+        self.assertEqual([runs[run]["changed"] for run in (first, second, third)], [2, 0, 1])
+        self.assertEqual(self.history._query("SELECT count(*) FROM states")[0][0], 2) # clean is stored once
+
+    def test_delta(self):
+        clean, dirty, ahead = _status(), _status(unstaged=1), _status(ahead=2)
+        first = self.record({"a": clean, "b": clean})
+        self.record({"a": dirty, "b": clean})
+        self.record({"a": clean, "b": ahead, "c": clean})
+        changes = {change.name: change for change in self.history.delta()}
+        self.assertEqual(sorted(changes), ["a", "b", "c"])
+        self.assertEqual((changes["a"].before, changes["a"].after),
+                         (status_digest_data(dirty), status_digest_data(clean)))
+        self.assertIsNone(changes["c"].before)
+        # a went dirty and back, so it did not change since the first run
+        self.assertEqual(sorted(change.name for change in self.history.delta(first)), ["b", "c"])
+        self.assertEqual(self.history.delta(first, first), [])
+
+    def test_text_is_ignored(self):
+        clean = _status()
+        self.record({"a": dict(clean, text="On branch main")})
+        self.record({"a": dict(clean, text="On branch main\n")})
+        self.assertEqual(self.history.delta(), [])
+
+    def test_compact_keeps_the_state_at_the_oldest_run(self):
+        clean, dirty, ahead = _status(), _status(unstaged=1), _status(ahead=1)
+        self.record({"a": clean, "b": clean})
+        self.record({"a": dirty, "b": clean})
+        kept = self.record({"a": dirty, "b": ahead})
+        last = self.record({"a": clean, "b": ahead})
+        before = self.history.state_at(kept)
+
+        self.assertEqual(self.history.compact(keep_runs=2), 2)
+        self.assertEqual([run["id"] for run in self.history.runs()], [last, kept])
+        self.assertEqual(self.history.state_at(kept), before)
+        self.assertEqual(self.history.state_at(), self.history.state_at(last))
+        self.assertEqual([change.name for change in self.history.delta(kept, last)], ["a"])
+        # the statuses only the dropped runs referred to are gone
+        self.assertEqual(self.history._query("SELECT count(*) FROM states")[0][0], 3)
+
+    def test_compact_by_age(self):
+        import time
+        self.record({"a": _status()})
+        self.history._connection.execute("UPDATE runs SET time = ?", (time.time() - 3600,))
+        self.history._connection.commit()
+        recent = self.record({"a": _status(unstaged=1)})
+        self.assertEqual(self.history.compact(max_age=60), 1)
+        self.assertEqual(self.history.state_at(recent), {"a": status_digest_data(_status(unstaged=1))})
+
+
+def status_digest_data(data):
+    """Return a status dict as History stores it"""
+    from .history import status_digest
+    return status_digest(data)[1]
@@ -0,0 +1,464 @@
+"""Watch daemon keeping the status of every indexed repo current
+
+`python -m pygit watch` subscribes to inotify events on the working tree and git
+directory of each indexed repo and re-reads the status of a repo only after it
+changes, waiting for DEBOUNCE seconds of quiet first. Current statuses are kept in
+memory and served over a Unix socket, see query(). Where inotify is not available,
+or a repo cannot be watched, the repo is polled instead.
+
+Nothing is fetched, so ahead/behind counts are relative to the last fetch.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import select
+import socket
+import struct
+import signal
+import argparse
+import threading
+import socketserver
+
+from subprocess import PIPE
+from concurrent.futures import ThreadPoolExecutor
+
+from . import pygit
+from .pygit import (
+    RepoStatus, load_multiple, parse_porcelain_status, status_fingerprint, git_dir, common_git_dir,
+    get_registry, STATUS_WORKERS, STATUS_CACHE
+)
+
+DEBOUNCE = 0.5 # seconds without events before a changed repo is read again
+POLL_INTERVAL = 5.0 # seconds between checks of repos that cannot be watched
+SOCKET_NAME = "watch.sock" # file in SHELF_DIR the daemon listens on
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+              IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT = struct.Struct("iIII")
+
+
+def socket_path():
+    """Return the path of the socket the daemon listens on"""
+    return str(pygit.SHELF_DIR / SOCKET_NAME)
+
+
+class Inotify:
+    """Minimal inotify binding through ctypes. Raises OSError where inotify is not available"""
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        if not sys.platform.startswith("linux"):
+            raise OSError(errno.ENOSYS, "inotify is only available on Linux")
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._ctypes = ctypes
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """Watch a directory and return its watch descriptor"""
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            error = self._ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+        return wd
+
+    def remove_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds and return a list of (wd, mask, name) events"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        position = 0
+        while position + _EVENT.size <= len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, position)
+            position += _EVENT.size
+            name = data[position:position + length].rstrip(b"\0")
+            position += length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _tree_fingerprint(directory):
+    """Return status_fingerprint of the repo plus the mtime and size of every file in its working tree"""
+    fingerprint = [status_fingerprint(directory)]
+    for root, folders, files in os.walk(directory):
+        folders[:] = [folder for folder in folders if folder != ".git"]
+        for file_name in files:
+            try:
+                stat = os.lstat(os.path.join(root, file_name))
+            except OSError:
+                continue
+            fingerprint.append((root, file_name, stat.st_mtime_ns, stat.st_size))
+    return fingerprint
+
+
+class Watcher:
+    """Keeps the status of indexed repos current by watching them for changes
+
+    Parameters
+    -----------
+    debounce : float
+        Seconds without events before a changed repo is read again
+    poll_interval : float
+        Seconds between checks of repos that are polled instead of watched
+    workers : int
+        Number of repos read at the same time
+    path : str
+        Socket to listen on, socket_path() by default
+    """
+
+    def __init__(self, debounce=DEBOUNCE, poll_interval=POLL_INTERVAL, workers=STATUS_WORKERS, path=None):
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.workers = workers
+        self.path = path or socket_path()
+        self.repos = {} # name -> Commands
+        self.table = {} # name -> {"status", "updated", "need_attention"}
+        self._lock = threading.Lock()
+        self._watches = {} # watch descriptor -> (repo name, directory)
+        self._dirty = {} # repo name -> time it may be read
+        self._running = set()
+        self._polled = {} # repo name -> last fingerprint, None until the first poll
+        self._polling = set()
+        self._stop = threading.Event()
+        self._reload = threading.Event()
+        self._server = None
+        try:
+            self._inotify = Inotify()
+        except OSError:
+            self._inotify = None
+
+    # status table
+
+    def _read_status(self, name):
+        repo = self.repos.get(name)
+        try:
+            if repo is None:
+                return
+            # --no-optional-locks keeps git from refreshing the index, which would wake the watch again
+            scope = repo.scope()
+            returncode, output = repo._run("--no-optional-locks", *repo.status_arguments(scope), stderr=PIPE)
+            if returncode != 0:
+                status = RepoStatus(error=output.decode("utf-8", "replace"))
+            else:
+                status = parse_porcelain_status(output)
+                STATUS_CACHE.put(repo, status, scope=scope)
+            with self._lock:
+                self.table[name] = {"status": status.as_dict(), "updated": time.time(),
+                                    "need_attention": bool(status.need_attention())}
+        finally:
+            with self._lock:
+                self._running.discard(name)
+
+    def snapshot(self, names=None):
+        """Return a copy of the status table, limited to names if given"""
+        with self._lock:
+            if names:
+                return {name: dict(self.table[name]) for name in names if name in self.table}
+            return {name: dict(entry) for name, entry in self.table.items()}
+
+    def mark(self, name, delay=None):
+        """Schedule the repo called name to be read again once it has been quiet for delay seconds"""
+        with self._lock:
+            self._dirty[name] = time.monotonic() + (self.debounce if delay is None else delay)
+
+    # watches
+
+    def _watch_tree(self, name, directory, skip_git=True):
+        """Watch directory and every folder below it. Returns False if a watch could not be added"""
+        for root, folders, _ in os.walk(directory):
+            if skip_git:
+                folders[:] = [folder for folder in folders if folder != ".git"]
+            try:
+                self._watches[self._inotify.add_watch(root)] = (name, root)
+            except OSError as error:
+                if error.errno in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                    continue
+                return False
+        return True
+
+    def _watch_repo(self, name, repo):
+        if self._inotify is None:
+            return False
+        repo_git_dir, common_dir = str(git_dir(repo.dir)), str(common_git_dir(repo.dir))
+        try:
+            for directory in {repo_git_dir, common_dir}: # HEAD, index and packed-refs
+                self._watches[self._inotify.add_watch(directory)] = (name, directory)
+        except OSError:
+            return False
+        return (self._watch_tree(name, os.path.join(common_dir, "refs"), skip_git=False)
+                and self._watch_tree(name, repo.dir))
+
+    def _unwatch_all(self):
+        if self._inotify is not None:
+            for wd in list(self._watches):
+                self._inotify.remove_watch(wd)
+        self._watches.clear()
+
+    def load(self):
+        """(Re)load the index, watch every repo and schedule all of them to be read"""
+        self._unwatch_all()
+        with self._lock:
+            self._polled.clear()
+        repos = {repo.name: repo for repo in load_multiple(_all=True)}
+        with self._lock:
+            self.repos = repos
+            for name in list(self.table):
+                if name not in repos:
+                    del self.table[name]
+        for name, repo in repos.items():
+            if not self._watch_repo(name, repo):
+                with self._lock:
+                    self._polled[name] = None
+            self.mark(name, delay=0)
+
+    def _handle_events(self, events):
+        for wd, mask, file_name in events:
+            if mask & IN_Q_OVERFLOW: # events were lost, read everything again
+                for name in self.repos:
+                    self.mark(name)
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            watched = self._watches.get(wd)
+            if watched is None:
+                continue
+            name, directory = watched
+            if file_name.endswith(".lock"):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                if not self._watch_tree(name, os.path.join(directory, file_name), skip_git=".git" not in directory):
+                    with self._lock:
+                        self._polled.setdefault(name, None)
+            self.mark(name)
+
+    def _poll(self, executor):
+        """Check the polled repos for changes with executor
+
+        Polled repos are the ones too big to watch, so their trees are walked in the
+        worker threads rather than in the loop handling events
+        """
+        with self._lock:
+            names = [name for name in self._polled if name not in self._polling]
+            self._polling.update(names)
+        for name in names:
+            executor.submit(self._poll_repo, name)
+
+    def _poll_repo(self, name):
+        try:
+            repo = self.repos.get(name)
+            if repo is None:
+                return
+            fingerprint = _tree_fingerprint(repo.dir)
+            with self._lock:
+                if name not in self._polled: # reloaded meanwhile
+                    return
+                previous, self._polled[name] = self._polled[name], fingerprint
+            if previous is not None and fingerprint != previous:
+                self.mark(name, delay=0)
+        finally:
+            with self._lock:
+                self._polling.discard(name)
+
+    # main loop
+
+    def _due(self):
+        """Return names of repos that are ready to be read and the seconds until the next one is"""
+        now = time.monotonic()
+        due, wait = [], None
+        with self._lock:
+            for name, when in list(self._dirty.items()):
+                if name in self._running:
+                    continue
+                if when <= now:
+                    del self._dirty[name]
+                    self._running.add(name)
+                    due.append(name)
+                else:
+                    wait = when - now if wait is None else min(wait, when - now)
+        return due, wait
+
+    def run(self):
+        """Serve the status table until stop() is called"""
+        self.start_server()
+        self.load()
+        next_poll = time.monotonic() # first poll records where polled repos start from
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            try:
+                while not self._stop.is_set():
+                    if self._reload.is_set():
+                        self._reload.clear()
+                        self.load()
+                        next_poll = time.monotonic()
+                    due, wait = self._due()
+                    for name in due:
+                        executor.submit(self._read_status, name)
+                    timeout = next_poll - time.monotonic()
+                    if wait is not None:
+                        timeout = min(timeout, wait)
+                    timeout = min(max(timeout, 0), 1.0) # wake up regularly to notice stop()
+                    if self._inotify is not None:
+                        self._handle_events(self._inotify.read(timeout))
+                    else:
+                        self._stop.wait(timeout)
+                    if time.monotonic() >= next_poll:
+                        self._poll(executor)
+                        next_poll = time.monotonic() + self.poll_interval
+            finally:
+                self.close()
+
+    def stop(self):
+        """Make run() return"""
+        self._stop.set()
+
+    def close(self):
+        self._unwatch_all()
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    # socket
+
+    def handle_request(self, request):
+        """Answer a query() request"""
+        command = request.get("command", "status")
+        if command == "ping":
+            return {"ok": True, "repos": len(self.repos), "watched": len(self.repos) - len(self._polled)}
+        if command == "status":
+            return {"ok": True, "repos": self.snapshot(request.get("repos"))}
+        if command == "attention":
+            table = self.snapshot()
+            return {"ok": True, "repos": {name: entry for name, entry in table.items() if entry["need_attention"]}}
+        if command == "refresh":
+            for name in request.get("repos") or list(self.repos):
+                self.mark(name, delay=0)
+            return {"ok": True}
+        if command == "reload":
+            self._reload.set()
+            return {"ok": True}
+        return {"ok": False, "error": "Unknown command {}".format(command)}
+
+    def start_server(self):
+        """Listen for query() requests on the Unix socket"""
+        if not hasattr(socket, "AF_UNIX"):
+            raise Exception("The watch daemon needs Unix domain sockets")
+        if os.path.exists(self.path):
+            try:
+                query("ping", path=self.path)
+            except OSError: # left behind by a daemon that did not shut down cleanly
+                os.unlink(self.path)
+            else:
+                raise Exception("A watch daemon is already listening on {}".format(self.path))
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        watcher = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                try:
+                    response = watcher.handle_request(json.loads(line.decode("utf-8") or "{}"))
+                except ValueError as error:
+                    response = {"ok": False, "error": str(error)}
+                self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+
+        class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+        self._server = Server(self.path, Handler)
+        os.chmod(self.path, 0o600)
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+
+def query(command="status", repos=None, path=None, timeout=5.0):
+    """Send a request to a running watch daemon and return its answer
+
+    Parameters
+    -----------
+    command : str
+        status (current status of repos), attention (repos needing attention only),
+        refresh (read repos again now), reload (reload the index) or ping
+    repos : list
+        Names of the repos the command applies to, all repos if None
+    path : str
+        Socket of the daemon, socket_path() by default
+
+    Raises OSError if no daemon is listening
+    """
+    request = {"command": command}
+    if repos:
+        request["repos"] = list(repos)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.settimeout(timeout)
+        connection.connect(path or socket_path())
+        connection.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        with connection.makefile("rb") as response:
+            answer = json.loads(response.readline().decode("utf-8"))
+    if not answer.get("ok"):
+        raise Exception(answer.get("error", "The watch daemon could not answer"))
+    return answer
+
+
+def main(argv=None):
+    """Entry point of `python -m pygit watch`"""
+    parser = argparse.ArgumentParser(prog="python -m pygit watch", description="Keep repo statuses current")
+    parser.add_argument("--debounce", type=float, default=DEBOUNCE, help="Seconds of quiet before a changed repo is read")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="Seconds between checks of repos that cannot be watched")
+    parser.add_argument("--socket", help="Socket to listen on")
+    parser.add_argument("-q", "--query", nargs="*", metavar="NAME", help="Print the status of repos from a running daemon instead")
+    args = parser.parse_args(argv)
+
+    if args.query is not None:
+        answer = query("status", args.query, path=args.socket)
+        for name, entry in sorted(answer["repos"].items()):
+            status = RepoStatus.from_dict(entry["status"])
+            print("*** {} ***{}\n{}\n".format(name, " (needs attention)" if entry["need_attention"] else "", status))
+        return
+
+    get_registry() # fail early if there is no index
+    watcher = Watcher(debounce=args.debounce, poll_interval=args.poll_interval, path=args.socket)
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: watcher.stop())
+    print("Watching indexed repos. Listening on {}".format(watcher.path))
+    watcher.run()